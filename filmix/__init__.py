@@ -10,13 +10,20 @@ version = '0.12.0'
     JSON_ERROR,
     ID_ERROR,
     DB_EXISTS_ERROR,
-) = range(8)
+    DUPLICATE_ERROR,
+    DB_BUSY_ERROR,
+    WORKERS_ERROR,
+) = range(11)
 
 ERRORS = {
     DIR_ERROR: "config directory error",
     FILE_ERROR: "config file error",
     DB_READ_ERROR: "database read error",
     DB_WRITE_ERROR: "database write error",
+    JSON_ERROR: "database format error",
     ID_ERROR: "to-do id error",
     DB_EXISTS_ERROR: "DB already exists, try adding -f to force delete",
+    DUPLICATE_ERROR: "film is already in the list",
+    DB_BUSY_ERROR: "database is busy in another filmix process, try again",
+    WORKERS_ERROR: "all workers exited with jobs left in the queue",
 }
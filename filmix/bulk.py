@@ -0,0 +1,90 @@
+"""Film list formats for ``filmix import`` and ``filmix export``.
+
+text   one url per line, optionally followed by a tab and the name
+       selector and another tab and the quality selector
+jsonl  one JSON object per line, with at least a "url" key
+csv    a header row naming the columns, with at least a "url" column
+"""
+import csv
+import json
+from typing import Any, Dict, Iterable, Iterator, Mapping, TextIO
+
+from filmix.film import json_default
+
+TEXT_FORMAT = "text"
+JSONL_FORMAT = "jsonl"
+CSV_FORMAT = "csv"
+FORMATS = (TEXT_FORMAT, JSONL_FORMAT, CSV_FORMAT)
+
+# Same defaults as 'filmix add'
+DEFAULT_SELECTORS = {"n_selector": "h1.name", "q_selector": "div.quality"}
+CSV_FIELDS = ("id", "url", "name", "n_selector", "q_selector", "quality", "imdb", "imdb_votes",
+              "filmix_users_rating", "last_checked")
+
+
+def guess_format(path: str) -> str:
+    if path.endswith((".jsonl", ".ndjson")):
+        return JSONL_FORMAT
+    if path.endswith(".csv"):
+        return CSV_FORMAT
+    return TEXT_FORMAT
+
+
+def read_films(lines: Iterable[str], format: str = TEXT_FORMAT) -> Iterator[Dict[str, Any]]:
+    """Yield a film dict per input row, lazily, with default selectors.
+
+    Raises ValueError naming the line of a malformed JSONL row.
+    """
+    if format == CSV_FORMAT:
+        rows: Iterable[Dict[str, Any]] = csv.DictReader(lines)
+    elif format == JSONL_FORMAT:
+        rows = _jsonl_rows(lines)
+    else:
+        rows = _text_rows(lines)
+    for row in rows:
+        film = {key: value for key, value in row.items() if key and value not in (None, "")}
+        for key, value in DEFAULT_SELECTORS.items():
+            film.setdefault(key, value)
+        yield film
+
+
+def _text_rows(lines: Iterable[str]) -> Iterator[Dict[str, str]]:
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        # Selectors may contain spaces, so only tabs separate the columns
+        yield dict(zip(("url", "n_selector", "q_selector"),
+                       (part.strip() for part in line.split("\t"))))
+
+
+def _jsonl_rows(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as ex:
+            raise ValueError(f"line {number} is not valid JSON, {ex}") from None
+        if not isinstance(row, dict):
+            raise ValueError(f"line {number} is not a JSON object")
+        yield row
+
+
+def write_films(films: Iterable[Mapping[str, Any]], stream: TextIO,
+                format: str = JSONL_FORMAT) -> int:
+    """Write films one at a time, return how many were written."""
+    count = 0
+    if format == CSV_FORMAT:
+        writer = csv.DictWriter(stream, CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for count, film in enumerate(films, 1):
+            writer.writerow(film)
+    elif format == JSONL_FORMAT:
+        for count, film in enumerate(films, 1):
+            stream.write(json.dumps(film, ensure_ascii=False, default=json_default) + "\n")
+    else:
+        for count, film in enumerate(films, 1):
+            columns = (film.get(key) or "" for key in ("url", "n_selector", "q_selector"))
+            stream.write("\t".join(columns).rstrip("\t") + "\n")
+    return count
@@ -1,9 +1,12 @@
-import webbrowser
+import datetime
+import sys
+from contextlib import nullcontext
 from pathlib import Path
 from typing import List, Optional
 
 import typer
-from filmix import ERRORS, app_name, version, config, database, filmix_lib
+from filmix import (DUPLICATE_ERROR, ERRORS, app_name, version, bulk, config, database,
+                    filmix_lib, jobqueue, profiling, ratelimit)
 
 app = typer.Typer()
 
@@ -18,17 +21,27 @@ def _version_callback(value: bool) -> None:
 def init(
     db_path: str = typer.Option(str(database.DEFAULT_DB_FILE_PATH),
                                 "--db-path", "-db", prompt="film database location?"),
-    force: bool = typer.Option(0, "--force", "-f", )
+    force: bool = typer.Option(0, "--force", "-f", ),
+    backend: str = typer.Option(database.JSON_BACKEND, "--backend", "-b",
+                                help="Storage backend: json, sqlite or journal."),
+    migrate_from: str = typer.Option("", "--migrate-from", "-m",
+                                     help="Copy films from an existing JSON database."),
 ) -> None:
-    """Initialize the film database."""
-    app_init_error = config.init_app(db_path)
+    """Initialize the film database, options --backend, --migrate-from"""
+    if backend not in database.BACKENDS:
+        typer.secho(f'Unknown backend "{backend}"', fg=typer.colors.RED)
+        raise typer.Exit(1)
+    if migrate_from and Path(migrate_from).resolve() == Path(db_path).resolve():
+        typer.secho("Migrate into a different database path", fg=typer.colors.RED)
+        raise typer.Exit(1)
+    app_init_error = config.init_app(db_path, backend)
     if app_init_error:
         typer.secho(
             f'Creating config file failed with "{ERRORS[app_init_error]}"',
             fg=typer.colors.RED,
         )
         raise typer.Exit(1)
-    db_init_error = database.init_database(Path(db_path), force)
+    db_init_error = database.init_database(Path(db_path), force, backend)
     if db_init_error:
         typer.secho(
             f'Creating database failed with "{ERRORS[db_init_error]}"',
@@ -37,6 +50,16 @@ def init(
         raise typer.Exit(1)
     else:
         typer.secho(f"The film database is {db_path}", fg=typer.colors.GREEN)
+    if migrate_from:
+        migrated = database.migrate_json(Path(migrate_from), Path(db_path), backend)
+        if migrated.error:
+            typer.secho(
+                f'Migrating films failed with "{ERRORS[migrated.error]}"',
+                fg=typer.colors.RED,
+            )
+            raise typer.Exit(1)
+        typer.secho(f"Migrated {len(migrated.todo_list)} films from {migrate_from}",
+                    fg=typer.colors.GREEN)
 
 
 @app.callback()
@@ -53,7 +76,7 @@ def main(
     return
 
 
-def get_todoer() -> filmix_lib.Todoer:
+def get_todoer(**options) -> filmix_lib.Todoer:
     if config.CONFIG_FILE_PATH.exists():
         db_path = database.get_database_path(config.CONFIG_FILE_PATH)
     else:
@@ -63,7 +86,8 @@ def get_todoer() -> filmix_lib.Todoer:
         )
         raise typer.Exit(1)
     if db_path.exists():
-        return filmix_lib.Todoer(db_path)
+        backend = database.get_database_backend(config.CONFIG_FILE_PATH)
+        return filmix_lib.Todoer(db_path, backend=backend, **options)
     else:
         typer.secho(
             f'Database not found. Please, run "{app_name} init"',
@@ -82,6 +106,12 @@ def add(
     todoer = get_todoer()
     film, error = todoer.add(
         url=url, n_selector=n_selector, q_selector=q_selector)
+    if error == DUPLICATE_ERROR:
+        typer.secho(
+            f"Film is already in the list as # {film.get('id')}: "
+            f"{film.get('name') or film.get('url')}", fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
     if error:
         typer.secho(
             f'Adding film failed with "{ERRORS[error]}"', fg=typer.colors.RED
@@ -89,7 +119,7 @@ def add(
         raise typer.Exit(1)
     else:
         typer.secho(
-            f"""New url: "{film.get('url')}" \n"""
+            f"""New film # {film.get('id')}, url: "{film.get('url')}" \n"""
             f"""Name Selector: {film.get('n_selector')}\n"""
             f"""Quality Selector: {film.get('q_selector')}""",
             fg=typer.colors.GREEN,
@@ -98,9 +128,32 @@ def add(
 
 @app.command(name="list")
 def list_all(fetch: bool = typer.Option(False, '--fetch', '-f'),
-             verbose: bool = typer.Option(False, '--verbose', '-v')) -> None:
-    """List all films, options --fetch|-f, --verbose|-v"""
-    todoer = get_todoer()
+             verbose: bool = typer.Option(False, '--verbose', '-v'),
+             stream: bool = typer.Option(
+                 False, '--stream', '-s',
+                 help="Stop downloading a page once all fields are found."),
+             profile: bool = typer.Option(
+                 False, '--profile', help="Print per-stage fetch timings."),
+             profile_out: str = typer.Option(
+                 "", '--profile-out',
+                 help="Save the profile: *.json for stage timings, "
+                      "*.pstats/*.prof for a cProfile dump."),
+             parse_pool: bool = typer.Option(
+                 False, '--parse-pool', help="Parse pages in worker processes."),
+             parse_workers: int = typer.Option(
+                 0, '--parse-workers', help="Parse pool size, defaults to the CPU count."),
+             budget: int = typer.Option(
+                 0, '--budget', '-b',
+                 help="Fetch at most this many due films, most overdue first."),
+             concurrency: int = typer.Option(
+                 32, '--concurrency', '-c', help="Pages fetched at the same time."),
+             rate: float = typer.Option(
+                 0.0, '--rate', help="Requests per second per site, 0 for no limit.")) -> None:
+    """List all films, options --fetch|-f, --verbose|-v, --stream|-s, --profile, --parse-pool, --budget, --concurrency, --rate"""
+    profiler = profiling.Profiler() if profile or profile_out else None
+    todoer = get_todoer(stream=stream, profiler=profiler, parse_pool=parse_pool,
+                        parse_workers=parse_workers, budget=budget, concurrency=concurrency,
+                        limits=ratelimit.RateLimits(rate=rate))
     film_list = todoer.get_film_list()
     if len(film_list) == 0:
         typer.secho(
@@ -113,12 +166,25 @@ def list_all(fetch: bool = typer.Option(False, '--fetch', '-f'),
                 fg=typer.colors.GREEN, bold=True)
     spacer = "-" * width
     typer.secho(spacer, fg=typer.colors.GREEN)
-    id_len = 2 if len(film_list) >= 10 else 1
+    id_len = 2 if max((film.get('id') for film in film_list), default=0) >= 10 else 1
     if fetch:
         typer.secho("Fetching status...", fg=typer.colors.CYAN)
-        todoer.start_fetch()
+        if profile_out.endswith(('.pstats', '.prof')):
+            import cProfile
+            with cProfile.Profile() as cprofile:
+                todoer.start_fetch()
+            cprofile.dump_stats(profile_out)
+            typer.secho(f"cProfile stats saved to {profile_out}", fg=typer.colors.CYAN)
+        else:
+            todoer.start_fetch()
+        if profiler:
+            typer.secho(profiler.report(), fg=typer.colors.CYAN)
+            if profile_out.endswith('.json'):
+                profiler.write_json(Path(profile_out))
+                typer.secho(f"Stage timings saved to {profile_out}", fg=typer.colors.CYAN)
 
-    for id, film in enumerate(film_list, 1):
+    for film in film_list:
+        id = film.get('id')
         if not film.get('name'):
             film['name'] = film.get('url')
 
@@ -126,6 +192,8 @@ def list_all(fetch: bool = typer.Option(False, '--fetch', '-f'),
         if quality := film.get('quality'):
             msg += str(quality)
         if imdb := film.get('imdb'):
+            if votes := film.get('imdb_votes'):
+                imdb = f"{imdb} ({votes})"
             msg += (18 - len(str(quality))) * ' ' + f"IMDB:{imdb}"
         if filmix_users_rating := film.get('filmix_users_rating'):
             msg += (15 - len(str(imdb))) * ' ' + \
@@ -135,18 +203,22 @@ def list_all(fetch: bool = typer.Option(False, '--fetch', '-f'),
         if verbose:
             msg = '| '.join([f'{key}:{val}' for key, val in film.items()])
         typer.secho(msg, fg=typer.colors.BLUE)
+    if verbose:
+        cache = todoer.cache_info()
+        typer.secho(f"DB cache: {cache.hits} hits, {cache.misses} misses",
+                    fg=typer.colors.CYAN)
     typer.secho(spacer + "\n", fg=typer.colors.CYAN)
     print_menu()
 
 
 @app.command()
-def change(film_ids: List[int] = typer.Argument(...),
+def change(film_ids: List[str] = typer.Argument(..., help="Film ids or urls."),
            url: str = typer.Option("", '--url', '-u'),
            name: str = typer.Option("", '--name', '-n'),
            n_selector: str = typer.Option("", "--n_selector", "-ns"),
            q_selector: str = typer.Option("", "--q_selector", "-qs")
            ) -> None:
-    """Edit film, options --url, --name, -ns, -qs"""
+    """Edit films given by id or url, options --url, --name, -ns, -qs"""
     todoer = get_todoer()
     data = {
         'url': url,
@@ -171,7 +243,7 @@ def change(film_ids: List[int] = typer.Argument(...),
 
 @app.command()
 def remove(
-    film_id: int = typer.Argument(...),
+    film_id: str = typer.Argument(..., help="Film id or url."),
     force: bool = typer.Option(
         False,
         "--force",
@@ -179,7 +251,7 @@ def remove(
         help="Force deletion without confirmation.",
     ),
 ) -> None:
-    """Remove a film using its film_id."""
+    """Remove a film using its film_id or url."""
     todoer = get_todoer()
 
     def _remove():
@@ -199,14 +271,12 @@ def remove(
     if force:
         _remove()
     else:
-        film_list = todoer.get_film_list()
-        try:
-            film = film_list[film_id - 1]
-        except IndexError:
+        film, error = todoer.find(film_id)
+        if error:
             typer.secho("Invalid film_id", fg=typer.colors.RED)
             raise typer.Exit(1)
         delete = typer.confirm(
-            f"Delete film # {film_id}: {film.get('name') or film.get('url')}?"
+            f"Delete film # {film.get('id')}: {film.get('name') or film.get('url')}?"
         )
         if delete:
             _remove()
@@ -214,6 +284,148 @@ def remove(
             typer.echo("Operation canceled")
 
 
+@app.command()
+def serve(host: str = typer.Option("127.0.0.1", '--host'),
+          port: int = typer.Option(8765, '--port', '-p'),
+          max_idle: float = typer.Option(
+              300.0, '--max-idle', help="Longest wait between scheduler checks, seconds."),
+          budget: int = typer.Option(0, '--budget', '-b', help="Fetch at most this many films per run."),
+          concurrency: int = typer.Option(32, '--concurrency', '-c'),
+          rate: float = typer.Option(0.0, '--rate', help="Requests per second per site."),
+          stream: bool = typer.Option(False, '--stream', '-s')) -> None:
+    """Refresh films in the background and serve a local JSON API"""
+    from filmix import server
+    todoer = get_todoer(stream=stream, profiler=profiling.Profiler(), budget=budget,
+                        concurrency=concurrency, limits=ratelimit.RateLimits(rate=rate))
+    typer.secho(f"Serving films on http://{host}:{port}", fg=typer.colors.GREEN)
+    server.serve(todoer, host, port, max_idle)
+
+
+@app.command()
+def worker(concurrency: int = typer.Option(32, '--concurrency', '-c'),
+           batch: int = typer.Option(
+               0, '--batch', help="Jobs leased at a time, defaults to 4 x concurrency."),
+           lease: float = typer.Option(
+               jobqueue.DEFAULT_LEASE, '--lease',
+               help="Seconds to finish a batch in before its jobs go to another worker."),
+           once: bool = typer.Option(
+               False, '--once', help="Exit when the queue is empty instead of waiting."),
+           rate: float = typer.Option(0.0, '--rate', help="Requests per second per site."),
+           stream: bool = typer.Option(False, '--stream', '-s')) -> None:
+    """Fetch films queued by "filmix dispatch", on this or another machine"""
+    import asyncio
+    todoer = get_todoer(stream=stream, concurrency=concurrency, history=False,
+                        limits=ratelimit.RateLimits(rate=rate))
+    name = jobqueue.worker_name()
+    typer.secho(f"Worker {name} waiting for jobs...", fg=typer.colors.CYAN)
+    with todoer.job_queue() as queue:
+        try:
+            done = asyncio.run(todoer.work(queue, name, batch, lease, once=once))
+        except KeyboardInterrupt:
+            typer.secho("Interrupted, unfinished jobs were handed back.", fg=typer.colors.RED)
+            done = None
+    if done is not None:
+        typer.secho(f"Worker {name} did {done} jobs", fg=typer.colors.GREEN)
+    typer.echo(todoer.summary())
+
+
+@app.command()
+def dispatch(workers: int = typer.Option(
+                 0, '--workers', '-w',
+                 help="Also start this many local workers, each exiting when done."),
+             budget: int = typer.Option(
+                 0, '--budget', '-b',
+                 help="Queue at most this many due films, most overdue first."),
+             poll: float = typer.Option(
+                 1.0, '--poll', help="Seconds between applying the workers' results.")) -> None:
+    """Queue the due films for workers and save what they fetch"""
+    import subprocess
+    todoer = get_todoer(budget=budget)
+    with todoer.job_queue() as queue:
+        typer.secho(f"Queueing due films in {queue.path}", fg=typer.colors.CYAN)
+        queued = todoer.queue_due(queue)
+        if queued.error:
+            typer.secho(f'Queueing films failed with "{ERRORS[queued.error]}"',
+                        fg=typer.colors.RED)
+            raise typer.Exit(1)
+        # Started once the queue is filled, a --once worker exits on an empty one
+        processes = [subprocess.Popen([sys.executable, '-m', 'filmix', 'worker', '--once'])
+                     for _ in range(workers)]
+        workers_alive = ((lambda: any(process.poll() is None for process in processes))
+                         if processes else None)
+        try:
+            result = todoer.dispatch(queue, poll, workers_alive)
+        finally:
+            for process in processes:
+                process.wait()
+    if result.error:
+        typer.secho(f'Saving results failed with "{ERRORS[result.error]}"', fg=typer.colors.RED)
+        raise typer.Exit(1)
+    typer.secho(f"Queued {queued.queued} films, saved {result.applied} results",
+                fg=typer.colors.GREEN)
+    if result.given_up:
+        typer.secho(f"Gave up on {len(result.given_up)} films after "
+                    f"{queue.max_attempts} leases:", fg=typer.colors.RED)
+        for url in result.given_up[:filmix_lib.SUMMARY_MAX_URLS]:
+            typer.secho(f"  {url}", fg=typer.colors.RED)
+
+
+@app.command(name="import")
+def import_films(
+    source: str = typer.Argument("-", help="File to read, - for stdin."),
+    format: str = typer.Option("", "--format", "-F",
+                               help="text, jsonl or csv, guessed from the file name."),
+) -> None:
+    """Add many films from a file or stdin in one write, skipping duplicates"""
+    format = format or bulk.guess_format(source)
+    if format not in bulk.FORMATS:
+        typer.secho(f'Unknown format "{format}"', fg=typer.colors.RED)
+        raise typer.Exit(1)
+    todoer = get_todoer()
+    try:
+        with (nullcontext(sys.stdin) if source == "-"
+              else Path(source).open(encoding="utf-8", newline="")) as lines:
+            result = todoer.import_films(bulk.read_films(lines, format))
+    except (OSError, ValueError) as ex:
+        typer.secho(f"Importing films failed, {ex}", fg=typer.colors.RED)
+        raise typer.Exit(1)
+    if result.error:
+        typer.secho(
+            f'Importing films failed with "{ERRORS[result.error]}"', fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    typer.secho(f"Imported {result.added} films, skipped {result.duplicates} duplicates "
+                f"and {result.invalid} invalid rows", fg=typer.colors.GREEN)
+
+
+@app.command(name="export")
+def export_films(
+    target: str = typer.Argument("-", help="File to write, - for stdout."),
+    format: str = typer.Option("", "--format", "-F",
+                               help="jsonl, csv or text, guessed from the file name."),
+) -> None:
+    """Write all films to a file or stdout as JSONL, CSV or a url list"""
+    format = format or (bulk.guess_format(target) if target != "-" else bulk.JSONL_FORMAT)
+    if format not in bulk.FORMATS:
+        typer.secho(f'Unknown format "{format}"', fg=typer.colors.RED)
+        raise typer.Exit(1)
+    todoer = get_todoer()
+    try:
+        with (nullcontext(sys.stdout) if target == "-"
+              else Path(target).open("w", encoding="utf-8", newline="")) as stream:
+            result = todoer.export_films(stream, format)
+    except OSError as ex:
+        typer.secho(f"Exporting films failed, {ex}", fg=typer.colors.RED)
+        raise typer.Exit(1)
+    if result.error:
+        typer.secho(
+            f'Exporting films failed with "{ERRORS[result.error]}"', fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    if target != "-":
+        typer.secho(f"Exported {result.exported} films to {target}", fg=typer.colors.GREEN)
+
+
 @app.command(name="clear")
 def remove_all(
     force: bool = typer.Option(
@@ -238,31 +450,88 @@ def remove_all(
         typer.echo("Operation canceled")
 
 
+def _observed(observation) -> str:
+    """One history row as quality, IMDB and filmix rating columns."""
+    imdb = '' if observation.imdb is None else f"{observation.imdb:.1f} ({observation.votes})"
+    rating = '' if observation.rating is None else str(observation.rating)
+    return f"{observation.quality or '':<18} IMDB:{imdb:<16} Filmix:{rating}"
+
+
 @app.command()
-def open(film_id: int = typer.Argument(...)):
+def history(film_id: str = typer.Argument(
+                "", help="Film id or url to show, all changed films if omitted."),
+            changed: bool = typer.Option(
+                False, '--changed', '-c', help="Show what changed in the last fetch.")) -> None:
+    """Show a film's quality and rating history, or what changed in the last fetch"""
+    todoer = get_todoer()
+    if film_id and not changed:
+        film, error = todoer.find(film_id)
+        if error:
+            typer.secho("Invalid film_id", fg=typer.colors.RED)
+            raise typer.Exit(1)
+        typer.secho(f"{film.get('id')}. {film.get('name') or film.get('url')}",
+                    fg=typer.colors.GREEN)
+        observations = todoer.history.for_url(film.get('url'))
+        if not observations:
+            typer.secho("No history recorded yet", fg=typer.colors.RED)
+        for observation in observations:
+            when = datetime.datetime.fromtimestamp(observation.time).strftime('%Y-%m-%d %H:%M')
+            typer.secho(f"{when}  {_observed(observation)}", fg=typer.colors.BLUE)
+        return
+    runs = todoer.history.runs()
+    if not runs:
+        typer.secho("No fetch recorded yet", fg=typer.colors.RED)
+        return
+    last_run = datetime.datetime.fromtimestamp(runs[-1]).strftime('%Y-%m-%d %H:%M')
+    film_list = todoer.get_film_list()
+    changes = todoer.history.changed_in_run(film.get('url') for film in film_list)
+    typer.secho(f"{len(changes)} films changed in the fetch of {last_run}", fg=typer.colors.GREEN)
+    for film in film_list:
+        if film.get('url') in changes:
+            before, after = changes[film.get('url')]
+            typer.secho(f"{film.get('id')}. {film.get('name') or film.get('url')}",
+                        fg=typer.colors.BLUE)
+            if before is not None:
+                typer.secho(f"    was  {_observed(before)}", fg=typer.colors.BLUE)
+            typer.secho(f"    now  {_observed(after)}", fg=typer.colors.BLUE)
+
+
+@app.command()
+def open(film_id: str = typer.Argument(...)):
     """Open in default browser 
 
     Args:
-        film_id (int, optional): _description_. Defaults to typer.Argument(...).
+        film_id (str): film id or url. Defaults to typer.Argument(...).
     """
+    import webbrowser
     try:
         todoer = get_todoer()
-        film_list = todoer.get_film_list()
+        film, error = todoer.find(film_id)
+        if error:
+            typer.secho("Invalid film_id", fg=typer.colors.RED)
+            return
         webbrowser.register('vivaldi', None, webbrowser.BackgroundBrowser(
             "C:\\Program Files\\Vivaldi\Application\\vivaldi.exe"))
-        webbrowser.get('vivaldi').open(film_list[film_id - 1].get('url'))
+        webbrowser.get('vivaldi').open(film.get('url'))
     except Exception as ex:
         print(str(ex))
 
 
 def print_useful():
     typer.secho('python -m filmix list -f', fg=typer.colors.GREEN)
-    typer.secho('python -m filmix open film_id', fg=typer.colors.GREEN)
-    typer.secho('python -m filmix remove film_id', fg=typer.colors.GREEN)
+    typer.secho('python -m filmix open film_id|url', fg=typer.colors.GREEN)
+    typer.secho('python -m filmix remove film_id|url', fg=typer.colors.GREEN)
     typer.secho('python -m filmix add https://filmix.ac/films/1',
                 fg=typer.colors.GREEN)
     typer.secho(
-        'python -m filmix change film_id --url|-u --name|-n -ns -qs', fg=typer.colors.GREEN)
+        'python -m filmix change film_id|url --url|-u --name|-n -ns -qs', fg=typer.colors.GREEN)
+
+
+# list_all is called directly from the menu, where typer does not fill in
+# option defaults
+MENU_LIST_OPTIONS = dict(verbose=False, stream=False, profile=False, profile_out="",
+                         parse_pool=False, parse_workers=0, budget=0,
+                         concurrency=32, rate=0.0)
 
 
 def print_menu():
@@ -276,9 +545,9 @@ def print_menu():
     while True:
         uinput = typer.prompt("Select from menu")
         if uinput == '1':
-            film_id = typer.prompt("Enter film id")
-            if film_id.isdigit():
-                open(int(film_id))
+            film_id = typer.prompt("Enter film id or url")
+            if film_id:
+                open(film_id)
         if uinput == '2':
             url = typer.prompt("Enter film url")
             if url:
@@ -291,15 +560,15 @@ def print_menu():
                 else:
                     add(url=url)
         if uinput == '3':
-            film_id = typer.prompt("Enter film id")
-            if film_id.isdigit():
-                remove(int(film_id))
+            film_id = typer.prompt("Enter film id or url")
+            if film_id:
+                remove(film_id)
         if uinput == '4':
             typer.clear()
-            list_all(fetch=False, verbose=False)
+            list_all(fetch=False, **MENU_LIST_OPTIONS)
         if uinput == '5':
             typer.clear()
-            list_all(fetch=True, verbose=False)
+            list_all(fetch=True, **MENU_LIST_OPTIONS)
         if uinput == '6':
             print_useful()
             break
@@ -9,12 +9,12 @@ CONFIG_DIR_PATH = Path(typer.get_app_dir(app_name))
 CONFIG_FILE_PATH = CONFIG_DIR_PATH / "config.ini"
 
 
-def init_app(db_path: str) -> int:
+def init_app(db_path: str, backend: str = "json") -> int:
     """Initialize the application."""
     config_code = _init_config_file()
     if config_code != SUCCESS:
         return config_code
-    database_code = _create_database(db_path)
+    database_code = _create_database(db_path, backend)
     if database_code != SUCCESS:
         return database_code
     return SUCCESS
@@ -34,9 +34,9 @@ def _init_config_file() -> int:
     return SUCCESS
 
 
-def _create_database(db_path: str) -> int:
+def _create_database(db_path: str, backend: str) -> int:
     config_parser = configparser.ConfigParser()
-    config_parser["General"] = {"database": db_path}
+    config_parser["General"] = {"database": db_path, "backend": backend}
     try:
         with CONFIG_FILE_PATH.open("w") as file:
             config_parser.write(file)
@@ -1,56 +1,1236 @@
 import configparser
+import hashlib
 import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, List, NamedTuple
-from filmix import DB_READ_ERROR, DB_WRITE_ERROR, JSON_ERROR, SUCCESS, DB_EXISTS_ERROR
+from typing import (Any, Callable, Container, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, TextIO)
+from filmix import (DB_BUSY_ERROR, DB_READ_ERROR, DB_WRITE_ERROR, JSON_ERROR, SUCCESS,
+                    DB_EXISTS_ERROR, ID_ERROR)
+from filmix.film import Film, as_film, json_default
+from filmix.locking import LOCK_TIMEOUT, FileLock
+from filmix.profiling import Profiler, stage
+from filmix.sites import normalize_url
+from filmix.writer import WriteBehind
 
 DEFAULT_DB_FILE_PATH = Path.home().joinpath(
     "." + Path.home().stem + "_filmix.json"
 )
 
+JSON_BACKEND = "json"
+SQLITE_BACKEND = "sqlite"
+JOURNAL_BACKEND = "journal"
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+ITER_CHUNK_SIZE = 64 * 1024
+ITER_BATCH_ROWS = 500
+# Read-modify-write attempts before giving up on a busy JSON database
+WRITE_RETRIES = 5
+# Internal: another process wrote the file since it was read
+_CONFLICT = -1
+
+
+class DBResponse(NamedTuple):
+    todo_list: List[Film]
+    error: int
+
+
+class DBRecord(NamedTuple):
+    todo: Dict[str, Any]
+    error: int
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+
+
 def get_database_path(config_file: Path) -> Path:
     """Return the current path to the to-do database."""
     config_parser = configparser.ConfigParser()
     config_parser.read(config_file)
     return Path(config_parser["General"]["database"])
 
-def init_database(db_path: Path, force) -> int:
+
+def get_database_backend(config_file: Path) -> str:
+    """Return the storage backend name configured for the database."""
+    config_parser = configparser.ConfigParser()
+    config_parser.read(config_file)
+    return config_parser["General"].get("backend", JSON_BACKEND)
+
+
+def init_database(db_path: Path, force, backend: str = JSON_BACKEND) -> int:
     """Create the to-do database."""
     if Path.exists(db_path) and not force:
         return DB_EXISTS_ERROR
+    try:
+        _ids_path(db_path).unlink(missing_ok=True)  # A new database numbers from 1
+    except OSError:
+        return DB_WRITE_ERROR
+    if backend == SQLITE_BACKEND:
+        try:
+            for path in (db_path, Path(f"{db_path}-wal"), Path(f"{db_path}-shm")):
+                if path.exists():
+                    path.unlink()
+            return SQLiteBackend(db_path).write([]).error
+        except OSError:
+            return DB_WRITE_ERROR
+    if backend == JOURNAL_BACKEND:
+        try:
+            for path in (db_path, db_path.with_name(db_path.name + ".journal")):
+                path.unlink(missing_ok=True)
+        except OSError:
+            return DB_WRITE_ERROR
+        return JournalBackend(db_path).write([]).error
     try:
         db_path.write_text("[]")  # Empty to-do list
         return SUCCESS
     except OSError:
         return DB_WRITE_ERROR
-    
-class DBResponse(NamedTuple):
-    todo_list: List[Dict[str, Any]]
-    error: int
 
-class DatabaseHandler:
+
+def migrate_json(json_path: Path, db_path: Path, backend: str = SQLITE_BACKEND) -> DBResponse:
+    """Copy every film from a JSON database into a database of another backend."""
+    read = JSONBackend(json_path).read()
+    if read.error:
+        return read
+    return BACKENDS[backend](db_path).write(read.todo_list)
+
+
+def iter_json_array(db: TextIO, chunk_size: int = ITER_CHUNK_SIZE) -> Iterator[Any]:
+    """Yield the items of a top-level JSON array read in chunks."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        # Skip whitespace, the opening bracket and separating commas
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","
+                                     or (not started and buffer[pos] == "[")):
+            started = started or buffer[pos] == "["
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        if pos < len(buffer) and not started:
+            raise json.JSONDecodeError("Expecting '['", buffer, pos)
+        try:
+            if pos == len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, pos)
+            item, end = decoder.raw_decode(buffer, pos)
+            if end == len(buffer) and not eof:  # A number may go on in the next chunk
+                raise json.JSONDecodeError("Need more data", buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = db.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+
+def _ids_path(db_path: Path) -> Path:
+    return db_path.with_name(db_path.name + ".ids")
+
+
+def read_last_id(db_path: Path) -> int:
+    """The highest id ever given to a film of the json or journal database,
+    0 if none was recorded."""
+    try:
+        return int(_ids_path(db_path).read_text())
+    except (OSError, ValueError):
+        return 0
+
+
+def _store_last_id(db_path: Path, last_id: int) -> None:
+    """Record ``last_id`` unless a higher one is, under the file lock.
+
+    Stored before the films that use it, so a crash in between can only
+    skip ids, never give one out twice. Raises OSError.
+    """
+    if last_id <= read_last_id(db_path):
+        return
+    path = _ids_path(db_path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(str(last_id))
+    os.replace(tmp_path, path)
+
+
+def number_films(films: Iterable[Any], taken: Container[int] = (),
+                 last_id: int = 0) -> Iterator[Film]:
+    """Yield the films as Films, numbering those without an id or with a
+    taken one in place, so callers see the new ids. New ids count up from
+    the highest of ``last_id`` and the ids seen so far.
+    """
+    seen = set()
+    for film in films:
+        if not isinstance(film, Film):
+            film = Film.from_dict(film)
+        if not film.id or film.id in taken or film.id in seen:
+            film.id = last_id + 1
+        last_id = max(last_id, film.id)
+        seen.add(film.id)
+        yield film
+
+
+class FilmIndex:
+    """Positions in a film list by film id, and film ids by normalized url.
+
+    Films get ids when they are added and keep them when other films are
+    removed. A film without an id, e.g. one stored before ids existed, or
+    with an id already taken gets the next id after the highest seen, so
+    a legacy list is numbered 1..N in the order it was always listed.
+
+    ``last_id`` is the highest id ever given out, including those of
+    removed films; it never goes down, so no id is given out twice.
+    """
+
+    def __init__(self, films: List[Film], last_id: int = 0) -> None:
+        self.films = films
+        self.last_id = 0
+        self.reindex()  # Films stored without ids are numbered by position
+        self.last_id = max(self.last_id, last_id)
+
+    def reindex(self) -> None:
+        """Rebuild the index after films were removed or changed url."""
+        self._positions: Dict[int, int] = {}
+        self._urls: Dict[str, int] = {}
+        for position, film in enumerate(self.films):
+            self._add(film, position)
+
+    def _add(self, film: Film, position: int) -> None:
+        film_id = film.id
+        if not film_id or film_id in self._positions:
+            film_id = film.id = self.last_id + 1
+        self.last_id = max(self.last_id, film_id)
+        self._positions[film_id] = position
+        self._urls.setdefault(normalize_url(film.url), film_id)
+
+    def position(self, film_id: int) -> Optional[int]:
+        return self._positions.get(film_id)
+
+    def get(self, film_id: int) -> Optional[Film]:
+        position = self._positions.get(film_id)
+        return None if position is None else self.films[position]
+
+    def find(self, url: str) -> Optional[Film]:
+        """The first film with this url in normalized form."""
+        film_id = self._urls.get(normalize_url(url))
+        return None if film_id is None else self.get(film_id)
+
+    def number(self, films: Iterable[Any]) -> List[Film]:
+        """Films to append, with ids never given out before, without
+        appending them."""
+        return list(number_films(films, range(self.last_id + 1), self.last_id))
+
+    def append(self, film: Film) -> None:
+        self._add(film, len(self.films))
+        self.films.append(film)
+
+    def pop(self, film_id: int) -> Optional[Film]:
+        position = self._positions.get(film_id)
+        if position is None:
+            return None
+        film = self.films.pop(position)
+        self.reindex()
+        return film
+
+
+class JSONBackend:
+    """The whole film list as one indented JSON array.
+
+    The parsed list is kept in memory, with a FilmIndex over it, and only
+    parsed again when the file's inode, size or mtime changes, i.e. when
+    another process rewrote it. Callers get their own copy of every film,
+    so they may mutate it freely.
+
+    Changes are optimistic: they are applied to a copy of the list as read,
+    and the copy is renamed over the file, under ``<db>.lock``, only if the
+    file is still the version that was read. Otherwise they are applied
+    again to what the other process wrote.
+
+    The highest id ever given out is kept in ``<db>.ids``, so removing the
+    last film does not free its id.
+    """
+
     def __init__(self, db_path: Path) -> None:
         self._db_path = db_path
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(db_path.with_name(db_path.name + ".lock"))
+        self._cache: Optional[List[Film]] = None
+        self._index: Optional[FilmIndex] = None
+        self._signature: Optional[tuple] = None
+        self._hits = 0
+        self._misses = 0
 
-    def read(self) -> DBResponse:
+    def _stat_signature(self) -> tuple:
+        stat = os.stat(self._db_path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self._hits, self._misses)
+
+    def _load(self) -> int:
+        """Parse the file into the cache unless the cache is current."""
         try:
+            signature = self._stat_signature()
+            if self._cache is not None and signature == self._signature:
+                self._hits += 1
+                return SUCCESS
+            self._misses += 1
             with self._db_path.open("r") as db:
                 try:
-                    return DBResponse(json.load(db), SUCCESS)
-                except json.JSONDecodeError:  # Catch wrong JSON format
-                    return DBResponse([], JSON_ERROR)
+                    todo_list = [Film.from_dict(film) for film in json.load(db)]
+                except (json.JSONDecodeError, TypeError):  # Catch wrong JSON format
+                    self._cache = None
+                    return JSON_ERROR
         except OSError:  # Catch file IO problems
-            return DBResponse([], DB_READ_ERROR)
+            self._cache = None
+            return DB_READ_ERROR
+        self._index = FilmIndex(todo_list, read_last_id(self._db_path))
+        self._cache = todo_list
+        self._signature = signature
+        return SUCCESS
 
-    def write(self, todo_list: List[Dict[str, Any]]) -> DBResponse:
+    def read(self) -> DBResponse:
+        with self._lock:
+            error = self._load()
+            if error:
+                return DBResponse([], error)
+            return DBResponse([film.copy() for film in self._cache], SUCCESS)
+
+    def last_id(self) -> int:
+        """The highest id given out so far, also to removed films."""
+        with self._lock:
+            if self._load():
+                return read_last_id(self._db_path)
+            return self._index.last_id
+
+    def write(self, todo_list: List[Film]) -> DBResponse:
+        """Replace the whole list, whatever other processes wrote."""
         try:
-            json.dumps(todo_list, indent=4)
+            films = [as_film(film) for film in todo_list]
         except TypeError:
             return DBResponse(todo_list, DB_WRITE_ERROR)
+        return DBResponse(todo_list, self._store(films, last_id=self.last_id()))
 
+    def _store(self, films: List[Film], expected: Optional[tuple] = None,
+               last_id: int = 0) -> int:
+        """Write ``films``, which become the cache, so they must not be
+        shared with a caller. Returns _CONFLICT if ``expected`` is given
+        and the file is no longer that version."""
         try:
-            with self._db_path.open("w") as db:
-                json.dump(todo_list, db, indent=4)
-            return DBResponse(todo_list, SUCCESS)
+            index = FilmIndex(films, last_id)  # Numbers films that have no id yet
+            # Encoded once, up front and outside the lock
+            text = json.dumps(films, indent=4, default=json_default)
+        except TypeError:
+            return DB_WRITE_ERROR
+
+        tmp_path = self._db_path.with_name(self._db_path.name + ".tmp")
+        try:
+            with self._lock, self._file_lock:
+                if expected is not None and self._stat_signature() != expected:
+                    return _CONFLICT
+                _store_last_id(self._db_path, index.last_id)
+                with tmp_path.open("w") as db:
+                    db.write(text)
+                    db.flush()
+                    os.fsync(db.fileno())
+                os.replace(tmp_path, self._db_path)  # Atomic, never leaves a half-written DB
+                self._cache = films
+                self._index = index
+                self._signature = self._stat_signature()
+            return SUCCESS
+        except TimeoutError:
+            return DB_BUSY_ERROR
         except OSError:  # Catch file IO problems
-            return DBResponse(todo_list, DB_WRITE_ERROR)
\ No newline at end of file
+            return DB_WRITE_ERROR
+
+    def _modify(self, change: Callable[[List[Film], int], int], start_over: bool = False) -> int:
+        """Apply ``change`` to a fresh copy of the films and store it.
+
+        ``change`` edits the list in place and returns an error code; it
+        also gets the highest id given out so far. When
+        another process wrote the file in between, it is applied again to
+        what that process wrote. ``start_over`` replaces an unreadable file
+        instead of failing.
+        """
+        for _ in range(WRITE_RETRIES):
+            with self._lock:
+                read = self.read()
+                expected = self._signature
+                last_id = self.last_id()
+            if read.error == JSON_ERROR and start_over:
+                expected = None
+            elif read.error:
+                return read.error
+            error = (change(read.todo_list, last_id)
+                     or self._store(read.todo_list, expected, last_id))
+            if error != _CONFLICT:
+                return error
+        return DB_BUSY_ERROR
+
+    def iter_films(self) -> Iterator[Film]:
+        """Yield the films one by one, parsing the file incrementally
+        unless it is already cached."""
+        if self._cache is not None and self._stat_signature() == self._signature:
+            for film in self._cache:
+                yield film.copy()
+            return
+        with self._db_path.open("r") as db:
+            # Numbered like a loaded list, for films stored without ids
+            yield from number_films(iter_json_array(db, ITER_CHUNK_SIZE))
+
+    def get(self, film_id: int) -> DBRecord:
+        with self._lock:
+            error = self._load()
+            if error:
+                return DBRecord({}, error)
+            film = self._index.get(film_id)
+            if film is None:
+                return DBRecord({}, ID_ERROR)
+            return DBRecord(film.copy(), SUCCESS)
+
+    def find(self, url: str) -> DBRecord:
+        with self._lock:
+            error = self._load()
+            if error:
+                return DBRecord({}, error)
+            film = self._index.find(url)
+            if film is None:
+                return DBRecord({}, ID_ERROR)
+            return DBRecord(film.copy(), SUCCESS)
+
+    def update(self, changes: Dict[int, Dict[str, Any]]) -> int:
+        def change(films: List[Film], last_id: int) -> int:
+            index = FilmIndex(films, last_id)
+            for film_id, fields in changes.items():
+                film = index.get(film_id)
+                if film is None:
+                    return ID_ERROR
+                film.update(fields)
+            return SUCCESS
+        return self._modify(change)
+
+    def append(self, films: Iterable[Film]) -> int:
+        films = list(films)
+
+        def change(stored: List[Film], last_id: int) -> int:
+            stored.extend(film.copy() for film in FilmIndex(stored, last_id).number(films))
+            return SUCCESS
+        return self._modify(change, start_over=True)
+
+    def delete(self, film_id: int) -> DBRecord:
+        removed: List[Film] = []
+
+        def change(films: List[Film], last_id: int) -> int:
+            film = FilmIndex(films, last_id).pop(film_id)
+            if film is None:
+                return ID_ERROR
+            removed[:] = [film]
+            return SUCCESS
+        error = self._modify(change)
+        return DBRecord(removed[0] if removed and not error else {}, error)
+
+    def merge(self, updates: Dict[int, Dict[str, Any]], appends: List[Film],
+              removed: Iterable[int]) -> int:
+        removed = set(removed)
+
+        def change(films: List[Film], last_id: int) -> int:
+            if removed:
+                films[:] = [film for film in films if film.id not in removed]
+            index = FilmIndex(films, last_id)
+            for film_id, fields in updates.items():
+                film = index.get(film_id)
+                if film is not None:  # Else another process removed it
+                    film.update(fields)
+            films.extend(film.copy() for film in index.number(appends))
+            return SUCCESS
+        # Updates and removals need the stored films, only pure appends may
+        # replace an unreadable file
+        return self._modify(change, start_over=bool(appends) and not (updates or removed))
+
+
+def _sqlite_write_error(ex: sqlite3.Error) -> int:
+    if isinstance(ex, sqlite3.OperationalError) and "locked" in str(ex):
+        return DB_BUSY_ERROR  # Another process held it past LOCK_TIMEOUT
+    return DB_WRITE_ERROR
+
+
+class SQLiteBackend:
+    """One row per film, keyed by the film id; the normalized url and
+    last_checked are indexed columns.
+
+    Writes take SQLite's write lock up front, so the rows a change reads
+    cannot be changed by another process before it writes them.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS films ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " url TEXT,"
+        " url_key TEXT,"
+        " last_checked TEXT,"
+        " data TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS films_url ON films(url)",
+        "CREATE INDEX IF NOT EXISTS films_url_key ON films(url_key)",
+        "CREATE INDEX IF NOT EXISTS films_last_checked ON films(last_checked)",
+    )
+    INSERT = ("INSERT INTO films (id, url, url_key, last_checked, data)"
+              " VALUES (?, ?, ?, ?, ?)")
+
+    def __init__(self, db_path: Path) -> None:
+        self._db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(str(self._db_path), timeout=LOCK_TIMEOUT,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute(self.SCHEMA[0])
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(films)")}
+                if "url_key" not in columns:
+                    self._add_url_keys(conn)
+                for statement in self.SCHEMA[1:]:
+                    conn.execute(statement)
+            self._conn = conn
+        return self._conn
+
+    @classmethod
+    def _add_url_keys(cls, conn: sqlite3.Connection) -> None:
+        """Upgrade a database from before film ids: add the url_key column
+        and renumber the films 1..N in the order they were listed."""
+        try:
+            films = [Film.from_dict(json.loads(data))
+                     for data, in conn.execute("SELECT data FROM films ORDER BY id")]
+        except (ValueError, TypeError) as ex:
+            raise sqlite3.DatabaseError(f"Unreadable film row, {ex}") from None
+        conn.execute("ALTER TABLE films ADD COLUMN url_key TEXT")
+        conn.execute("DELETE FROM films")
+        conn.executemany(cls.INSERT, [cls._row(film) for film in number_films(films)])
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """The shared connection inside an immediate write transaction."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    @staticmethod
+    def _row(film: Film) -> tuple:
+        data = as_film(film).to_dict()
+        return (data.get("id"), data.get("url"), normalize_url(data.get("url")),
+                data.get("last_checked"), json.dumps(data))
+
+    @staticmethod
+    def _film(film_id: int, data: str) -> Film:
+        film = Film.from_dict(json.loads(data))
+        film.id = film_id
+        return film
+
+    def read(self) -> DBResponse:
+        try:
+            with self._lock:
+                rows = self._connect().execute(
+                    "SELECT id, data FROM films ORDER BY id").fetchall()
+        except sqlite3.Error:
+            return DBResponse([], DB_READ_ERROR)
+        try:
+            return DBResponse([self._film(*row) for row in rows], SUCCESS)
+        except (json.JSONDecodeError, TypeError):
+            return DBResponse([], JSON_ERROR)
+
+    def iter_films(self) -> Iterator[Film]:
+        # A connection of its own, so the shared one is not held while the
+        # caller consumes films; WAL lets it read alongside writers
+        with self._lock:
+            self._connect()  # Upgrades an old schema first
+        conn = sqlite3.connect(str(self._db_path))
+        try:
+            cursor = conn.execute("SELECT id, data FROM films ORDER BY id")
+            while rows := cursor.fetchmany(ITER_BATCH_ROWS):
+                for row in rows:
+                    yield self._film(*row)
+        finally:
+            conn.close()
+
+    def write(self, todo_list: List[Film]) -> DBResponse:
+        try:
+            films = [as_film(film) for film in todo_list]
+            with self._transaction() as conn:
+                # Films without an id get ones the removed films never had
+                rows = [self._row(film)
+                        for film in number_films(films, (), self._last_id(conn))]
+                conn.execute("DELETE FROM films")
+                conn.executemany(self.INSERT, rows)
+        except sqlite3.Error as ex:
+            return DBResponse(todo_list, _sqlite_write_error(ex))
+        except TypeError:
+            return DBResponse(todo_list, DB_WRITE_ERROR)
+        return DBResponse(todo_list, SUCCESS)
+
+    def _select(self, where: str, value: Any) -> DBRecord:
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    f"SELECT id, data FROM films WHERE {where} ORDER BY id LIMIT 1",
+                    (value,)).fetchone()
+        except sqlite3.Error:
+            return DBRecord({}, DB_READ_ERROR)
+        if row is None:
+            return DBRecord({}, ID_ERROR)
+        return DBRecord(self._film(*row), SUCCESS)
+
+    def get(self, film_id: int) -> DBRecord:
+        return self._select("id = ?", film_id)
+
+    def find(self, url: str) -> DBRecord:
+        return self._select("url_key = ?", normalize_url(url))
+
+    def _update_rows(self, conn: sqlite3.Connection, changes: Dict[int, Dict[str, Any]],
+                     missing_ok: bool = False) -> int:
+        for film_id, fields in changes.items():
+            row = conn.execute("SELECT id, data FROM films WHERE id = ?", (film_id,)).fetchone()
+            if row is None:
+                if missing_ok:
+                    continue
+                return ID_ERROR
+            film = self._film(*row)
+            film.update(fields)
+            conn.execute("UPDATE films SET url = ?, url_key = ?, last_checked = ?, data = ?"
+                         " WHERE id = ?", (*self._row(film)[1:], film_id))
+        return SUCCESS
+
+    @staticmethod
+    def _last_id(conn: sqlite3.Connection) -> int:
+        """The highest id AUTOINCREMENT gave out, also to removed films."""
+        last_id, = conn.execute("SELECT COALESCE(MAX(id), 0) FROM films").fetchone()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+            seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'films'").fetchone()
+            last_id = max(last_id, seq[0] if seq else 0)
+        return last_id
+
+    def last_id(self) -> int:
+        try:
+            with self._lock:
+                return self._last_id(self._connect())
+        except sqlite3.Error:
+            return 0
+
+    def _insert_rows(self, conn: sqlite3.Connection, films: List[Film]) -> None:
+        """Insert ``films``, numbering those without an id never given out
+        before in place. SQLite picks the new ids."""
+        last_id = self._last_id(conn)
+        seen = set()
+        for film in films:
+            if not film.id or film.id <= last_id or film.id in seen:
+                film.id = None
+            film.id = conn.execute(self.INSERT, self._row(film)).lastrowid
+            seen.add(film.id)
+
+    def update(self, changes: Dict[int, Dict[str, Any]]) -> int:
+        try:
+            with self._transaction() as conn:
+                # Checked before writing anything, so a bad id changes nothing
+                if any(conn.execute("SELECT 1 FROM films WHERE id = ?", (film_id,)).fetchone()
+                       is None for film_id in changes):
+                    return ID_ERROR
+                self._update_rows(conn, changes)
+        except sqlite3.Error as ex:
+            return _sqlite_write_error(ex)
+        except TypeError:
+            return DB_WRITE_ERROR
+        return SUCCESS
+
+    def append(self, films: Iterable[Film]) -> int:
+        try:
+            films = [film if isinstance(film, Film) else Film.from_dict(film) for film in films]
+            with self._transaction() as conn:
+                self._insert_rows(conn, films)
+        except sqlite3.Error as ex:
+            return _sqlite_write_error(ex)
+        except TypeError:
+            return DB_WRITE_ERROR
+        return SUCCESS
+
+    def delete(self, film_id: int) -> DBRecord:
+        try:
+            with self._transaction() as conn:
+                row = conn.execute(
+                    "SELECT id, data FROM films WHERE id = ?", (film_id,)).fetchone()
+                if row is None:
+                    return DBRecord({}, ID_ERROR)
+                conn.execute("DELETE FROM films WHERE id = ?", (film_id,))
+        except sqlite3.Error as ex:
+            return DBRecord({}, _sqlite_write_error(ex))
+        return DBRecord(self._film(*row), SUCCESS)
+
+    def merge(self, updates: Dict[int, Dict[str, Any]], appends: List[Film],
+              removed: Iterable[int]) -> int:
+        try:
+            with self._transaction() as conn:
+                conn.executemany("DELETE FROM films WHERE id = ?",
+                                 [(film_id,) for film_id in removed])
+                self._update_rows(conn, updates, missing_ok=True)
+                self._insert_rows(conn, appends)
+        except sqlite3.Error as ex:
+            return _sqlite_write_error(ex)
+        except TypeError:
+            return DB_WRITE_ERROR
+        return SUCCESS
+
+
+class JournalBackend:
+    """JSON snapshot plus an append-only JSONL journal of mutations.
+
+    Every mutation appends one small record to ``<db>.journal`` and the state
+    is rebuilt from snapshot + journal on open. The journal starts with a
+    header naming the hash of the snapshot it applies to, so a journal left
+    behind by an interrupted compaction is recognised as already folded in,
+    and a truncated last record from a crash is ignored. Once the journal
+    grows past ``compact_bytes`` it is folded into a new snapshot in a
+    background thread.
+
+    Mutations and compactions hold ``<db>.lock`` and catch up with what
+    other processes logged before logging their own records. As with the
+    JSON backend, the highest id ever given out is kept in ``<db>.ids``.
+    """
+
+    def __init__(self, db_path: Path, compact_bytes: int = JOURNAL_COMPACT_BYTES) -> None:
+        self._db_path = db_path
+        self._journal_path = db_path.with_name(db_path.name + ".journal")
+        self._compact_bytes = compact_bytes
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(db_path.with_name(db_path.name + ".lock"))
+        self._state: Optional[List[Film]] = None
+        self._index: Optional[FilmIndex] = None
+        self._base = ""
+        self._signature: Optional[tuple] = None
+        self._compactor: Optional[threading.Thread] = None
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def _digest(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def _stat_signature(self) -> tuple:
+        signature = []
+        for path in (self._db_path, self._journal_path):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    @staticmethod
+    def _apply(index: FilmIndex, record: Dict[str, Any]) -> None:
+        op = record["op"]
+        if op == "update":
+            if "films" in record:
+                changes = [(index.get(int(film_id)), fields)
+                           for film_id, fields in record["films"].items()]
+            else:  # Written before film ids, by list position
+                changes = [(index.films[int(position)], fields)
+                           for position, fields in record["changes"].items()]
+            for film, fields in changes:
+                if film is not None:  # Else removed by a record before it
+                    film.update(fields)
+            if any("url" in fields for _, fields in changes):
+                index.reindex()
+        elif op == "append":
+            for film in record["films"]:
+                index.append(as_film(film))
+        elif op == "delete":
+            film_id = record["id"] if "id" in record else index.films[record["index"]].id
+            index.pop(film_id)
+
+    def _load(self, repair: bool = False) -> int:
+        """Rebuild the state from disk unless it is already current.
+
+        A torn journal tail is cut off only with ``repair``, i.e. under the
+        file lock, as it may be a record another process is still writing.
+        """
+        signature = self._stat_signature()
+        if self._state is not None and signature == self._signature:
+            self._hits += 1
+            return SUCCESS
+        self._misses += 1
+        try:
+            data = self._db_path.read_bytes()
+        except OSError:
+            self._state = None
+            return DB_READ_ERROR
+        try:
+            state = [Film.from_dict(film) for film in json.loads(data)]
+        except (json.JSONDecodeError, TypeError):
+            self._state = None
+            return JSON_ERROR
+        index = FilmIndex(state, read_last_id(self._db_path))
+        base = self._digest(data)
+        torn_at = None
+        try:
+            with self._journal_path.open("rb") as journal:
+                header = journal.readline()
+                if header and json.loads(header).get("base") == base:
+                    valid = len(header)
+                    for line in journal:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            record = None
+                        if record is None or not line.endswith(b"\n"):
+                            torn_at = valid  # Crash mid-append, drop the tail
+                            break
+                        self._apply(index, record)
+                        valid += len(line)
+                elif header:
+                    torn_at = 0  # Left over from an interrupted compaction
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, LookupError):
+            self._state = None
+            return DB_READ_ERROR
+        if torn_at is not None and not repair:
+            signature = None  # Load again, and repair, before the next write
+        elif torn_at is not None:
+            try:
+                if torn_at:
+                    os.truncate(self._journal_path, torn_at)
+                else:
+                    self._journal_path.write_text(json.dumps({"base": base}) + "\n")
+            except OSError:
+                return DB_WRITE_ERROR
+            signature = self._stat_signature()
+        self._state = state
+        self._index = index
+        self._base = base
+        self._signature = signature
+        return SUCCESS
+
+    def _append_record(self, record: Dict[str, Any]) -> int:
+        try:
+            line = json.dumps(record, default=json_default) + "\n"
+        except TypeError:
+            return DB_WRITE_ERROR
+        try:
+            with self._journal_path.open("a") as journal:
+                if journal.tell() == 0:
+                    journal.write(json.dumps({"base": self._base}) + "\n")
+                journal.write(line)
+                size = journal.tell()
+        except OSError:
+            return DB_WRITE_ERROR
+        self._apply(self._index, record)
+        self._signature = self._stat_signature()
+        if size >= self._compact_bytes:
+            self._start_compaction()
+        return SUCCESS
+
+    def _write_snapshot(self, todo_list: List[Film]) -> int:
+        data = json.dumps(todo_list, indent=4, default=json_default).encode()
+        base = self._digest(data)
+        tmp_path = self._db_path.with_name(self._db_path.name + ".tmp")
+        journal_tmp = self._journal_path.with_name(self._journal_path.name + ".tmp")
+        try:
+            with tmp_path.open("wb") as db:
+                db.write(data)
+                db.flush()
+                os.fsync(db.fileno())
+            journal_tmp.write_text(json.dumps({"base": base}) + "\n")
+            os.replace(tmp_path, self._db_path)
+            # A crash here leaves the old journal, whose header no longer
+            # matches the new snapshot, so it is skipped on the next open.
+            os.replace(journal_tmp, self._journal_path)
+        except OSError:
+            return DB_WRITE_ERROR
+        self._base = base
+        self._signature = self._stat_signature()
+        return SUCCESS
+
+    def _start_compaction(self) -> None:
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, name="filmix-compact")
+        self._compactor.start()
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Exclusive against threads and processes, with the state current."""
+        with self._lock, self._file_lock:
+            yield
+
+    def compact(self) -> int:
+        """Fold the journal into a fresh snapshot."""
+        try:
+            with self._locked():
+                error = self._load(repair=True)
+                if error:
+                    return error
+                return self._write_snapshot(self._state)
+        except TimeoutError:
+            return DB_BUSY_ERROR
+
+    def wait_compaction(self) -> None:
+        if self._compactor is not None:
+            self._compactor.join()
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self._hits, self._misses)
+
+    def read(self) -> DBResponse:
+        with self._lock:
+            error = self._load()
+            if error:
+                return DBResponse([], error)
+            return DBResponse([film.copy() for film in self._state], SUCCESS)
+
+    def last_id(self) -> int:
+        """The highest id given out so far, also to removed films."""
+        with self._lock:
+            if self._load():
+                return read_last_id(self._db_path)
+            return self._index.last_id
+
+    def iter_films(self) -> Iterator[Film]:
+        with self._lock:
+            error = self._load()
+            if error == JSON_ERROR:
+                raise ValueError(f"Unreadable snapshot {self._db_path}")
+            if error:
+                raise OSError(f"Cannot read {self._db_path}")
+            films = list(self._state)
+        for film in films:
+            yield film.copy()
+
+    def write(self, todo_list: List[Film]) -> DBResponse:
+        try:
+            with self._locked():
+                try:
+                    films = [as_film(film) for film in todo_list]
+                    index = FilmIndex(films, self.last_id())
+                    _store_last_id(self._db_path, index.last_id)
+                    error = self._write_snapshot(films)
+                except TypeError:
+                    return DBResponse(todo_list, DB_WRITE_ERROR)
+                except OSError:
+                    return DBResponse(todo_list, DB_WRITE_ERROR)
+                if not error:
+                    self._state = films
+                    self._index = index
+                return DBResponse(todo_list, error)
+        except TimeoutError:
+            return DBResponse(todo_list, DB_BUSY_ERROR)
+
+    def get(self, film_id: int) -> DBRecord:
+        with self._lock:
+            error = self._load()
+            if error:
+                return DBRecord({}, error)
+            film = self._index.get(film_id)
+            if film is None:
+                return DBRecord({}, ID_ERROR)
+            return DBRecord(film.copy(), SUCCESS)
+
+    def find(self, url: str) -> DBRecord:
+        with self._lock:
+            error = self._load()
+            if error:
+                return DBRecord({}, error)
+            film = self._index.find(url)
+            if film is None:
+                return DBRecord({}, ID_ERROR)
+            return DBRecord(film.copy(), SUCCESS)
+
+    def update(self, changes: Dict[int, Dict[str, Any]]) -> int:
+        try:
+            with self._locked():
+                error = self._load(repair=True)
+                if error:
+                    return error
+                if any(self._index.position(film_id) is None for film_id in changes):
+                    return ID_ERROR
+                return self._log_update(changes)
+        except TimeoutError:
+            return DB_BUSY_ERROR
+
+    def _log_update(self, changes: Dict[int, Dict[str, Any]]) -> int:
+        changes = {str(film_id): fields for film_id, fields in changes.items()}
+        return self._append_record({"op": "update", "films": changes})
+
+    def _log_append(self, films: Iterable[Film]) -> int:
+        # Numbered before logging, so a replay gives them the same ids
+        films = self._index.number(films)
+        try:
+            _store_last_id(self._db_path, max((film.id for film in films), default=0))
+        except OSError:
+            return DB_WRITE_ERROR
+        return self._append_record({"op": "append", "films": films})
+
+    def append(self, films: Iterable[Film]) -> int:
+        try:
+            with self._locked():
+                error = self._load(repair=True)
+                if error == DB_READ_ERROR:
+                    return error
+                if error:  # Unreadable snapshot, start over like the JSON backend
+                    return self.write(list(films)).error
+                return self._log_append(films)
+        except TimeoutError:
+            return DB_BUSY_ERROR
+
+    def delete(self, film_id: int) -> DBRecord:
+        try:
+            with self._locked():
+                error = self._load(repair=True)
+                if error:
+                    return DBRecord({}, error)
+                todo = self._index.get(film_id)
+                if todo is None:
+                    return DBRecord({}, ID_ERROR)
+                error = self._append_record({"op": "delete", "id": film_id})
+                return DBRecord(todo, error)
+        except TimeoutError:
+            return DBRecord({}, DB_BUSY_ERROR)
+
+    def merge(self, updates: Dict[int, Dict[str, Any]], appends: List[Film],
+              removed: Iterable[int]) -> int:
+        try:
+            with self._locked():
+                error = self._load(repair=True)
+                if error == DB_READ_ERROR:
+                    return error
+                if error:
+                    # Unreadable snapshot: only a batch of appends alone may start over
+                    if appends and not (updates or removed):
+                        return self.write(list(appends)).error
+                    return error
+                for film_id in removed:
+                    if self._index.position(film_id) is not None:
+                        error = self._append_record({"op": "delete", "id": film_id})
+                        if error:
+                            return error
+                # Films another process removed are skipped
+                updates = {film_id: fields for film_id, fields in updates.items()
+                           if self._index.position(film_id) is not None}
+                if updates:
+                    error = self._log_update(updates)
+                if appends and not error:
+                    error = self._log_append(appends)
+                return error
+        except TimeoutError:
+            return DB_BUSY_ERROR
+
+
+BACKENDS = {
+    JSON_BACKEND: JSONBackend,
+    SQLITE_BACKEND: SQLiteBackend,
+    JOURNAL_BACKEND: JournalBackend,
+}
+
+
+class DatabaseHandler:
+    def __init__(self, db_path: Path, backend: str = JSON_BACKEND) -> None:
+        self._db_path = db_path
+        self._backend = BACKENDS[backend](db_path)
+        self.profiler: Optional[Profiler] = None
+
+    def cache_info(self) -> CacheInfo:
+        """Return read cache hit/miss counters (zero for uncached backends)."""
+        if hasattr(self._backend, "cache_info"):
+            return self._backend.cache_info()
+        return CacheInfo(0, 0)
+
+    def read(self) -> DBResponse:
+        with stage(self.profiler, "db_read"):
+            return self._backend.read()
+
+    def last_id(self) -> int:
+        """The highest id given out so far; removed films' ids are not
+        given out again."""
+        return self._backend.last_id()
+
+    def iter_films(self) -> Iterator[Film]:
+        """Yield the films in order without loading the whole database
+        where the backend allows it. Raises OSError, ValueError or
+        sqlite3.Error when the database cannot be read."""
+        return self._backend.iter_films()
+
+    def write(self, todo_list: List[Film]) -> DBResponse:
+        with stage(self.profiler, "db_write"):
+            return self._backend.write(todo_list)
+
+    def get(self, film_id: int) -> DBRecord:
+        """Return the film with this id."""
+        with stage(self.profiler, "db_read"):
+            return self._backend.get(film_id)
+
+    def find(self, url: str) -> DBRecord:
+        """Return the film with this url, compared in normalized form."""
+        with stage(self.profiler, "db_read"):
+            return self._backend.find(url)
+
+    def update(self, changes: Dict[int, Dict[str, Any]]) -> int:
+        """Apply ``{film_id: {field: value}}`` changes to existing films."""
+        with stage(self.profiler, "db_write"):
+            return self._backend.update(changes)
+
+    def append(self, films: Iterable[Film]) -> int:
+        """Add films, giving those without a free id the next ones."""
+        with stage(self.profiler, "db_write"):
+            return self._backend.append(films)
+
+    def delete(self, film_id: int) -> DBRecord:
+        """Remove and return the film with this id."""
+        with stage(self.profiler, "db_write"):
+            return self._backend.delete(film_id)
+
+    def merge(self, updates: Dict[int, Dict[str, Any]], appends: List[Film],
+              removed: Iterable[int] = ()) -> int:
+        """Apply a batch of changes on top of what is stored now, which
+        other processes may have changed since it was read.
+
+        Films in ``removed`` go first, then ``updates`` are applied; both
+        skip films that are gone. ``appends`` whose id was given out
+        meanwhile are renumbered in place.
+        """
+        with stage(self.profiler, "db_write"):
+            return self._backend.merge(updates, appends, removed)
+
+    def unit_of_work(self, flush_every: int = 0, flush_interval: float = 0.0,
+                     write_behind: bool = False) -> "UnitOfWork":
+        """Load the database once and collect changes until commit."""
+        return UnitOfWork(self, flush_every, flush_interval, write_behind)
+
+
+class UnitOfWork:
+    """In-memory copy of the database that is written back in one go.
+
+    Look films up with ``get`` or ``find``, mutate them and record the
+    mutation with ``update``; add and remove films with ``append``,
+    ``remove`` and ``clear``. The changes are written on ``commit``, on
+    leaving the ``with`` block, or earlier once ``flush_every`` changes or
+    ``flush_interval`` seconds have piled up (0 disables either).
+
+    Only the changes are written, merged into what is stored by then, so
+    other processes' changes made in the meantime are kept. An appended
+    film whose id another process took gets the next free one.
+
+    With ``write_behind`` a commit only hands the changes to a WriteBehind
+    thread; leaving the ``with`` block waits until they are written.
+    ``write_error`` then tells whether the last changes were lost.
+    """
+
+    def __init__(self, handler: DatabaseHandler, flush_every: int = 0,
+                 flush_interval: float = 0.0, write_behind: bool = False) -> None:
+        self._handler = handler
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        read = handler.read()
+        self.todo_list = read.todo_list
+        self.index = FilmIndex(self.todo_list, handler.last_id())
+        self.error = read.error
+        self.pending = 0
+        self.commits = 0
+        self.writer: Optional[WriteBehind] = WriteBehind(handler) if write_behind else None
+        self.write_error = SUCCESS  # of the final commit, set on leaving the block
+        self._reset()
+
+    def _reset(self) -> None:
+        self._updates: Dict[int, Dict[str, Any]] = {}
+        self._removed: List[int] = []
+        self._stored_len = len(self.todo_list)
+        self._last_commit = time.monotonic()
+
+    def _touch(self) -> int:
+        self.pending += 1
+        if self._flush_every and self.pending >= self._flush_every:
+            return self.commit()
+        if self._flush_interval and time.monotonic() - self._last_commit >= self._flush_interval:
+            return self.commit()
+        return SUCCESS
+
+    def get(self, film_id: int) -> Optional[Film]:
+        return self.index.get(film_id)
+
+    def find(self, url: str) -> Optional[Film]:
+        return self.index.find(url)
+
+    def update(self, film_id: int, fields: Dict[str, Any]) -> int:
+        """Record that the film ``film_id`` got ``fields``."""
+        position = self.index.position(film_id)
+        if position is not None and position < self._stored_len:
+            self._updates.setdefault(film_id, {}).update(fields)
+        if "url" in fields:
+            self.index.reindex()
+        return self._touch()
+
+    def append(self, film: Film) -> int:
+        """Append ``film`` to ``todo_list``, giving it a free id if need be."""
+        self.index.append(film)
+        return self._touch()
+
+    def remove(self, film_id: int) -> DBRecord:
+        position = self.index.position(film_id)
+        film = self.index.pop(film_id)
+        if film is None:
+            return DBRecord({}, ID_ERROR)
+        if position < self._stored_len:  # Else appended since the last commit
+            self._stored_len -= 1
+            self._updates.pop(film_id, None)
+            self._removed.append(film_id)
+        return DBRecord(film, self._touch())
+
+    def clear(self) -> int:
+        self._removed += [film.id for film in self.todo_list[:self._stored_len]]
+        self._updates = {}
+        self._stored_len = 0
+        self.todo_list.clear()
+        self.index.reindex()
+        return self._touch()
+
+    def commit(self) -> int:
+        if not self.pending:
+            return SUCCESS
+        appends = self.todo_list[self._stored_len:]
+        if self.writer is not None:
+            # The writer gets copies, the films here keep changing meanwhile
+            self.writer.submit(self._updates, [film.copy() for film in appends], self._removed)
+            error = SUCCESS  # Write errors come out of writer.close()
+        else:
+            ids = [film.id for film in appends]
+            error = self._handler.merge(self._updates, appends, self._removed)
+            if not error and ids != [film.id for film in appends]:
+                self.index.reindex()  # Another process took some of the ids
+        if error:
+            return error
+        self.pending = 0
+        self.commits += 1
+        self._reset()
+        return SUCCESS
+
+    def __enter__(self) -> "UnitOfWork":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            self.write_error = self.commit()
+        finally:
+            if self.writer is not None:
+                self.write_error = self.writer.close() or self.write_error
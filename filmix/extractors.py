@@ -0,0 +1,325 @@
+import re
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+FAST_BACKEND = "fast"
+SOUP_BACKEND = "soup"
+
+# Elements that never get an end tag, as in bs4's HTML tree builder
+VOID_ELEMENTS = frozenset((
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link",
+    "menuitem", "meta", "param", "source", "track", "wbr", "basefont", "bgsound",
+    "command", "frame", "image", "isindex", "nextid", "spacer",
+))
+# Text inside these is a special string type that bs4 leaves out of .text
+# of any other element
+STRING_CONTAINERS = frozenset(("script", "style", "template", "rt", "rp"))
+PRESERVE_WHITESPACE = frozenset(("pre", "textarea"))
+ASCII_SPACES = frozenset("\x20\x0a\x09\x0c\x0d")
+
+Fields = Dict[str, Sequence[str]]
+
+
+class Match(NamedTuple):
+    text: str
+    attrs: Dict[str, str]
+
+
+class UnsupportedSelector(ValueError):
+    pass
+
+
+class Compound(NamedTuple):
+    tag: str
+    ids: Tuple[str, ...]
+    classes: Tuple[str, ...]
+    attrs: Tuple[Tuple[str, Optional[str]], ...]
+
+    def matches(self, element: "_Element") -> bool:
+        if self.tag != "*" and self.tag != element.tag:
+            return False
+        if any(element.attrs.get("id") != id_ for id_ in self.ids):
+            return False
+        if any(cls not in element.classes for cls in self.classes):
+            return False
+        for name, value in self.attrs:
+            if name not in element.attrs:
+                return False
+            if value is not None and element.attrs[name] != value:
+                return False
+        return True
+
+
+class Selector(NamedTuple):
+    """A compiled selector: compounds joined by ' ' or '>' combinators."""
+    compounds: Tuple[Compound, ...]
+    combinators: Tuple[str, ...]
+
+    def matches(self, stack: List["_Element"]) -> bool:
+        return self._match(len(self.compounds) - 1, stack, len(stack) - 1)
+
+    def _match(self, part: int, stack: List["_Element"], depth: int) -> bool:
+        if not self.compounds[part].matches(stack[depth]):
+            return False
+        if part == 0:
+            return True
+        if self.combinators[part - 1] == ">":
+            return depth > 0 and self._match(part - 1, stack, depth - 1)
+        return any(self._match(part - 1, stack, ancestor)
+                   for ancestor in range(depth - 1, -1, -1))
+
+
+_TOKEN = re.compile(r"""
+    (?P<child>\s*>\s*)
+    |(?P<space>\s+)
+    |(?P<tag>[a-zA-Z][-\w]*|\*)
+    |(?P<id>\#[-\w]+)
+    |(?P<cls>\.[-\w]+)
+    |\[\s*(?P<attr>[-\w]+)\s*(?:=\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<bare>[-\w]+))\s*)?\]
+""", re.VERBOSE)
+
+
+@lru_cache(maxsize=1024)
+def compile_selector(selector: str) -> Selector:
+    """Compile the subset of CSS the fast backend understands.
+
+    Supported: tag, ``*``, ``.class``, ``#id``, ``[attr]``, ``[attr=value]``
+    and the descendant/child combinators. Anything else raises
+    UnsupportedSelector so the caller can fall back to BeautifulSoup.
+    Results are cached, so each selector is compiled once per process.
+    """
+    compounds: List[Compound] = []
+    combinators: List[str] = []
+    current: Optional[dict] = None
+    pending = None
+    pos = 0
+    text = selector.strip()
+    if not text:
+        raise UnsupportedSelector(selector)
+    while pos < len(text):
+        token = _TOKEN.match(text, pos)
+        if not token:
+            raise UnsupportedSelector(selector)
+        pos = token.end()
+        if token.lastgroup in ("child", "space"):
+            if current is None:
+                raise UnsupportedSelector(selector)
+            compounds.append(Compound(**current))
+            current = None
+            pending = ">" if token.lastgroup == "child" else " "
+            continue
+        if current is None:
+            current = {"tag": "*", "ids": (), "classes": (), "attrs": ()}
+            if pending is not None:
+                combinators.append(pending)
+                pending = None
+        if token.group("tag"):
+            if current["ids"] or current["classes"] or current["attrs"] or current["tag"] != "*":
+                raise UnsupportedSelector(selector)
+            current["tag"] = token.group("tag").lower()
+        elif token.group("id"):
+            current["ids"] += (token.group("id")[1:],)
+        elif token.group("cls"):
+            current["classes"] += (token.group("cls")[1:],)
+        else:
+            value = next((v for v in token.group("dq", "sq", "bare") if v is not None), None)
+            current["attrs"] += ((token.group("attr").lower(), value),)
+    if current is None:
+        raise UnsupportedSelector(selector)
+    compounds.append(Compound(**current))
+    return Selector(tuple(compounds), tuple(combinators))
+
+
+class _Element(NamedTuple):
+    tag: str
+    attrs: Dict[str, str]
+    classes: frozenset
+
+
+class _Capture:
+    __slots__ = ("depth", "container", "parts", "attrs")
+
+    def __init__(self, depth: int, container: Optional[str], attrs: Dict[str, str]) -> None:
+        self.depth = depth
+        self.container = container
+        self.parts: List[str] = []
+        self.attrs = attrs
+
+
+class _Done(Exception):
+    pass
+
+
+class FastExtractor(HTMLParser):
+    """Evaluate a handful of selectors while tokenizing, without a tree.
+
+    Only the text of matched elements is collected, and parsing stops as
+    soon as the first alternative of every field has been seen in full.
+    Chunks can be fed incrementally; check ``done`` between them.
+    """
+
+    def __init__(self, fields: Fields) -> None:
+        super().__init__(convert_charrefs=True)
+        self._fields = {field: [compile_selector(sel) for sel in selectors]
+                        for field, selectors in fields.items()}
+        self._found: Dict[Tuple[str, int], Match] = {}
+        self._captures: Dict[Tuple[str, int], _Capture] = {}
+        self._stack: List[_Element] = []
+        self._containers: List[str] = []
+        self._preserve = 0
+        self._text: List[str] = []
+        self.done = not self._fields
+
+    def feed(self, data: str) -> None:
+        if self.done:
+            return
+        try:
+            super().feed(data)
+        except _Done:
+            self.done = True
+
+    def close(self) -> None:
+        if not self.done:
+            try:
+                super().close()
+                self._flush()
+            except _Done:
+                pass
+        for key, capture in self._captures.items():
+            self._found[key] = Match("".join(capture.parts), capture.attrs)
+        self._captures.clear()
+        self.done = True
+
+    def results(self) -> Dict[str, Optional[Match]]:
+        results = {}
+        for field, selectors in self._fields.items():
+            results[field] = next((self._found[(field, alt)] for alt in range(len(selectors))
+                                   if (field, alt) in self._found), None)
+        return results
+
+    def _container(self) -> Optional[str]:
+        return self._containers[-1] if self._containers else None
+
+    def _flush(self) -> None:
+        """Hand the text since the last markup to the open captures.
+
+        Mirrors bs4's endData: a run of text is one string, and a run of
+        nothing but ASCII whitespace collapses to a single newline or space
+        outside <pre>/<textarea>.
+        """
+        if not self._text:
+            return
+        data = "".join(self._text)
+        self._text.clear()
+        if not self._preserve and all(char in ASCII_SPACES for char in data):
+            data = "\n" if "\n" in data else " "
+        container = self._container()
+        for capture in self._captures.values():
+            if capture.container == container:
+                capture.parts.append(data)
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        self._flush()
+        attr_dict = {name: value or "" for name, value in attrs}
+        element = _Element(tag, attr_dict, frozenset(attr_dict.get("class", "").split()))
+        self._stack.append(element)
+        if tag in STRING_CONTAINERS:
+            self._containers.append(tag)
+        if tag in PRESERVE_WHITESPACE:
+            self._preserve += 1
+        for field, selectors in self._fields.items():
+            for alt, selector in enumerate(selectors):
+                key = (field, alt)
+                if key in self._found or key in self._captures:
+                    continue
+                if selector.matches(self._stack):
+                    container = tag if tag in STRING_CONTAINERS else None
+                    self._captures[key] = _Capture(len(self._stack), container, attr_dict)
+        if tag in VOID_ELEMENTS:
+            self._pop(len(self._stack) - 1)
+
+    def handle_startendtag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag: str) -> None:
+        self._flush()
+        # Like bs4: close the most recent open element of that name, ignore
+        # stray end tags
+        for depth in range(len(self._stack) - 1, -1, -1):
+            if self._stack[depth].tag == tag:
+                self._pop(depth)
+                return
+
+    def _pop(self, depth: int) -> None:
+        while len(self._stack) > depth:
+            element = self._stack.pop()
+            if element.tag in STRING_CONTAINERS:
+                self._containers.pop()
+            if element.tag in PRESERVE_WHITESPACE:
+                self._preserve -= 1
+            for key in [key for key, capture in self._captures.items()
+                        if capture.depth > len(self._stack)]:
+                capture = self._captures.pop(key)
+                self._found[key] = Match("".join(capture.parts), capture.attrs)
+        if all((field, 0) in self._found for field in self._fields):
+            raise _Done()
+
+    def handle_data(self, data: str) -> None:
+        if self._captures:
+            self._text.append(data)
+
+    def handle_comment(self, data: str) -> None:
+        self._flush()
+
+    handle_decl = handle_pi = unknown_decl = handle_comment
+
+
+def _soup_match(tag) -> Match:
+    attrs = {name: " ".join(value) if isinstance(value, list) else value
+             for name, value in tag.attrs.items()}
+    return Match(tag.text, attrs)
+
+
+@lru_cache(maxsize=1024)
+def compile_soup_selector(selector: str):
+    import soupsieve
+    return soupsieve.compile(selector)
+
+
+def soup_extract(html: str, fields: Fields) -> Dict[str, Optional[Match]]:
+    """Reference backend: full BeautifulSoup tree plus select_one."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    results = {}
+    for field, selectors in fields.items():
+        tag = None
+        for selector in selectors:
+            tag = compile_soup_selector(selector).select_one(soup)
+            if tag:
+                break
+        results[field] = _soup_match(tag) if tag else None
+    return results
+
+
+def fast_extract(html: str, fields: Fields) -> Dict[str, Optional[Match]]:
+    try:
+        extractor = FastExtractor(fields)
+    except UnsupportedSelector:
+        return soup_extract(html, fields)
+    extractor.feed(html)
+    extractor.close()
+    return extractor.results()
+
+
+EXTRACTORS = {
+    FAST_BACKEND: fast_extract,
+    SOUP_BACKEND: soup_extract,
+}
+
+
+def extract(html: str, fields: Fields, backend: str = FAST_BACKEND) -> Dict[str, Optional[Match]]:
+    """Return the first element matching each field's selectors, in order."""
+    return EXTRACTORS[backend](html, fields)
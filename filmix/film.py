@@ -0,0 +1,182 @@
+"""Compact typed film record.
+
+A Film keeps its fields in ``__slots__`` with parsed values: the IMDB
+score is a float and its vote count an int, the filmix rating is an int,
+``last_checked`` is a ``datetime.date`` and the id and schedule fields
+are ints. Selectors and quality labels are interned and equal dates are
+shared, so 100k films take a fraction of the memory of the equivalent
+dicts.
+
+Films still behave as mutable mappings keyed by the stored field names,
+so ``film.get('quality')``, ``film['imdb'] = '|7.5|53966'`` and
+``todoer.change(film_id, **film)`` keep working. Assigned strings are
+parsed the same way the loader parses the legacy all-string format.
+"""
+import datetime
+import sys
+from collections.abc import MutableMapping
+from functools import lru_cache
+from typing import Any, Dict, Iterator, Optional
+
+TEXT_FIELDS = ('url', 'name', 'etag', 'last_modified', 'content_hash')
+# Few distinct values shared by many films
+INTERNED_FIELDS = ('n_selector', 'q_selector', 'quality')
+INT_FIELDS = ('id', 'imdb_votes', 'filmix_users_rating', 'next_due', 'check_interval')
+# Serialization order
+FIELDS = ('id', 'url', 'name', 'n_selector', 'q_selector', 'quality', 'imdb', 'imdb_votes',
+          'filmix_users_rating', 'last_checked', 'next_due', 'check_interval',
+          'etag', 'last_modified', 'content_hash')
+
+
+@lru_cache(maxsize=1024)
+def _parse_date(value: str) -> Optional[datetime.date]:
+    try:
+        return datetime.date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+
+def _parse_int(value: Any) -> Optional[int]:
+    if isinstance(value, str):
+        value = value.replace(' ', '').replace(',', '')
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class Film(MutableMapping):
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, **fields: Any) -> None:
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Film':
+        """Load a film from either the typed or the legacy all-string format."""
+        if isinstance(data, Film):
+            return data.copy()
+        if not isinstance(data, dict):
+            raise TypeError(f'Cannot load a film from {type(data).__name__}')
+        return cls(**data)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The JSON-ready form: dates as ISO strings, unset fields left out."""
+        data = {}
+        for name in FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value.isoformat() if name == 'last_checked' else value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def copy(self) -> 'Film':
+        film = Film.__new__(Film)
+        for name in FIELDS:
+            setattr(film, name, getattr(self, name))
+        film.extra = dict(self.extra) if self.extra else None
+        return film
+
+    def _set_imdb(self, value: Any) -> None:
+        if isinstance(value, str):
+            # Legacy format: '|7.5|53966' as scraped, score then vote count
+            parts = [part for part in value.split('|') if part.strip()]
+            try:
+                self.imdb = float(parts[0])
+            except (IndexError, ValueError):
+                self.imdb = None
+            if len(parts) > 1:
+                self.imdb_votes = _parse_int(parts[1])
+        else:
+            self.imdb = float(value) if value is not None else None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key == 'imdb':
+            self._set_imdb(value)
+        elif key == 'last_checked':
+            if isinstance(value, str):
+                value = _parse_date(value)
+            elif isinstance(value, datetime.datetime):
+                value = value.date()
+            self.last_checked = value
+        elif key in INT_FIELDS:
+            setattr(self, key, _parse_int(value))
+        elif key in INTERNED_FIELDS:
+            setattr(self, key, sys.intern(str(value)) if value is not None else None)
+        elif key in TEXT_FIELDS:
+            setattr(self, key, value)
+        elif value is None:
+            if self.extra:
+                self.extra.pop(key, None)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __getitem__(self, key: str) -> Any:
+        if key in FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def __delitem__(self, key: str) -> None:
+        if key in FIELDS and getattr(self, key) is not None:
+            setattr(self, key, None)
+        elif self.extra and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        return self.get(key) is not None if isinstance(key, str) else False
+
+    def __iter__(self) -> Iterator[str]:
+        for name in FIELDS:
+            if getattr(self, name) is not None:
+                yield name
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, dict):
+            other = Film.from_dict(other)
+        if not isinstance(other, Film):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f'Film({self.to_dict()!r})'
+
+
+def as_film(film: Any) -> Film:
+    """A Film copy of a Film or a film dict."""
+    return film.copy() if isinstance(film, Film) else Film.from_dict(film)
+
+
+def json_default(value: Any) -> Any:
+    """``json.dump(default=...)`` hook that serializes films and dates."""
+    if isinstance(value, Film):
+        return value.to_dict()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
@@ -1,16 +1,35 @@
+import codecs
 import datetime
+import hashlib
+import os
+import sqlite3
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from functools import lru_cache
 from pathlib import Path
 from random import randint
-from typing import Any, Dict, List, NamedTuple
+from typing import (TYPE_CHECKING, Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List,
+                    MutableMapping, NamedTuple, Optional, TextIO, Tuple, Union)
 import urllib
 import urllib.parse
-from filmix.database import DatabaseHandler
-from filmix import DB_READ_ERROR, ID_ERROR, SUCCESS
-from bs4 import BeautifulSoup
-import aiohttp
-import asyncio
-import fake_useragent
+from filmix.database import CacheInfo, DatabaseHandler, DBResponse, UnitOfWork, JSON_BACKEND
+from filmix import DB_READ_ERROR, DUPLICATE_ERROR, ERRORS, ID_ERROR, JSON_ERROR, SUCCESS, WORKERS_ERROR, bulk, extractors, jobqueue, ratelimit, scheduler, sites
+from filmix.history import History
+from filmix.film import Film
+from filmix.profiling import Profiler, stage
+from filmix.writer import WriteBehind
 
+# aiohttp, asyncio and fake_useragent are imported on the fetch path only,
+# so commands that never touch the network start fast
+if TYPE_CHECKING:
+    import aiohttp
+    from concurrent.futures import ProcessPoolExecutor
+
+
+STREAM_CHUNK_SIZE = 16 * 1024
+STREAM_MAX_BYTES = 2 * 1024 * 1024
+SUMMARY_MAX_URLS = 10
 
 SESSION_STATIC_HEADERS = {
     'sec-ch-ua': '"Chromium";v="110", "Not A(Brand";v="24"',
@@ -18,32 +37,216 @@ SESSION_STATIC_HEADERS = {
 }
 
 
+class PoolSettings(NamedTuple):
+    limit: int = 100
+    limit_per_host: int = 10
+    keepalive_timeout: float = 30.0
+    dns_cache_ttl: int = 300
+
+
+class PageResponse(NamedTuple):
+    status: int
+    text: str = ''
+    etag: str = ''
+    last_modified: str = ''
+    digest: str = ''
+    found: Optional[Dict[str, Optional[extractors.Match]]] = None
+
+
+# A film id, or a film url
+FilmRef = Union[int, str]
+
+
 class CurrentTodo(NamedTuple):
-    todo: Dict[str, Any]
+    todo: MutableMapping[str, Any]
+    error: int = SUCCESS
+
+
+class ImportResult(NamedTuple):
+    added: int = 0
+    duplicates: int = 0
+    invalid: int = 0
     error: int = SUCCESS
 
 
+class ExportResult(NamedTuple):
+    exported: int = 0
+    error: int = SUCCESS
+
+
+class DispatchResult(NamedTuple):
+    queued: int = 0
+    applied: int = 0
+    given_up: List[str] = []  # urls no worker got a result for
+    error: int = SUCCESS
+
+
+@lru_cache(maxsize=None)
+def user_agents():
+    """Shared fake_useragent database, loaded on first use."""
+    import fake_useragent
+    return fake_useragent.UserAgent()
+
+
 class Todoer:
-    def __init__(self, db_path: Path) -> None:
-        self._db_handler = DatabaseHandler(db_path)
+    def __init__(self, db_path: Path, pool: PoolSettings = PoolSettings(),
+                 flush_every: int = 200, flush_interval: float = 10.0,
+                 backend: str = JSON_BACKEND,
+                 extractor: str = extractors.FAST_BACKEND,
+                 stream: bool = False, max_bytes: int = STREAM_MAX_BYTES,
+                 profiler: Optional[Profiler] = None,
+                 parse_pool: bool = False, parse_workers: Optional[int] = None,
+                 budget: int = 0, concurrency: int = 32,
+                 limits: ratelimit.RateLimits = ratelimit.RateLimits(),
+                 history: bool = True, write_behind: bool = True) -> None:
+        self._db_path = db_path
+        self._db_handler = DatabaseHandler(db_path, backend)
+        self._db_handler.profiler = profiler
+        self.profiler = profiler
+        self._extractor = extractor
+        self._stream = stream
+        self._max_bytes = max_bytes
+        self._parse_pool = parse_pool
+        self._parse_workers = parse_workers or os.cpu_count()
+        self._executor: Optional['ProcessPoolExecutor'] = None
+        self._pool = pool
+        self._budget = budget
+        self._concurrency = max(1, concurrency)
+        self._session = None
+        self._uow = None
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._write_behind = write_behind
+        self.writer: Optional[WriteBehind] = None  # the last fetch run's
+        self.write_error = SUCCESS  # the last batch's final write
+        self._limits = limits
+        self._limiter = ratelimit.HostLimiter(limits.rate, limits.burst)
+        self.history = History(db_path) if history else None
+        self._run: Optional[int] = None  # history run number while fetching
+        self.stats = Counter()
+        self.throttled = Counter()  # 429s per host in the last run
+        self.skipped: List[str] = []  # urls given up on after all retries
+
+    @contextmanager
+    def batch(self, flush_every: int = 0, flush_interval: float = 0.0,
+              write_behind: bool = False) -> Iterator[UnitOfWork]:
+        """Group add/change/remove calls into a single database write.
+
+        With ``write_behind`` the writes happen on a thread of their own.
+        """
+        if self._uow is not None:
+            yield self._uow
+            return
+        uow = self._db_handler.unit_of_work(flush_every, flush_interval, write_behind)
+        try:
+            with uow, self._using(uow):
+                yield uow
+        finally:
+            self.write_error = uow.write_error
+
+    @contextmanager
+    def _using(self, uow: UnitOfWork) -> Iterator[UnitOfWork]:
+        """Send add/change/remove calls to ``uow`` for the duration of the block."""
+        self._uow = uow
+        if uow.writer is not None:
+            self.writer = uow.writer
+        try:
+            yield uow
+        finally:
+            self._uow = None
+
+    def _read(self) -> DBResponse:
+        if self._uow is not None:
+            return DBResponse(self._uow.todo_list, self._uow.error)
+        return self._db_handler.read()
+
+    def find(self, ref: FilmRef) -> CurrentTodo:
+        """Look a film up by its id or its url."""
+        if isinstance(ref, str) and not ref.strip().isdigit():
+            if self._uow is None:
+                return CurrentTodo(*self._db_handler.find(ref))
+            film = self._uow.find(ref) if not self._uow.error else None
+        else:
+            if self._uow is None:
+                return CurrentTodo(*self._db_handler.get(int(ref)))
+            film = self._uow.get(int(ref)) if not self._uow.error else None
+        if film is None:
+            return CurrentTodo({}, self._uow.error or ID_ERROR)
+        return CurrentTodo(film, SUCCESS)
+
+    def _film_id(self, ref: FilmRef) -> int:
+        """The id of a film given by id or url, 0 for an unknown url."""
+        if isinstance(ref, int) or ref.strip().isdigit():
+            return int(ref)
+        return self.find(ref).todo.get('id', 0)
 
     def add(self, **kwargs) -> CurrentTodo:
-        """Add a new to-do to the database."""
-        film = {}
-        for key, val in kwargs.items():
-            film[key] = val
-        read = self._db_handler.read()
+        """Add a new to-do to the database.
+
+        A film whose url is already in the list is not added; the stored
+        one is returned with DUPLICATE_ERROR.
+        """
+        film = Film.from_dict(kwargs)
+        existing = self.find(film.url or '')
+        if existing.error == SUCCESS:
+            return CurrentTodo(existing.todo, DUPLICATE_ERROR)
+        if self._uow is None:
+            return CurrentTodo(film, self._db_handler.append([film]))
+        if self._uow.error == DB_READ_ERROR:
+            return CurrentTodo(film, self._uow.error)
+        return CurrentTodo(film, self._uow.append(film))
+
+    def import_films(self, films: Iterable[Dict[str, Any]]) -> ImportResult:
+        """Add many films in one database write, skipping known urls.
+
+        Urls are compared in normalized form against a set of the stored
+        ones and of those imported so far. Nothing is written if reading
+        ``films`` raises.
+        """
+        read = self._read()
         if read.error == DB_READ_ERROR:
-            return CurrentTodo(film, read.error)
-        read.todo_list.append(film)
-        write = self._db_handler.write(read.todo_list)
-        return CurrentTodo(film, write.error)
+            return ImportResult(error=read.error)
+        seen = {sites.normalize_url(film.get('url')) for film in read.todo_list}
+        new_films = []
+        duplicates = invalid = 0
+        for film in films:
+            url = film.get('url')
+            if not isinstance(url, str) or not urllib.parse.urlsplit(url).netloc:
+                invalid += 1
+                continue
+            key = sites.normalize_url(url)
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            new_films.append(film)
+        error = SUCCESS
+        if self._uow is None:
+            if new_films:
+                error = self._db_handler.append(new_films)
+        else:
+            for film in new_films:
+                error = self.add(**film).error or error
+        return ImportResult(len(new_films), duplicates, invalid, error)
+
+    def export_films(self, stream: TextIO, format: str = bulk.JSONL_FORMAT) -> ExportResult:
+        """Stream the stored films out one at a time."""
+        try:
+            return ExportResult(bulk.write_films(self._db_handler.iter_films(), stream, format))
+        except ValueError:
+            return ExportResult(error=JSON_ERROR)
+        except (OSError, sqlite3.Error):
+            return ExportResult(error=DB_READ_ERROR)
 
     def get_film_list(self) -> List[Dict[str, Any]]:
         """Return the current to-do list."""
-        read = self._db_handler.read()
+        read = self._read()
         return read.todo_list
 
+    def cache_info(self) -> CacheInfo:
+        """Return the database read cache hit/miss counters."""
+        return self._db_handler.cache_info()
+
     def set_random_headers(self):
         current_ip = f'{randint(1,253)}.{randint(1,253)}.{randint(1,253)}.{randint(1,253)}'
         return {
@@ -54,128 +257,478 @@ class Todoer:
             'X-Client-IP': current_ip,
             'X-Host': current_ip,
             'X-Forwarded-Host': current_ip,
-            'User-Agent': fake_useragent.UserAgent().random,
+            'User-Agent': user_agents().random,
         }
 
     def start_fetch(self):
-        asyncio.run(self.fetch_all_statuses())
-
-    async def fetch_all_statuses(self):
-        tasks = []
-        film_list = self.get_film_list()
-        for idx, film in enumerate(film_list, start=1):
-            last_checked = film.get('last_checked')
-            if not last_checked or last_checked < datetime.datetime.now().strftime('%Y-%m-%d'):
-                film['last_checked'] = datetime.datetime.now().strftime('%Y-%m-%d')
-                tasks.append(self.get_status(film, idx))
-        if len(tasks) > 0:
-            print(f'Fetching statuses for {len(tasks)} films...')
+        import asyncio
+        try:
+            asyncio.run(self.fetch_all_statuses())
+        except KeyboardInterrupt:
+            # The batch was written on the way out, say what made it
+            print('Interrupted.')
+            print(self.summary())
+
+    def create_session(self) -> 'aiohttp.ClientSession':
+        """Return a session with a pooled keep-alive connector."""
+        import aiohttp
+        connector = aiohttp.TCPConnector(
+            limit=self._pool.limit,
+            limit_per_host=self._pool.limit_per_host,
+            keepalive_timeout=self._pool.keepalive_timeout,
+            ttl_dns_cache=self._pool.dns_cache_ttl,
+        )
+        trace_configs = [self.profiler.trace_config()] if self.profiler else None
+        return aiohttp.ClientSession(connector=connector, headers=SESSION_STATIC_HEADERS,
+                                     trace_configs=trace_configs)
+
+    @asynccontextmanager
+    async def open_session(self) -> 'AsyncIterator[aiohttp.ClientSession]':
+        """Use the open session, or open one for the duration of the block."""
+        if self._session is not None:
+            yield self._session
+            return
+        async with self.create_session() as session:
+            self._session = session
+            try:
+                yield session
+            finally:
+                self._session = None
+
+    async def fetch_all_statuses(self) -> int:
+        """Fetch the due films, return how many were fetched."""
+        due = scheduler.due_films(self.get_film_list())
+        films = due[:self._budget or None]
+        if len(films) < len(due):
+            print(f'Fetching statuses for {len(films)} of {len(due)} due films...')
+        elif len(films) > 0:
+            print(f'Fetching statuses for {len(films)} films...')
         else:
             print('All films are up to date, no need to fetch statuses.')
-        await asyncio.gather(*tasks)
+            return 0
+        self._clear_stats()
+        if self.history is not None:
+            self._run = self.history.start_run()
+        try:
+            with self.batch(self._flush_every, self._flush_interval, self._write_behind):
+                await self.fetch_films(films)
+        finally:
+            if self.history is not None:
+                self.history.flush()
+            self._run = None
+        print(self.summary())
+        return len(films)
 
-    async def fetch_one_status(self, film, debug=False):
-        url = film.get('url')
-        origin = urllib.parse.urlparse(url).netloc
+    def job_queue(self) -> jobqueue.JobQueue:
+        """Open the job queue that goes with the database."""
+        return jobqueue.JobQueue(jobqueue.queue_path(self._db_path))
+
+    def _clear_stats(self) -> None:
+        self.stats.clear()
+        self.throttled.clear()
+        self.skipped.clear()
+
+    async def fetch_films(self, films: List[Tuple[int, Dict[str, Any]]]) -> None:
+        """Fetch ``films`` with the session and parse pool set up, changes
+        go to the active batch."""
+        from concurrent.futures import ProcessPoolExecutor
+        workers = min(self._concurrency, len(films))
+        executor = (ProcessPoolExecutor(min(self._parse_workers, workers))
+                    if self._parse_pool else nullcontext())
+        with executor:
+            async with self.open_session():
+                self._executor = executor if self._parse_pool else None
+                try:
+                    await self._run_pipeline(films, workers)
+                finally:
+                    self._executor = None
+
+    async def work(self, queue: jobqueue.JobQueue, worker: str = '', batch: int = 0,
+                   lease: float = jobqueue.DEFAULT_LEASE, idle: float = 1.0,
+                   once: bool = False) -> int:
+        """Fetch the films of leased jobs and store the results in the queue,
+        return how many jobs were done.
+
+        Leases ``batch`` jobs at a time. Waits ``idle`` seconds when there
+        is nothing to lease; with ``once`` it returns instead, as soon as no
+        job is waiting or leased by another worker.
+        """
+        import asyncio
+        worker = worker or jobqueue.worker_name()
+        batch = batch or self._concurrency * 4
+        self._clear_stats()
+        done = 0
+        while True:
+            jobs = queue.lease(worker, batch, lease)
+            if jobs:
+                done += await self._work_on(queue, worker, jobs)
+                continue
+            if once:
+                stats = queue.stats()
+                if not (stats.waiting or stats.leased):
+                    return done
+            await asyncio.sleep(idle)
+
+    async def _work_on(self, queue: jobqueue.JobQueue, worker: str,
+                       jobs: List[jobqueue.Job]) -> int:
+        """Fetch the jobs' films into a batch of their own and hand the changes
+        back as the jobs' results.
+
+        On Ctrl-C the jobs not done yet are released for another worker; after
+        a crash they stay leased until the lease runs out, using up an attempt.
+        """
+        import asyncio
+        leased = jobqueue.LeasedFilms(jobs)
+        uow = UnitOfWork(leased)
+        finished = interrupted = False
+        try:
+            with self._using(uow):
+                await self.fetch_films([(job.film_id, job.film) for job in jobs])
+            finished = True
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            interrupted = True
+            raise
+        finally:
+            uow.commit()
+            results = leased.results
+            if finished:  # Films fetched without a change still count as done
+                results = {job.film_id: results.get(job.film_id, {}) for job in jobs}
+            done = queue.complete(worker, results)
+            if interrupted:
+                queue.release(worker, [job.film_id for job in jobs
+                                       if job.film_id not in results])
+        return done
+
+    def queue_due(self, queue: jobqueue.JobQueue) -> DispatchResult:
+        """Queue the due films for ``filmix worker`` processes, most overdue
+        first. Jobs queued by an earlier dispatch that did not finish are kept."""
+        read = self._read()
+        if read.error:
+            return DispatchResult(error=read.error)
+        due = scheduler.due_films(read.todo_list)
+        return DispatchResult(queued=queue.enqueue(due[:self._budget or None]))
+
+    def dispatch(self, queue: jobqueue.JobQueue, poll: float = 1.0,
+                 workers_alive: Optional[Callable[[], bool]] = None) -> DispatchResult:
+        """Apply the workers' results to the database as they come in, until
+        no job is left.
+
+        Results are applied by this process alone, in one write per poll.
+        With ``workers_alive``, stops with WORKERS_ERROR once it returns
+        False while jobs are still waiting for a worker.
+        """
+        applied = 0
+        error = SUCCESS
+        if self.history is not None:
+            self._run = self.history.start_run()
+        try:
+            with self.batch() as uow:
+                while True:
+                    results = queue.results()
+                    for film_id, (url, fields) in results.items():
+                        stored = uow.get(film_id)
+                        if stored is None or stored.url != url:
+                            continue  # Removed, or its url changed since it was fetched
+                        if self._update_fields(film_id, fields) == SUCCESS:
+                            applied += 1
+                            if self._run is not None:
+                                self.history.record(uow.get(film_id), self._run)
+                    error = uow.commit()
+                    if error:
+                        break
+                    queue.ack(results)
+                    stats = queue.stats()
+                    if not (stats.waiting or stats.leased or stats.done):
+                        break
+                    if workers_alive is not None and stats.waiting and not workers_alive():
+                        error = WORKERS_ERROR
+                        break
+                    time.sleep(poll)
+        finally:
+            if self.history is not None:
+                self.history.flush()
+            self._run = None
+        return DispatchResult(0, applied, queue.discard_given_up(), error or self.write_error)
+
+    async def _run_pipeline(self, films: List[Tuple[int, Dict[str, Any]]], workers: int) -> None:
+        """Feed films through a bounded queue to a fixed pool of workers.
+
+        At most ``workers`` pages are downloaded or parsed at once and at
+        most twice that many films wait in the queue, however long the list.
+        Changes go to the active batch, which flushes every flush_every.
+        """
+        import asyncio
+        queue = asyncio.Queue(maxsize=workers * 2)
+        today = datetime.datetime.now().strftime('%Y-%m-%d')
+
+        async def produce() -> None:
+            for film_id, film in films:
+                film['last_checked'] = today
+                await queue.put((film_id, film))
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def work() -> None:
+            while (item := await queue.get()) is not None:
+                film_id, film = item
+                await self.get_status(film, film_id)
+
+        tasks = [asyncio.ensure_future(produce())]
+        tasks += [asyncio.ensure_future(work()) for _ in range(workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def extract(self, html: str, fields: extractors.Fields):
+        """Run the extractor in the parse pool if there is one, else inline."""
+        if self._executor is None:
+            return extractors.extract(html, fields, self._extractor)
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, extractors.extract, html, fields, self._extractor)
+
+    def summary(self) -> str:
+        """What the last fetch run did, plus who throttled it and what was given up."""
+        lines = [f"Fetched {self.stats['fetched']} pages: "
+                 f"{self.stats['updated']} updated, "
+                 f"{self.stats['not_modified']} not modified, "
+                 f"{self.stats['unchanged']} unchanged content skipped, "
+                 f"{self.stats['failed']} failed, "
+                 f"{self.stats['retried']} retries"]
+        if self.throttled:
+            lines.append(f"Throttled {self.stats['throttled']} times by " + ', '.join(
+                f'{host} ({count})' for host, count in self.throttled.most_common()))
+        if self.skipped:
+            lines.append(f"Skipped {len(self.skipped)} urls after {self._limits.retries} retries:")
+            lines += [f'  {url}' for url in self.skipped[:SUMMARY_MAX_URLS]]
+            if len(self.skipped) > SUMMARY_MAX_URLS:
+                lines.append(f'  ... and {len(self.skipped) - SUMMARY_MAX_URLS} more')
+        if self.writer is not None and self.writer.flush_times.count:
+            flush = self.writer.flush_times
+            lines.append(f"Wrote {self.writer.films_written} films in {flush.count} background "
+                         f"flushes: up to {self.writer.max_queued} queued, "
+                         f"{flush.total / flush.count * 1000:.1f}ms mean, "
+                         f"{flush.max * 1000:.1f}ms max")
+        if self.write_error:
+            lines.append(f"Writing the database failed: {ERRORS[self.write_error]}")
+        return '\n'.join(lines)
+
+    def request_headers(self, film: Dict[str, Any]) -> Dict[str, str]:
+        """Per-request headers, sent on top of the session headers."""
+        origin = urllib.parse.urlparse(film.get('url')).netloc
+        headers = {**self.set_random_headers(),
+                   'origin': f'https://{origin}', 'referer': f'https://{origin}/'}
+        if etag := film.get('etag'):
+            headers['If-None-Match'] = etag
+        if last_modified := film.get('last_modified'):
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    @staticmethod
+    def film_fields(film: Dict[str, Any]) -> extractors.Fields:
+        """Selectors to look up on a film page, by field name."""
+        return sites.for_url(film.get('url')).film_fields(film)
+
+    async def _page_response(self, page: 'aiohttp.ClientResponse', film) -> PageResponse:
+        if page.status == 304:
+            return PageResponse(page.status)
+        etag = page.headers.get('ETag', '')
+        last_modified = page.headers.get('Last-Modified', '')
+        if self._stream:
+            try:
+                extractor = extractors.FastExtractor(self.film_fields(film))
+            except extractors.UnsupportedSelector:
+                extractor = None
+            if extractor is not None:
+                with stage(self.profiler, 'stream'):
+                    await self._read_until_found(page, extractor)
+                return PageResponse(page.status, '', etag, last_modified,
+                                    found=extractor.results())
+        with stage(self.profiler, 'download'):
+            body = await page.read()
+        return PageResponse(page.status, await page.text(), etag, last_modified,
+                            hashlib.blake2b(body, digest_size=16).hexdigest())
+
+    async def _read_until_found(self, page: 'aiohttp.ClientResponse',
+                                extractor: extractors.FastExtractor) -> None:
+        """Feed the body to the extractor chunk by chunk and hang up as soon
+        as every field is found or max_bytes were read."""
         try:
-            current_headers = SESSION_STATIC_HEADERS.copy()
-            current_headers = {**current_headers, **self.set_random_headers(),
-                               'origin': f'https://{origin}', 'referer': f'https://{origin}/'}
-            async with aiohttp.ClientSession(headers=current_headers) as session:
-                async with session.get(url) as page:
+            decoder = codecs.getincrementaldecoder(page.charset or 'utf-8')('replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        received = 0
+        async for chunk in page.content.iter_chunked(STREAM_CHUNK_SIZE):
+            received += len(chunk)
+            extractor.feed(decoder.decode(chunk))
+            if extractor.done or received >= self._max_bytes:
+                break
+        else:
+            extractor.feed(decoder.decode(b'', final=True))
+        if not page.content.at_eof():
+            self.stats['stopped_early'] += 1
+            page.close()  # Do not download the rest of the page
+        extractor.close()
+
+    async def fetch_one_status(self, film, debug=False) -> PageResponse:
+        import asyncio
+        if self._session is None:
+            async with self.open_session():
+                return await self.fetch_one_status(film, debug)
+        import aiohttp
+        session = self._session
+        url = film.get('url')
+        limits = self._limits
+        status = 0
+        for attempt in range(limits.retries + 1):
+            with stage(self.profiler, 'rate_wait'):
+                await self._limiter.acquire(url)
+            try:
+                with stage(self.profiler, 'headers'):
+                    current_headers = self.request_headers(film)
+                async with session.get(url, headers=current_headers) as page:
                     if debug:
                         print(f'Fetching status for url {film.get("url")} with ip '
-                              f'{session.headers.get("X-Forwarded-For")}')
-                    await page.read()
-                    if page.status == 429:
-                        print('Too many requests, retrying with new IP...')
-                        session.headers.update(self.set_random_headers())
-                        retry = int(page.headers.get(
-                            'Retry-After')) + randint(5, 10)
-                        print(f'Waiting {retry} seconds to retry...')
-                        await asyncio.sleep(retry)
-                        if debug:
-                            print(session.headers)
-                        page = await session.get(url)
+                              f'{current_headers.get("X-Forwarded-For")}')
+                    status = page.status
+                    if status == 429:
                         await page.read()
-                        if page.status == 429:
-                            print('Still too many requests, skipping...')
-                            return ''
-                    return await page.text()
-        except Exception as ex:
-            print(f'Cannot fetch url {url}, {ex}')
-            return ''
+                        retry = ratelimit.parse_retry_after(page.headers.get('Retry-After'),
+                                                            limits.default_retry_after)
+                        # Everything queued for this host waits, not just this film
+                        self._limiter.pause(url, retry)
+                        self.stats['throttled'] += 1
+                        self.throttled[self._host(url)] += 1
+                        if debug:
+                            print(f'Too many requests, pausing {self._host(url)} for {retry}s')
+                        if attempt < limits.retries:
+                            self.stats['retried'] += 1
+                        continue
+                    if status < 500:
+                        return await self._page_response(page, film)
+                    await page.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                status = 0
+                if debug:
+                    print(f'Cannot fetch url {url}, {ex!r}')
+            except Exception as ex:
+                print(f'Cannot fetch url {url}, {ex}')
+                return PageResponse(0)
+            if attempt < limits.retries:
+                self.stats['retried'] += 1
+                await asyncio.sleep(ratelimit.backoff(attempt, limits.backoff_base,
+                                                      limits.backoff_cap))
+        self.skipped.append(url)
+        return PageResponse(status)
+
+    @staticmethod
+    def _host(url: str) -> str:
+        return urllib.parse.urlparse(url or '').netloc
 
     async def get_status(self, film, film_id, debug=False) -> Dict[str, Any]:
-        page_content = await self.fetch_one_status(film, debug)
-        soup = BeautifulSoup(page_content, 'html.parser')
-        name = None
+        page = await self.fetch_one_status(film, debug)
+        self.stats['fetched'] += 1
+        if page.status == 304:  # Not modified since the stored ETag/Last-Modified
+            self.stats['not_modified'] += 1
+            self.reschedule(film_id, film, False)
+            return film
+        if page.status != 200:
+            self.stats['failed'] += 1
+        elif page.digest and page.digest == film.get('content_hash'):  # Same body as last time
+            self.stats['unchanged'] += 1
+            self.reschedule(film_id, film, False)
+            return film
+        elif page.digest:
+            film['content_hash'] = page.digest
+        if page.etag:
+            film['etag'] = page.etag
+        if page.last_modified:
+            film['last_modified'] = page.last_modified
+        seen = scheduler.tracked(film)
+        updated = False
         try:
-            if not film.get('name'):
-                name = soup.select_one(film.get('n_selector'))
-                if name:
-                    film['name'] = name.text
-                    self.change(film_id=film_id, name=film.get('name'))
-
-            imdb = soup.select_one(
-                'span.imdb_rating') or soup.select_one('span.imdb')
-            if imdb:
-                film['imdb'] = '|'.join(imdb.text.split('\n')).rstrip('|')
-
-            rate_pos = soup.select_one('span.ratePos') or ''
-            rate_neg = soup.select_one('span.rateNeg') or ''
-            if rate_pos or rate_neg:
-                film['filmix_users_rating'] = f'{int(rate_pos.text)-int(rate_neg.text)}'
-
-            quality = soup.select_one(film.get('q_selector'))
-            if quality:
-                film['quality'] = quality.text.rstrip()
-                if not film['quality']:
-                    film['quality'] = quality.attrs.get(
-                        'title').strip('Фильм в высочайшем качестве')
-            if not film.get('quality') and 'hdkinoteatr' in film.get('url'):
-                film['quality'] = 'HD 720P'
-
-            if quality or imdb or name or rate_pos or rate_neg:
-                if debug:
-                    print(
-                        f'Fetched film info: {name=}, {imdb=}, {quality=}, {rate_pos=}, {rate_neg=}')
-                self.change(film_id, **film)
-        except AttributeError as ex:
+            with stage(self.profiler, 'parse'):
+                found = page.found
+                if found is None:
+                    found = await self.extract(page.text, self.film_fields(film))
+                updated = sites.for_url(film.get('url')).apply(film, found)
+            if updated and debug:
+                print(f'Fetched film info: {found}')
+        except (AttributeError, ValueError) as ex:
             print(f'Cannot get film name or quality, {ex}')
+        changed = scheduler.tracked(film) != seen if page.status == 200 else None
+        if updated:
+            scheduler.reschedule(film, changed)
+            with stage(self.profiler, 'change'):
+                self.change(film_id, **film)
+            if self._run is not None:
+                self.history.record(film, self._run)
+            self.stats['updated'] += 1
+        else:
+            self.reschedule(film_id, film, changed)
+        return film
 
-    def change(self, film_id: int, **kwargs) -> CurrentTodo:
-        """change to-do"""
-        read = self._db_handler.read()
-        if read.error:
-            return CurrentTodo({}, read.error)
-        try:
-            todo = read.todo_list[film_id - 1]
-        except IndexError:
-            return CurrentTodo({}, ID_ERROR)
+    def reschedule(self, film_id: int, film: Dict[str, Any], changed: Optional[bool]) -> int:
+        """Schedule the film's next check and store just the schedule."""
+        return self._update_fields(film_id, scheduler.reschedule(film, changed))
+
+    def _update_fields(self, film_id: int, fields: Dict[str, Any]) -> int:
+        """Store ``fields`` on the film ``film_id`` as they are."""
+        if self._uow is None:
+            return self._db_handler.update({film_id: fields})
+        if self._uow.error:
+            return self._uow.error
+        stored = self._uow.get(film_id)
+        if stored is None:
+            return ID_ERROR
+        stored.update(fields)
+        return self._uow.update(film_id, fields)
+
+    def change(self, ref: FilmRef, **kwargs) -> CurrentTodo:
+        """Change the fields of a film given by id or url."""
+        record = self.find(ref)
+        if record.error:
+            return CurrentTodo({}, record.error)
+        todo = record.todo
+        film_id = todo.get('id')
+        before = dict(todo)
         for key, arg in kwargs.items():
-            if arg:
-                if not todo.get(key) or todo.get(key) != arg:
-                    todo[key] = arg
-                    write = self._db_handler.write(read.todo_list)
-                    if write.error:
-                        print(f'{write.error=}')
-                        return CurrentTodo(todo, write.error)
+            # None and '' mean "not given", a parsed 0 is a value
+            if arg is not None and arg != '' and key != 'id':
+                todo[key] = arg
+        if any(before.get(key) != todo.get(key) for key in ('url', 'n_selector', 'q_selector')):
+            # The stored validators and hash were taken from another page or selectors
+            for key in ('etag', 'last_modified', 'content_hash'):
+                todo.pop(key, None)
+        # Compare parsed values, '|7.5|53966' sets both imdb and imdb_votes
+        changes = {key: todo.get(key) for key in {*before, *todo}
+                   if before.get(key) != todo.get(key)}
+        if changes:
+            if self._uow is None:
+                error = self._db_handler.update({film_id: changes})
+            else:
+                error = self._uow.update(film_id, changes)
+            if error:
+                print(f'{error=}')
+                return CurrentTodo(todo, error)
         return CurrentTodo(todo, SUCCESS)
 
-    def remove(self, film_id: int) -> CurrentTodo:
-        """Remove a to-do from the database using its id or index."""
-        read = self._db_handler.read()
-        if read.error:
-            return CurrentTodo({}, read.error)
-        try:
-            todo = read.todo_list.pop(film_id - 1)
-        except IndexError:
-            return CurrentTodo({}, ID_ERROR)
-        write = self._db_handler.write(read.todo_list)
-        return CurrentTodo(todo, write.error)
+    def remove(self, ref: FilmRef) -> CurrentTodo:
+        """Remove a film given by id or url; other films keep their ids."""
+        film_id = self._film_id(ref)
+        if self._uow is None:
+            return CurrentTodo(*self._db_handler.delete(film_id))
+        if self._uow.error:
+            return CurrentTodo({}, self._uow.error)
+        return CurrentTodo(*self._uow.remove(film_id))
 
     def remove_all(self) -> CurrentTodo:
         """Remove all to-dos from the database."""
+        if self._uow is not None:
+            return CurrentTodo({}, self._uow.clear())
         write = self._db_handler.write([])
         return CurrentTodo({}, write.error)
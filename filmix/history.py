@@ -0,0 +1,269 @@
+"""Append-only history of the quality and ratings seen for each film.
+
+Stored next to the database in ``<db>.history/`` as one flat file per
+column (``array`` machine format, native byte order), so loading is a
+``fromfile`` per column and appending is a ``tofile``. A row is written
+only when a film's quality, IMDB score or filmix rating differs from its
+previous row, so daily refreshes of unchanged films cost nothing; a
+change costs 30 bytes. Quality strings are interned in ``strings.txt``.
+
+Films are keyed by a 64-bit hash of their url, which survives
+renumbering when other films are removed.
+
+Processes sharing the database take its lock file around starting a run
+and appending rows, so their rows never interleave within a column.
+"""
+import hashlib
+import time
+from array import array
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from filmix.locking import FileLock
+
+NO_VALUE = -1
+NO_RATING = -2 ** 31
+
+# Column name -> array typecode
+COLUMNS = {
+    'time': 'I',     # unix time of the observation
+    'run': 'I',      # fetch run that saw it
+    'film': 'Q',     # film_key(url)
+    'quality': 'i',  # index into strings.txt
+    'imdb': 'h',     # IMDB score * 10
+    'votes': 'I',    # IMDB vote count
+    'rating': 'i',   # filmix users rating
+}
+
+
+class Observation(NamedTuple):
+    time: int
+    run: int
+    quality: Optional[str]
+    imdb: Optional[float]
+    votes: int
+    rating: Optional[int]
+
+
+def film_key(url: str) -> int:
+    digest = hashlib.blake2b((url or '').strip().encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _fits(column: str, value: int) -> bool:
+    try:
+        array(COLUMNS[column], [value])
+    except OverflowError:
+        return False
+    return True
+
+
+def _parse_imdb(value: Any, votes: Any = None) -> Tuple[int, int]:
+    if isinstance(value, str):
+        # Legacy '|7.5|53966': the score, then the vote count
+        parts = [part for part in value.split('|') if part]
+        value = parts[0] if parts else None
+        votes = parts[1] if len(parts) > 1 else votes
+    # A typed film has the score and the vote count as separate fields
+    try:
+        score = round(float(value) * 10)
+    except (TypeError, ValueError, OverflowError):
+        score = NO_VALUE
+    try:
+        votes = int(votes)
+    except (TypeError, ValueError):
+        votes = 0
+    return (score if _fits('imdb', score) else NO_VALUE,
+            votes if _fits('votes', votes) else 0)
+
+
+def _parse_rating(value: Any) -> int:
+    try:
+        rating = int(value)
+    except (TypeError, ValueError):
+        return NO_RATING
+    return rating if _fits('rating', rating) else NO_RATING
+
+
+class History:
+    def __init__(self, db_path: Path) -> None:
+        self.path = Path(f'{db_path}.history')
+        self._file_lock = FileLock(Path(f'{db_path}.lock'))
+        self._columns: Optional[Dict[str, array]] = None
+        self._pending = {name: array(code) for name, code in COLUMNS.items()}
+        self._runs: Optional[array] = None
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        self._pending_strings: List[str] = []
+        self._last: Dict[int, Tuple[int, int, int]] = {}
+
+    def _load(self) -> None:
+        if self._columns is not None:
+            return
+        columns = {name: array(code) for name, code in COLUMNS.items()}
+        for name, column in columns.items():
+            self._read_column(self.path / f'{name}.col', column)
+        # A crash between column appends leaves some columns a row longer
+        rows = min(len(column) for column in columns.values())
+        for column in columns.values():
+            del column[rows:]
+        self._columns = columns
+        self._runs = array('d')
+        self._read_column(self.path / 'runs.col', self._runs)
+        self._strings = self._read_strings()
+        self._string_ids = {text: index for index, text in enumerate(self._strings)}
+        for row in range(rows):
+            self._last[columns['film'][row]] = (columns['quality'][row],
+                                                columns['imdb'][row], columns['rating'][row])
+
+    def _read_strings(self) -> List[str]:
+        strings = self.path / 'strings.txt'
+        if not strings.exists():
+            return []
+        return strings.read_text(encoding='utf-8').split('\n')[:-1]
+
+    @staticmethod
+    def _read_column(path: Path, column: array) -> None:
+        if not path.exists():
+            return
+        data = path.read_bytes()
+        column.frombytes(data[:len(data) - len(data) % column.itemsize])
+
+    def _string_id(self, text: Optional[str]) -> int:
+        if not text:
+            return NO_VALUE
+        text = ' '.join(str(text).split())
+        if text not in self._string_ids:
+            self._string_ids[text] = len(self._strings)
+            self._strings.append(text)
+            self._pending_strings.append(text)
+        return self._string_ids[text]
+
+    def start_run(self, now: Optional[float] = None) -> int:
+        """Register a fetch run and return its number."""
+        self._load()
+        with self._file_lock:
+            # Numbered after the runs other processes started since loading
+            runs = array('d')
+            self._read_column(self.path / 'runs.col', runs)
+            runs.append(time.time() if now is None else now)
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path / 'runs.col', 'ab') as column:
+                runs[-1:].tofile(column)
+        self._runs = runs
+        return len(runs) - 1
+
+    def record(self, film: Dict[str, Any], run: int, now: Optional[float] = None) -> bool:
+        """Queue a row if the film's values changed, return True if so."""
+        self._load()
+        key = film_key(film.get('url'))
+        imdb, votes = _parse_imdb(film.get('imdb'), film.get('imdb_votes'))
+        rating = _parse_rating(film.get('filmix_users_rating'))
+        quality = self._string_id(film.get('quality'))
+        if self._last.get(key) == (quality, imdb, rating):
+            return False
+        row = {'time': int(time.time() if now is None else now), 'run': run, 'film': key,
+               'quality': quality, 'imdb': imdb, 'votes': votes, 'rating': rating}
+        # Converted up front, so a value a column cannot hold leaves no column a row longer
+        cells = {name: array(COLUMNS[name], [value]) for name, value in row.items()}
+        for name, cell in cells.items():
+            self._pending[name].extend(cell)
+        self._last[key] = (quality, imdb, rating)
+        return True
+
+    def flush(self) -> None:
+        """Append the queued rows to the column files."""
+        if not self._pending['time']:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self._file_lock:
+            self._store_strings()
+            films = self.path / 'film.col'
+            stored = films.stat().st_size if films.exists() else 0
+            # Another process appended rows since they were loaded
+            stale = stored != len(self._columns['film']) * self._columns['film'].itemsize
+            for name, column in self._pending.items():
+                self._append(self.path / f'{name}.col', column, self._columns[name])
+        if stale:
+            self._columns = None  # Reloaded with everyone's rows on next use
+
+    def _store_strings(self) -> None:
+        """Append the new quality strings, renumbering those another process
+        stored first or under the same ids."""
+        if not self._pending_strings:
+            return
+        stored = self._read_strings()
+        stored_ids = {text: index for index, text in enumerate(stored)}
+        new = []
+        moved = {}
+        for text in self._pending_strings:
+            if text not in stored_ids:
+                stored_ids[text] = len(stored) + len(new)
+                new.append(text)
+            if stored_ids[text] != self._string_ids[text]:
+                moved[self._string_ids[text]] = stored_ids[text]
+        with open(self.path / 'strings.txt', 'a', encoding='utf-8') as strings:
+            strings.write(''.join(f'{text}\n' for text in new))
+        self._pending_strings.clear()
+        self._strings = stored + new
+        self._string_ids = stored_ids
+        if moved:
+            quality = self._pending['quality']
+            for row, string_id in enumerate(quality):
+                quality[row] = moved.get(string_id, string_id)
+            self._last = {key: (moved.get(last[0], last[0]), *last[1:])
+                          for key, last in self._last.items()}
+
+    @staticmethod
+    def _append(path: Path, pending: array, loaded: array) -> None:
+        if not pending:
+            return
+        with open(path, 'ab') as column:
+            pending.tofile(column)
+        loaded.extend(pending)
+        del pending[:]
+
+    def _observation(self, row: int) -> Observation:
+        columns = self._columns
+        quality = columns['quality'][row]
+        imdb = columns['imdb'][row]
+        rating = columns['rating'][row]
+        return Observation(columns['time'][row], columns['run'][row],
+                           self._strings[quality] if quality != NO_VALUE else None,
+                           imdb / 10 if imdb != NO_VALUE else None,
+                           columns['votes'][row],
+                           rating if rating != NO_RATING else None)
+
+    def for_url(self, url: str) -> List[Observation]:
+        """Every recorded change of one film, oldest first."""
+        self._load()
+        key = film_key(url)
+        films = self._columns['film']
+        return [self._observation(row) for row in range(len(films)) if films[row] == key]
+
+    def runs(self) -> List[float]:
+        """Start time of each fetch run, by run number."""
+        self._load()
+        return list(self._runs)
+
+    def changed_in_run(self, urls: Iterable[str],
+                       run: Optional[int] = None) -> Dict[str, Tuple[Optional[Observation], Observation]]:
+        """{url: (previous, current)} for the films that changed in a run.
+
+        Defaults to the last run; ``previous`` is None for a film's first row.
+        """
+        self._load()
+        if run is None:
+            run = len(self._runs) - 1
+        keys = {film_key(url): url for url in urls}
+        previous: Dict[int, int] = {}
+        changed = {}
+        columns = self._columns
+        for row in range(len(columns['film'])):
+            key = columns['film'][row]
+            if columns['run'][row] == run and key in keys:
+                before = previous.get(key)
+                changed[keys[key]] = (self._observation(before) if before is not None else None,
+                                      self._observation(row))
+            previous[key] = row
+        return changed
@@ -0,0 +1,214 @@
+"""Persistent job queue that spreads a refresh over several processes.
+
+``filmix dispatch`` queues the due films in ``<db>.jobs``, an SQLite file
+next to the database, and is the one process that applies the results to
+the database. Any number of ``filmix worker`` processes, on this machine
+or on others sharing the filesystem, lease a few jobs at a time, fetch
+the films and store the fields that changed as the jobs' results.
+
+A lease runs out after its visibility timeout, and a job whose lease ran
+out is leased again, so the jobs of a worker that died are picked up by
+the others. A job leased ``max_attempts`` times without a result is given
+up on. A worker whose lease ran out cannot overwrite the result of the
+worker that took the job over.
+"""
+import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from filmix import SUCCESS
+from filmix.database import DBResponse
+from filmix.film import Film, json_default
+from filmix.locking import LOCK_TIMEOUT
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+# Seconds a worker may hold a job before it goes to another worker
+DEFAULT_LEASE = 300.0
+MAX_ATTEMPTS = 3
+
+
+class Job(NamedTuple):
+    film_id: int
+    film: Film
+    attempts: int
+
+
+class Result(NamedTuple):
+    url: Optional[str]  # of the film when it was queued
+    fields: Dict[str, Any]
+
+
+class QueueStats(NamedTuple):
+    waiting: int = 0  # queued, or leased by a worker that ran out of time
+    leased: int = 0
+    done: int = 0  # results not applied yet
+    given_up: int = 0
+
+
+def queue_path(db_path: Path) -> Path:
+    return db_path.with_name(db_path.name + ".jobs")
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " film_id INTEGER PRIMARY KEY,"
+        " film TEXT NOT NULL,"
+        " state TEXT NOT NULL,"
+        " worker TEXT,"
+        " lease_until REAL,"
+        " attempts INTEGER NOT NULL DEFAULT 0,"
+        " result TEXT)",
+        "CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, lease_until)",
+    )
+
+    def __init__(self, path: Path, max_attempts: int = MAX_ATTEMPTS) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+        # Transactions are begun explicitly, see _transaction
+        self._conn = sqlite3.connect(str(path), timeout=LOCK_TIMEOUT, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self) -> "JobQueue":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Take the write lock up front, so two workers never lease the same job."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def enqueue(self, films: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        """Queue a job per (film_id, film) that has none yet, return how many
+        were queued. Jobs still waiting for a worker get the film as it is now."""
+        rows = [(film_id, json.dumps(film, default=json_default), QUEUED)
+                for film_id, film in films]
+        with self._transaction() as conn:
+            before, = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()
+            conn.executemany("INSERT INTO jobs (film_id, film, state) VALUES (?, ?, ?)"
+                             " ON CONFLICT(film_id) DO UPDATE SET film = excluded.film"
+                             " WHERE state = excluded.state", rows)
+            after, = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()
+        return after - before
+
+    def lease(self, worker: str, count: int, seconds: float = DEFAULT_LEASE,
+              now: Optional[float] = None) -> List[Job]:
+        """Lease up to ``count`` waiting jobs to ``worker`` for ``seconds``."""
+        now = time.time() if now is None else now
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT film_id, film, attempts FROM jobs"
+                " WHERE (state = ? OR (state = ? AND lease_until < ?)) AND attempts < ?"
+                " ORDER BY film_id LIMIT ?",
+                (QUEUED, LEASED, now, self.max_attempts, count)).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1"
+                " WHERE film_id = ?",
+                [(LEASED, worker, now + seconds, film_id) for film_id, _, _ in rows])
+        return [Job(film_id, Film.from_dict(json.loads(film)), attempts + 1)
+                for film_id, film, attempts in rows]
+
+    def complete(self, worker: str, results: Dict[int, Dict[str, Any]]) -> int:
+        """Store the changed fields of jobs ``worker`` still holds, return
+        how many were stored. Jobs another worker took over are skipped."""
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "UPDATE jobs SET state = ?, result = ?, lease_until = NULL"
+                " WHERE film_id = ? AND state = ? AND worker = ?",
+                [(DONE, json.dumps(fields, default=json_default), film_id, LEASED, worker)
+                 for film_id, fields in results.items()])
+            return conn.total_changes - before
+
+    def release(self, worker: str, film_ids: Iterable[int]) -> None:
+        """Give unfinished jobs back, e.g. on Ctrl-C, without using up an attempt."""
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL,"
+                " attempts = attempts - 1 WHERE film_id = ? AND state = ? AND worker = ?",
+                [(QUEUED, film_id, LEASED, worker) for film_id in film_ids])
+
+    def results(self) -> Dict[int, Result]:
+        """The changed fields of the finished jobs, by film id."""
+        rows = self._conn.execute(
+            "SELECT film_id, film, result FROM jobs WHERE state = ?", (DONE,))
+        return {film_id: Result(json.loads(film).get("url"), json.loads(result))
+                for film_id, film, result in rows}
+
+    def ack(self, film_ids: Iterable[int]) -> None:
+        """Drop finished jobs whose results were applied."""
+        with self._transaction() as conn:
+            conn.executemany("DELETE FROM jobs WHERE film_id = ? AND state = ?",
+                             [(film_id, DONE) for film_id in film_ids])
+
+    def discard_given_up(self, now: Optional[float] = None) -> List[str]:
+        """Drop the jobs given up on, return their urls."""
+        now = time.time() if now is None else now
+        where = ("(state = ? OR (state = ? AND lease_until < ?)) AND attempts >= ?",
+                 (QUEUED, LEASED, now, self.max_attempts))
+        with self._transaction() as conn:
+            urls = [json.loads(film).get("url") for film, in conn.execute(
+                f"SELECT film FROM jobs WHERE {where[0]}", where[1])]
+            conn.execute(f"DELETE FROM jobs WHERE {where[0]}", where[1])
+        return urls
+
+    def stats(self, now: Optional[float] = None) -> QueueStats:
+        now = time.time() if now is None else now
+        (waiting, leased, done, given_up), = self._conn.execute(
+            "SELECT"
+            " COALESCE(SUM((state = ? OR (state = ? AND lease_until < ?)) AND attempts < ?), 0),"
+            " COALESCE(SUM(state = ? AND lease_until >= ?), 0),"
+            " COALESCE(SUM(state = ?), 0),"
+            " COALESCE(SUM((state = ? OR (state = ? AND lease_until < ?)) AND attempts >= ?), 0)"
+            " FROM jobs",
+            (QUEUED, LEASED, now, self.max_attempts, LEASED, now, DONE,
+             QUEUED, LEASED, now, self.max_attempts)).fetchall()
+        return QueueStats(waiting, leased, done, given_up)
+
+
+class LeasedFilms:
+    """Stands in for the DatabaseHandler of a worker's UnitOfWork.
+
+    The leased films are its database, and what a commit would write is
+    kept as the jobs' results instead.
+    """
+
+    def __init__(self, jobs: List[Job]) -> None:
+        self.films = [job.film for job in jobs]
+        self.results: Dict[int, Dict[str, Any]] = {}
+
+    def read(self) -> DBResponse:
+        return DBResponse([film.copy() for film in self.films], SUCCESS)
+
+    def last_id(self) -> int:
+        return 0  # Workers add no films
+
+    def merge(self, updates: Dict[int, Dict[str, Any]], appends: List[Film],
+              removed: Iterable[int] = ()) -> int:
+        for film_id, fields in updates.items():
+            self.results.setdefault(film_id, {}).update(fields)
+        return SUCCESS
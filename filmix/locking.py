@@ -0,0 +1,100 @@
+"""Advisory file locks that let several filmix processes share a database.
+
+A lock is held only around the short part of a write that has to be
+exclusive, e.g. checking that the file is still the version that was read
+and renaming the new one over it. Readers never take it.
+"""
+import errno
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Give up on a lock another process holds after this many seconds
+LOCK_TIMEOUT = 10.0
+MAX_POLL = 0.05
+
+_BUSY = (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK, errno.EDEADLK)
+
+
+def _try_lock(fd: int) -> bool:
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError as ex:
+        if ex.errno in _BUSY:
+            return False
+        raise
+    return True
+
+
+def _unlock(fd: int) -> None:
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class FileLock:
+    """Exclusive lock on ``path``, created if missing.
+
+    Excludes other processes and other threads; the thread holding it may
+    take it again. Raises TimeoutError when it stays taken for ``timeout``
+    seconds.
+    """
+
+    def __init__(self, path: Path, timeout: float = LOCK_TIMEOUT) -> None:
+        self.path = path
+        self.timeout = timeout
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd: Optional[int] = None
+
+    def _acquire(self) -> int:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        poll = 0.001
+        try:
+            while not _try_lock(fd):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"{self.path} is locked by another process")
+                time.sleep(poll)
+                poll = min(poll * 2, MAX_POLL)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def __enter__(self) -> "FileLock":
+        if not self._thread_lock.acquire(timeout=self.timeout):
+            raise TimeoutError(f"{self.path} is locked by another thread")
+        try:
+            if not self._depth:
+                self._fd = self._acquire()
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._depth -= 1
+        try:
+            if not self._depth:
+                fd, self._fd = self._fd, None
+                try:
+                    _unlock(fd)
+                finally:
+                    os.close(fd)
+        finally:
+            self._thread_lock.release()
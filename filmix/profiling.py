@@ -0,0 +1,116 @@
+"""Per-stage timing for fetch runs (``filmix list --fetch --profile``)."""
+import bisect
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+# Histogram bucket upper bounds in milliseconds
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+              1000, 2500, 5000, 10000, 30000, float('inf'))
+
+# Report order; stages not listed here are printed after these
+STAGES = ('rate_wait', 'pool_wait', 'connect', 'ttfb', 'download', 'stream', 'headers', 'parse',
+          'change', 'db_read', 'db_write')
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct: float) -> float:
+        """Upper bound, in seconds, of the bucket holding the percentile."""
+        if not self.count:
+            return 0.0
+        rank = pct / 100 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound / 1000, self.max)
+        return self.max
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'total_s': round(self.total, 6),
+            'mean_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+            'buckets_ms': {str(bound): count
+                           for bound, count in zip(BUCKETS_MS, self.counts) if count},
+        }
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.stages: Dict[str, Histogram] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.stages.setdefault(stage, Histogram()).add(seconds)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def trace_config(self):
+        """aiohttp TraceConfig feeding pool wait, connect and ttfb stages."""
+        import aiohttp
+
+        def started(attr):
+            async def callback(session, ctx: SimpleNamespace, params) -> None:
+                setattr(ctx, attr, time.perf_counter())
+            return callback
+
+        def ended(attr, stage):
+            async def callback(session, ctx: SimpleNamespace, params) -> None:
+                if hasattr(ctx, attr):
+                    self.record(stage, time.perf_counter() - getattr(ctx, attr))
+            return callback
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_queued_start.append(started('queued'))
+        trace.on_connection_queued_end.append(ended('queued', 'pool_wait'))
+        trace.on_connection_create_start.append(started('connecting'))
+        trace.on_connection_create_end.append(ended('connecting', 'connect'))
+        trace.on_request_start.append(started('request'))
+        trace.on_request_end.append(ended('request', 'ttfb'))
+        return trace
+
+    def as_dict(self) -> Dict[str, Dict[str, Any]]:
+        order = [stage for stage in STAGES if stage in self.stages]
+        order += sorted(set(self.stages) - set(STAGES))
+        return {stage: self.stages[stage].as_dict() for stage in order}
+
+    def report(self) -> str:
+        lines = [f"{'stage':<10} {'count':>7} {'total s':>9} {'mean ms':>9} "
+                 f"{'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}"]
+        for stage, data in self.as_dict().items():
+            lines.append(f"{stage:<10} {data['count']:>7} {data['total_s']:>9.3f} "
+                         f"{data['mean_ms']:>9.2f} {data['p50_ms']:>9.2f} "
+                         f"{data['p99_ms']:>9.2f} {data['max_ms']:>9.2f}")
+        return '\n'.join(lines)
+
+    def write_json(self, path: Path) -> None:
+        path.write_text(json.dumps(self.as_dict(), indent=4))
+
+
+def stage(profiler: Optional[Profiler], name: str) -> ContextManager:
+    """``profiler.stage(name)``, or a no-op when profiling is off."""
+    return profiler.stage(name) if profiler is not None else nullcontext()
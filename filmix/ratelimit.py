@@ -0,0 +1,97 @@
+"""Per-host request pacing shared by every fetch of a run.
+
+Each host gets a token bucket. A 429 pauses the host's bucket, so every
+request queued for that host waits out the server's Retry-After, not just
+the one that was throttled.
+"""
+import datetime
+import email.utils
+import random
+import time
+import urllib.parse
+from typing import Dict, NamedTuple, Optional
+
+
+class RateLimits(NamedTuple):
+    rate: float = 0.0  # requests per second per host, 0 for no limit
+    burst: int = 1
+    retries: int = 3  # extra attempts after a 429, a 5xx or a network error
+    backoff_base: float = 1.0
+    backoff_cap: float = 60.0
+    default_retry_after: float = 30.0  # pause on a 429 without Retry-After
+
+
+class TokenBucket:
+    """Allow ``rate`` requests per second in bursts of up to ``burst``."""
+
+    def __init__(self, rate: float = 0.0, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def try_acquire(self) -> float:
+        """Take a token and return 0, or return how long to wait for one."""
+        now = time.monotonic()
+        if self.paused_until > now:
+            return self.paused_until - now
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        import asyncio
+        while (wait := self.try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+
+class HostLimiter:
+    def __init__(self, rate: float = 0.0, burst: int = 1) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = (urllib.parse.urlparse(url or '').hostname or '').lower()
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self._rate, self._burst)
+        return self._buckets[host]
+
+    async def acquire(self, url: str) -> None:
+        await self.bucket(url).acquire()
+
+    def pause(self, url: str, seconds: float) -> None:
+        self.bucket(url).pause(seconds)
+
+
+def parse_retry_after(value: Optional[str], default: float) -> float:
+    """Seconds to wait from a Retry-After header (delay or HTTP date)."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when is None:  # Python < 3.10
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter for the given retry attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,91 @@
+"""Adaptive per-film refresh schedule.
+
+Every checked film carries ``next_due`` (unix time of its next check) and
+``check_interval`` (seconds between checks). A check that sees the quality,
+IMDB score or filmix rating change halves the interval, a check that sees
+nothing new doubles it, within MIN_INTERVAL..MAX_INTERVAL. Fresh releases
+are therefore polled often and old titles rarely. Due films are fetched
+most overdue first.
+"""
+import datetime
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+MIN_INTERVAL = 6 * 3600
+DEFAULT_INTERVAL = 24 * 3600
+MAX_INTERVAL = 30 * 24 * 3600
+# A failed check keeps the interval and is retried after this long
+RETRY_INTERVAL = 3600
+SHRINK = 0.5
+GROWTH = 2.0
+
+TRACKED_FIELDS = ('quality', 'imdb', 'filmix_users_rating')
+
+
+def due_at(film: Dict[str, Any]) -> float:
+    """Unix time the film is due; films never checked are due at once."""
+    next_due = film.get('next_due')
+    if next_due is not None:
+        return float(next_due)
+    # Films checked before the scheduler existed: once a day, as before
+    last_checked = film.get('last_checked')
+    if not last_checked:
+        return 0.0
+    if isinstance(last_checked, datetime.date):
+        checked = datetime.datetime.combine(last_checked, datetime.time())
+    else:
+        try:
+            checked = datetime.datetime.strptime(last_checked, '%Y-%m-%d')
+        except ValueError:
+            return 0.0
+    return (checked + datetime.timedelta(days=1)).timestamp()
+
+
+def due_films(film_list: List[Dict[str, Any]],
+              now: Optional[float] = None) -> List[Tuple[int, Dict[str, Any]]]:
+    """(film_id, film) for every film due at ``now``, most overdue first."""
+    now = time.time() if now is None else now
+    due = []
+    for position, film in enumerate(film_list, 1):
+        when = due_at(film)
+        if when <= now:
+            # Films stored before ids existed are numbered by position
+            due.append((when, film.get('id', position), film))
+    due.sort(key=lambda item: item[:2])
+    return [(film_id, film) for _, film_id, film in due]
+
+
+def next_due(film_list: List[Dict[str, Any]]) -> float:
+    """Unix time the first film falls due, inf for an empty list."""
+    return min((due_at(film) for film in film_list), default=float('inf'))
+
+
+def tracked(film: Dict[str, Any]) -> Tuple:
+    """The values whose change makes a film worth checking more often.
+
+    Only the IMDB score counts, not the vote count that ticks up daily.
+    """
+    imdb = next((part for part in str(film.get('imdb') or '').split('|') if part), '')
+    return film.get('quality'), imdb, film.get('filmix_users_rating')
+
+
+def reschedule(film: Dict[str, Any], changed: Optional[bool],
+               now: Optional[float] = None) -> Dict[str, Any]:
+    """Set the film's next check, return the schedule fields that changed.
+
+    ``changed`` is None when the check failed. The first successful check
+    of a film starts it at DEFAULT_INTERVAL.
+    """
+    now = time.time() if now is None else now
+    interval = film.get('check_interval')
+    if changed is None:
+        fields = {'next_due': int(now + RETRY_INTERVAL)}
+    else:
+        if not interval:
+            interval = DEFAULT_INTERVAL
+        else:
+            interval = interval * (SHRINK if changed else GROWTH)
+        interval = int(min(MAX_INTERVAL, max(MIN_INTERVAL, interval)))
+        fields = {'check_interval': interval, 'next_due': int(now + interval)}
+    film.update(fields)
+    return fields
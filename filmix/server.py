@@ -0,0 +1,161 @@
+"""``filmix serve``: one warm process that keeps the films fresh.
+
+The database, the HTTP connection pool and the scheduler stay loaded;
+due films are refreshed in the background and a small JSON API answers
+on localhost:
+
+    GET    /films          all films with their ids
+    POST   /films          add {"url": ..., "n_selector": ..., "q_selector": ...}
+    DELETE /films/{id}     remove a film, the others keep their ids
+    POST   /refresh        fetch the due films now
+    GET    /metrics        last run counters, stage timings, cache and writer stats
+"""
+import asyncio
+import functools
+import json
+import time
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+from filmix import DUPLICATE_ERROR, ERRORS, ID_ERROR, scheduler
+from filmix.film import json_default
+from filmix.filmix_lib import Todoer
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# Longest sleep between scheduler checks
+MAX_IDLE = 300.0
+
+
+_dumps = functools.partial(json.dumps, default=json_default)
+
+
+def _json(data: Any, status: int = 200) -> web.Response:
+    return web.json_response(data, status=status, dumps=_dumps)
+
+
+def _error(status: int, message: str) -> web.Response:
+    return _json({'error': message}, status)
+
+
+class FilmService:
+    def __init__(self, todoer: Todoer, max_idle: float = MAX_IDLE) -> None:
+        self.todoer = todoer
+        self.max_idle = max_idle
+        self.runs = 0
+        self.refreshing = False
+        self.last_run: Dict[str, Any] = {}
+        self.started = time.time()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, app: web.Application) -> None:
+        self._wake = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self, app: web.Application) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def run(self) -> None:
+        """Refresh due films until cancelled, reusing one HTTP session."""
+        async with self.todoer.open_session():
+            while True:
+                self._wake.clear()
+                await self.refresh()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.idle_time())
+                except asyncio.TimeoutError:
+                    pass
+
+    async def refresh(self) -> None:
+        self.refreshing = True
+        started = time.time()
+        try:
+            fetched = await self.todoer.fetch_all_statuses()
+        finally:
+            self.refreshing = False
+        if fetched:
+            self.runs += 1
+            self.last_run = {
+                'started': started,
+                'seconds': round(time.time() - started, 3),
+                'stats': dict(self.todoer.stats),
+                'throttled': dict(self.todoer.throttled),
+                'skipped': list(self.todoer.skipped),
+            }
+
+    def idle_time(self) -> float:
+        """Seconds until the next film falls due, within 1s..max_idle."""
+        wait = scheduler.next_due(self.todoer.get_film_list()) - time.time()
+        return min(self.max_idle, max(1.0, wait))
+
+    async def list_films(self, request: web.Request) -> web.Response:
+        return _json({'films': self.todoer.get_film_list()})
+
+    async def add_film(self, request: web.Request) -> web.Response:
+        try:
+            data = await request.json()
+        except ValueError:
+            return _error(400, 'request body is not JSON')
+        if not isinstance(data, dict) or not data.get('url'):
+            return _error(400, 'url is required')
+        film, error = self.todoer.add(url=data['url'],
+                                      n_selector=data.get('n_selector', 'h1.name'),
+                                      q_selector=data.get('q_selector', 'div.quality'))
+        if error == DUPLICATE_ERROR:
+            return _json({'error': ERRORS[error], 'film': film}, 409)
+        if error:
+            return _error(500, ERRORS[error])
+        self._wake.set()  # Fetch the new film right away
+        return _json({'film': film}, 201)
+
+    async def remove_film(self, request: web.Request) -> web.Response:
+        film_id = int(request.match_info['film_id'])
+        if film_id < 1:
+            return _error(404, ERRORS[ID_ERROR])
+        # During a refresh this goes to its batch, which then skips the film
+        film, error = self.todoer.remove(film_id)
+        if error == ID_ERROR:
+            return _error(404, ERRORS[error])
+        if error:
+            return _error(500, ERRORS[error])
+        return _json({'film': film})
+
+    async def trigger_refresh(self, request: web.Request) -> web.Response:
+        self._wake.set()
+        return _json({'refreshing': True}, 202)
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        cache = self.todoer.cache_info()
+        film_list = self.todoer.get_film_list()
+        return _json({
+            'uptime_s': round(time.time() - self.started, 3),
+            'films': len(film_list),
+            'next_due': scheduler.next_due(film_list) if film_list else None,
+            'refreshing': self.refreshing,
+            'runs': self.runs,
+            'last_run': self.last_run,
+            'db_cache': {'hits': cache.hits, 'misses': cache.misses},
+            'stages': self.todoer.profiler.as_dict() if self.todoer.profiler else {},
+            'writer': self.todoer.writer.as_dict() if self.todoer.writer else None,
+        })
+
+
+def create_app(todoer: Todoer, max_idle: float = MAX_IDLE) -> web.Application:
+    service = FilmService(todoer, max_idle)
+    app = web.Application()
+    app.router.add_get('/films', service.list_films)
+    app.router.add_post('/films', service.add_film)
+    app.router.add_delete('/films/{film_id:\\d+}', service.remove_film)
+    app.router.add_post('/refresh', service.trigger_refresh)
+    app.router.add_get('/metrics', service.metrics)
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    return app
+
+
+def serve(todoer: Todoer, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+          max_idle: float = MAX_IDLE) -> None:
+    web.run_app(create_app(todoer, max_idle), host=host, port=port)
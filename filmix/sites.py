@@ -0,0 +1,156 @@
+"""Per-site extractor plugins.
+
+A plugin is a SiteExtractor subclass that names the hosts it handles (as
+fnmatch patterns), the selectors to read from a film page and how to turn
+the matches into film fields. Third-party plugins are registered through
+the ``filmix.extractors`` entry point group, e.g. in setup.py::
+
+    entry_points={'filmix.extractors': ['mymirror = mypkg:MirrorExtractor']}
+
+Plugins are looked up once per host and reused for every film on it.
+"""
+import fnmatch
+import urllib.parse
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from filmix.extractors import Fields, Match
+
+ENTRY_POINT_GROUP = 'filmix.extractors'
+
+
+class SiteExtractor:
+    hosts: Tuple[str, ...] = ()
+    name_selector = 'h1.name'
+    quality_selector = 'div.quality'
+    fields: Fields = {
+        'imdb': ('span.imdb_rating', 'span.imdb'),
+    }
+
+    def film_fields(self, film: Dict[str, Any]) -> Fields:
+        """Selectors to look up on this film's page, by field name."""
+        fields = dict(self.fields)
+        if not film.get('name'):
+            name_selector = film.get('n_selector') or self.name_selector
+            if name_selector:
+                fields['name'] = (name_selector,)
+        quality_selector = film.get('q_selector') or self.quality_selector
+        if quality_selector:
+            fields['quality'] = (quality_selector,)
+        return fields
+
+    def apply(self, film: Dict[str, Any], found: Dict[str, Optional[Match]]) -> bool:
+        """Copy the matches onto the film, return True if any field was found."""
+        name = found.get('name')
+        if name:
+            film['name'] = name.text
+
+        imdb = found.get('imdb')
+        if imdb:
+            film['imdb'] = '|'.join(imdb.text.split('\n')).rstrip('|')
+
+        quality = found.get('quality')
+        if quality:
+            film['quality'] = quality.text.rstrip() or self.quality_from_attrs(quality)
+        return bool(name or imdb or quality)
+
+    def quality_from_attrs(self, quality: Match) -> str:
+        return quality.attrs.get('title', '')
+
+
+class FilmixExtractor(SiteExtractor):
+    hosts = ('filmix.*', '*.filmix.*')
+    fields = {
+        **SiteExtractor.fields,
+        'rate_pos': ('span.ratePos',),
+        'rate_neg': ('span.rateNeg',),
+    }
+
+    def apply(self, film: Dict[str, Any], found: Dict[str, Optional[Match]]) -> bool:
+        updated = super().apply(film, found)
+        rate_pos = found.get('rate_pos')
+        rate_neg = found.get('rate_neg')
+        if rate_pos or rate_neg:
+            film['filmix_users_rating'] = f'{int(rate_pos.text)-int(rate_neg.text)}'
+        return updated or bool(rate_pos or rate_neg)
+
+    def quality_from_attrs(self, quality: Match) -> str:
+        return quality.attrs.get('title').strip('Фильм в высочайшем качестве')
+
+
+class HdKinoteatrExtractor(FilmixExtractor):
+    hosts = ('hdkinoteatr.*', '*.hdkinoteatr.*')
+
+    def apply(self, film: Dict[str, Any], found: Dict[str, Optional[Match]]) -> bool:
+        updated = super().apply(film, found)
+        if not film.get('quality'):
+            film['quality'] = 'HD 720P'
+        return updated
+
+
+# Sites without a plugin are treated like filmix mirrors
+DEFAULT_EXTRACTOR = FilmixExtractor
+
+_registry: List[Type[SiteExtractor]] = [FilmixExtractor, HdKinoteatrExtractor]
+_entry_points_loaded = False
+
+
+def register(extractor: Type[SiteExtractor]) -> Type[SiteExtractor]:
+    """Register a plugin; later registrations win over earlier ones."""
+    _registry.append(extractor)
+    for_host.cache_clear()
+    return extractor
+
+
+def _load_entry_points() -> None:
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    from importlib import metadata
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        group = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:  # Python < 3.10
+        group = entry_points.get(ENTRY_POINT_GROUP, [])
+    for entry_point in group:
+        try:
+            register(entry_point.load())
+        except Exception as ex:
+            print(f'Cannot load extractor plugin {entry_point.name}, {ex}')
+
+
+@lru_cache(maxsize=None)
+def for_host(host: str) -> SiteExtractor:
+    """Return the shared plugin instance for a host."""
+    _load_entry_points()
+    for extractor in reversed(_registry):
+        if any(fnmatch.fnmatch(host, pattern) for pattern in extractor.hosts):
+            return extractor()
+    return DEFAULT_EXTRACTOR()
+
+
+def for_url(url: str) -> SiteExtractor:
+    return for_host((urllib.parse.urlparse(url or '').hostname or '').lower())
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a film url, for spotting the same film twice.
+
+    Lowercases scheme and host, drops a default port, the fragment and a
+    trailing slash.
+    """
+    parts = urllib.parse.urlsplit((url or '').strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = f'{netloc}:{port}'
+    path = parts.path.rstrip('/') or '/'
+    return urllib.parse.urlunsplit((scheme, netloc, path, parts.query, ''))
@@ -0,0 +1,169 @@
+"""Write-behind: database writes on a thread of their own.
+
+A fetch run collects its changes in a UnitOfWork, which used to write
+them on the event loop, stalling every download in flight while a large
+JSON file was dumped and fsynced. With write-behind the UnitOfWork hands
+each batch to a WriteBehind thread and returns at once. Batches that
+pile up while the thread is busy are merged per film, so a film changed
+in several of them is written once. ``close`` writes what is left and
+stops the thread; the UnitOfWork calls it on leaving its ``with`` block,
+so Ctrl-C still saves what was fetched.
+"""
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Set
+
+from filmix import SUCCESS
+from filmix.film import Film
+from filmix.profiling import Histogram
+
+if TYPE_CHECKING:
+    from filmix.database import DatabaseHandler
+
+
+class Batch:
+    """Pending changes: films to remove, then to append, then updates,
+    merged per film id."""
+
+    def __init__(self) -> None:
+        self.removed: Set[int] = set()
+        self.appends: Dict[int, Film] = {}
+        self.updates: Dict[int, Dict[str, Any]] = {}
+
+    def __len__(self) -> int:
+        """Films waiting to be written."""
+        return len(self.removed) + len(self.appends) + len(self.updates)
+
+    def add(self, updates: Dict[int, Dict[str, Any]], appends: Iterable[Film] = (),
+            removed: Iterable[int] = ()) -> None:
+        for film_id in removed:
+            self.updates.pop(film_id, None)
+            if self.appends.pop(film_id, None) is None:  # Else never written
+                self.removed.add(film_id)
+        for film in appends:
+            self.appends[film.id] = film
+        for film_id, fields in updates.items():
+            if film_id in self.appends:
+                self.appends[film_id].update(fields)
+            else:
+                self.updates.setdefault(film_id, {}).update(fields)
+
+    def merge(self, newer: 'Batch') -> None:
+        self.add(newer.updates, newer.appends.values(), newer.removed)
+
+
+class WriteBehind:
+    """A thread that writes queued batches through a DatabaseHandler.
+
+    Reports the queue depth in films and a histogram of flush latency. A
+    failed flush keeps its films queued and is retried with the next
+    batch; ``close`` returns the first error. Films the database stored
+    under another id, because another process took theirs, are written
+    under that id from then on.
+    """
+
+    def __init__(self, handler: 'DatabaseHandler') -> None:
+        self._handler = handler
+        self._cond = threading.Condition()
+        self._pending = Batch()
+        self._ready = False  # Something new to try since the last flush
+        self._busy = False
+        self._closed = False
+        self.error = SUCCESS
+        self.flush_times = Histogram()
+        self.films_written = 0
+        self.max_queued = 0
+        self._ids: Dict[int, int] = {}  # submitted id: stored id
+        self._thread = threading.Thread(target=self._run, name='filmix-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def submit(self, updates: Dict[int, Dict[str, Any]], appends: Iterable[Film] = (),
+               removed: Iterable[int] = ()) -> None:
+        """Queue a batch without waiting for it to be written.
+
+        The films and field dicts are handed over, callers must not
+        change them afterwards.
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('WriteBehind is closed')
+            self._pending.add(updates, appends, removed)
+            self.max_queued = max(self.max_queued, len(self._pending))
+            self._ready = True
+            self._cond.notify_all()
+
+    def flush(self) -> int:
+        """Wait until everything queued so far was written or failed."""
+        with self._cond:
+            while self._busy or (self._ready and len(self._pending)):
+                self._cond.wait()
+            return self.error
+
+    def close(self) -> int:
+        """Write what is queued, stop the thread, return the first error."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        return self.error
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not (self._ready or self._closed):
+                    self._cond.wait()
+                if not len(self._pending):
+                    if self._closed:
+                        return
+                    self._ready = False
+                    continue
+                batch, self._pending = self._pending, Batch()
+                self._ready = False
+                self._busy = True
+            start = time.perf_counter()
+            error = self._write(batch)
+            with self._cond:
+                self.flush_times.add(time.perf_counter() - start)
+                if error:
+                    self.error = self.error or error
+                    batch.merge(self._pending)
+                    self._pending = batch
+                    if self._closed:  # Already retried on close, give up
+                        self._busy = False
+                        self._cond.notify_all()
+                        return
+                else:
+                    self.films_written += len(batch)
+                self._busy = False
+                self._cond.notify_all()
+
+    def _write(self, batch: Batch) -> int:
+        """Write the batch in one merge; the batch is left as it was."""
+        ids = self._ids
+        appends = [film.copy() for film in batch.appends.values()]
+        error = self._handler.merge({ids.get(film_id, film_id): fields
+                                     for film_id, fields in batch.updates.items()},
+                                    appends,
+                                    [ids.get(film_id, film_id) for film_id in batch.removed])
+        if not error:
+            for film_id, film in zip(batch.appends, appends):
+                if film.id != film_id:
+                    ids[film_id] = film.id
+                else:
+                    ids.pop(film_id, None)  # A reused id, stored as it is
+        return error
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'queued': len(self._pending),
+                'max_queued': self.max_queued,
+                'films_written': self.films_written,
+                'error': self.error,
+                'flush': self.flush_times.as_dict(),
+            }
@@ -0,0 +1,171 @@
+"""Offline refresh benchmark against a local stub film server.
+
+    python -m tests.bench_filmix --films 100 10000 100000 --latency 0.005
+
+Each catalog is refreshed in a fresh process so peak RSS is per catalog.
+Reports throughput, p50/p99 fetch latency, peak RSS, database writes and
+the longest stall of the event loop.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Dict, List
+
+from filmix import database, extractors, filmix_lib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from tests.stub_server import StubFilmServer
+
+# How often the loop stall monitor wakes up
+LAG_TICK = 0.01
+
+
+class BenchTodoer(filmix_lib.Todoer):
+    """Todoer that records fetch latencies and counts database writes."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.latencies: List[float] = []
+        self.db_writes = Counter()
+        for name in ('write', 'update', 'append', 'delete', 'merge'):
+            setattr(self._db_handler, name, self._counted(name, getattr(self._db_handler, name)))
+
+    def _counted(self, name, method):
+        def counted(*args, **kwargs):
+            self.db_writes[name] += 1
+            return method(*args, **kwargs)
+        return counted
+
+    async def fetch_one_status(self, film, debug=False):
+        start = time.perf_counter()
+        try:
+            return await super().fetch_one_status(film, debug)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+async def refresh(todoer: filmix_lib.Todoer) -> float:
+    """Run one refresh, return the longest event loop stall in seconds."""
+    lag = 0.0
+
+    async def monitor() -> None:
+        nonlocal lag
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_TICK)
+            lag = max(lag, time.perf_counter() - start - LAG_TICK)
+
+    task = asyncio.ensure_future(monitor())
+    try:
+        await todoer.fetch_all_statuses()
+    finally:
+        task.cancel()
+    return lag
+
+
+def make_catalog(db_path: Path, base_url: str, films: int, backend: str) -> None:
+    catalog = [{'url': f'{base_url}/films/{film_id}.html',
+                'n_selector': 'h1.name',
+                'q_selector': 'div.quality'} for film_id in range(1, films + 1)]
+    database.init_database(db_path, True, backend)
+    database.DatabaseHandler(db_path, backend).write(catalog)
+
+
+def run_benchmark(films: int, base_url: str, backend: str = database.JSON_BACKEND,
+                  work_dir: str = '', **todoer_options) -> Dict[str, Any]:
+    """Refresh a synthetic catalog of ``films`` films once and measure it."""
+    with tempfile.TemporaryDirectory(dir=work_dir or None) as tmp:
+        db_path = Path(tmp) / f'bench.{backend}'
+        make_catalog(db_path, base_url, films, backend)
+        todoer = BenchTodoer(db_path, backend=backend, **todoer_options)
+        start = time.perf_counter()
+        lag = asyncio.run(refresh(todoer))
+        elapsed = time.perf_counter() - start
+        return {
+            'films': films,
+            'backend': backend,
+            'seconds': round(elapsed, 3),
+            'films_per_second': round(films / elapsed, 1),
+            'p50_ms': round(percentile(todoer.latencies, 50) * 1000, 2),
+            'p99_ms': round(percentile(todoer.latencies, 99) * 1000, 2),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'db_writes': dict(todoer.db_writes),
+            'max_loop_lag_ms': round(lag * 1000, 2),
+            'stats': dict(todoer.stats),
+        }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--films', type=int, nargs='+', default=[100, 10000, 100000])
+    parser.add_argument('--backend', default=database.JSON_BACKEND, choices=database.BACKENDS)
+    parser.add_argument('--extractor', default=extractors.FAST_BACKEND,
+                        choices=extractors.EXTRACTORS)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--parse-pool', action='store_true')
+    parser.add_argument('--parse-workers', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--flush-every', type=int, default=200)
+    parser.add_argument('--no-write-behind', dest='write_behind', action='store_false',
+                        help='write the database on the event loop')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random latency')
+    parser.add_argument('--body-kb', type=int, default=0, help='padding added to each page')
+    parser.add_argument('--throttle-every', type=int, default=0,
+                        help='answer every Nth request with 429')
+    parser.add_argument('--retry-after', type=int, default=0)
+    parser.add_argument('--json', dest='json_path', default='', help='also write results here')
+    args = parser.parse_args(argv)
+
+    server = StubFilmServer(latency=args.latency, jitter=args.jitter, body_kb=args.body_kb,
+                            throttle_every=args.throttle_every,
+                            retry_after=args.retry_after)
+    results = []
+    with server:
+        for films in args.films:
+            # One process per catalog keeps peak RSS comparable between sizes
+            with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+                result = pool.submit(run_benchmark, films, server.base_url, args.backend,
+                                     extractor=args.extractor, stream=args.stream,
+                                     parse_pool=args.parse_pool,
+                                     parse_workers=args.parse_workers,
+                                     concurrency=args.concurrency,
+                                     flush_every=args.flush_every,
+                                     write_behind=args.write_behind).result()
+            results.append(result)
+            print(f"{films:>7} films  {result['seconds']:>8.2f}s  "
+                  f"{result['films_per_second']:>8.1f} films/s  "
+                  f"p50 {result['p50_ms']:>7.2f}ms  p99 {result['p99_ms']:>7.2f}ms  "
+                  f"rss {result['peak_rss_mb']:>7.1f}MB  "
+                  f"lag {result['max_loop_lag_ms']:>7.2f}ms  writes {result['db_writes']}")
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
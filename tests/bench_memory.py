@@ -0,0 +1,59 @@
+"""Memory of a loaded film list: legacy string dicts vs Film records.
+
+    python -m tests.bench_memory --films 100000
+
+Builds a synthetic catalog in the legacy all-string format and measures,
+with tracemalloc, the list as parsed by ``json.load`` and as Films.
+"""
+import argparse
+import gc
+import json
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from filmix.film import Film
+
+QUALITIES = ('1080p', '720p', '4K UHD', 'TS', 'CAMRip', 'WEB-DL 1080p')
+
+
+def legacy_films(count: int) -> List[Dict[str, Any]]:
+    return [{
+        'url': f'https://filmix.example/film/{number}-film-{number}.html',
+        'n_selector': 'h1.name',
+        'q_selector': 'div.quality',
+        'name': f'Film number {number}',
+        'quality': QUALITIES[number % len(QUALITIES)],
+        'imdb': f'|{number % 90 / 10 + 1:.1f}|{number * 7 % 500000}',
+        'filmix_users_rating': str(number % 1000),
+        'last_checked': f'2024-{number % 12 + 1:02d}-{number % 28 + 1:02d}',
+        'next_due': 1700000000 + number,
+        'check_interval': 86400,
+    } for number in range(count)]
+
+
+def measure(build: Callable[[], Any]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--films', type=int, nargs='+', default=[100000])
+    args = parser.parse_args()
+    print(f"{'films':>8} {'dicts MB':>9} {'Films MB':>9} {'saved':>6}")
+    for count in args.films:
+        # Round-trip through JSON so strings are not shared with the generator
+        text = json.dumps(legacy_films(count))
+        dicts = measure(lambda: json.loads(text))
+        films = measure(lambda: [Film.from_dict(film) for film in json.loads(text)])
+        print(f"{count:>8} {dicts / 2 ** 20:>9.1f} {films / 2 ** 20:>9.1f} "
+              f"{1 - films / dicts:>6.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Local stand-in for a filmix mirror, used by the benchmarks and tests.
+
+Serves generated film pages at ``/films/<id>.html`` with optional latency,
+periodic 429 responses and padding to make bodies large.
+"""
+import asyncio
+import random
+import threading
+from typing import Optional
+
+from aiohttp import web
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="ru">
+<head><meta charset="utf-8"><title>Film {film_id}</title>
+<link rel="stylesheet" href="/templates/Filmix/css/main.css"></head>
+<body class="film-page">
+<div id="wrapper">
+<article class="fullstory">
+  <h1 class="name">Film {film_id}</h1>
+  <div class="quality" title="Фильм в высочайшем качестве">{quality}</div>
+  <span class="imdb_rating">
+{imdb}
+{votes}</span>
+  <div class="rateinf"><span class="ratePos">{rate_pos}</span> / <span class="rateNeg">{rate_neg}</span></div>
+</article>
+{padding}
+</div>
+</body>
+</html>
+"""
+QUALITIES = ('CAMRip', 'TS 1080', 'WEB-DL 720', 'HD 1080P', '4K UHD')
+PADDING_ROW = '<div class="comment"><span class="author">user</span><p>{text}</p></div>\n'
+
+
+def film_page(film_id: int, body_kb: int = 0) -> str:
+    rows = body_kb * 1024 // 128
+    padding = ''.join(PADDING_ROW.format(text='x' * 80) for _ in range(rows))
+    return PAGE_TEMPLATE.format(
+        film_id=film_id,
+        quality=QUALITIES[film_id % len(QUALITIES)],
+        imdb=f'{5 + film_id % 50 / 10:.1f}',
+        votes=1000 + film_id,
+        rate_pos=100 + film_id % 900,
+        rate_neg=film_id % 100,
+        padding=padding,
+    )
+
+
+class StubFilmServer:
+    """aiohttp app running on its own event loop in a background thread."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, body_kb: int = 0,
+                 throttle_every: int = 0, retry_after: int = 0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.body_kb = body_kb
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.served = 0
+        self.throttled = 0
+        self.base_url = ''
+        self._requests = 0
+        self._pages = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self._requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if self.throttle_every and self._requests % self.throttle_every == 0:
+            self.throttled += 1
+            return web.Response(status=429, headers={'Retry-After': str(self.retry_after)})
+        film_id = int(request.match_info['film_id'])
+        if film_id not in self._pages:
+            self._pages[film_id] = film_page(film_id, self.body_kb)
+        self.served += 1
+        return web.Response(text=self._pages[film_id], content_type='text/html')
+
+    async def _start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/films/{film_id:\\d+}.html', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.base_url = f'http://127.0.0.1:{self._runner.addresses[0][1]}'
+
+    def film_url(self, film_id: int) -> str:
+        return f'{self.base_url}/films/{film_id}.html'
+
+    def start(self) -> 'StubFilmServer':
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self) -> 'StubFilmServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,117 @@
+from pathlib import Path
+
+import pytest
+
+from filmix import extractors
+
+PAGES = sorted((Path(__file__).parent / 'pages').glob('*.html'))
+
+SELECTORS = [
+    'h1.name', 'div.quality', 'span.imdb_rating', 'span.imdb', 'span.ratePos',
+    'span.rateNeg', 'div.full-story', 'div.origin-name', 'section span.deep',
+    'div > span', '.a.b[data-id="7"]', '#main span', 'span.tpl', 'p.unclosed',
+    'div.stray', 'div.empty', 'span.last', 'li.comment p', 'template span',
+    'img.poster', 'article div.quality', 'title', 'style', 'script', 'body',
+    'div.quality:not(.x)', 'h1.name, div.quality',
+]
+
+FILM_FIELDS = {
+    'name': ('h1.name',),
+    'imdb': ('span.imdb_rating', 'span.imdb'),
+    'rate_pos': ('span.ratePos',),
+    'rate_neg': ('span.rateNeg',),
+    'quality': ('div.quality',),
+}
+
+
+def _fields():
+    return {selector: (selector,) for selector in SELECTORS}
+
+
+@pytest.mark.parametrize('page', PAGES, ids=lambda page: page.name)
+def test_backend_parity(page):
+    html = page.read_text()
+    fast = extractors.extract(html, _fields(), extractors.FAST_BACKEND)
+    soup = extractors.extract(html, _fields(), extractors.SOUP_BACKEND)
+    assert fast == soup
+
+
+@pytest.mark.parametrize('page', PAGES, ids=lambda page: page.name)
+def test_film_fields_parity(page):
+    html = page.read_text()
+    fast = extractors.extract(html, FILM_FIELDS, extractors.FAST_BACKEND)
+    soup = extractors.extract(html, FILM_FIELDS, extractors.SOUP_BACKEND)
+    assert fast == soup
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 512])
+@pytest.mark.parametrize('page', PAGES, ids=lambda page: page.name)
+def test_incremental_feed_parity(page, chunk_size):
+    html = page.read_text()
+    fields = {selector: (selector,) for selector in SELECTORS[:25]}
+    extractor = extractors.FastExtractor(fields)
+    for start in range(0, len(html), chunk_size):
+        extractor.feed(html[start:start + chunk_size])
+    extractor.close()
+    assert extractor.results() == extractors.extract(html, fields, extractors.SOUP_BACKEND)
+
+
+def test_stops_once_fields_found():
+    extractor = extractors.FastExtractor({'name': ('h1.name',)})
+    extractor.feed('<html><body><h1 class="name">Film</h1><div>')
+    assert extractor.done
+    assert extractor.results()['name'] == extractors.Match('Film', {'class': 'name'})
+
+
+@pytest.mark.parametrize('selector', ['div:first-child', 'a, b', '> a', 'a >', 'a + b', ''])
+def test_unsupported_selectors(selector):
+    with pytest.raises(extractors.UnsupportedSelector):
+        extractors.compile_selector(selector)
+
+
+def test_site_plugins_by_host():
+    from filmix import sites
+    assert type(sites.for_url('https://filmix.ac/films/1.html')) is sites.FilmixExtractor
+    assert type(sites.for_url('https://www.hdkinoteatr.com/f/1')) is sites.HdKinoteatrExtractor
+    assert sites.for_url('https://filmix.ac/a') is sites.for_url('https://filmix.ac/b')
+
+
+def test_hdkinoteatr_plugin_page():
+    from filmix import sites
+    html = (Path(__file__).parent / 'pages' / 'hdkinoteatr_film.html').read_text()
+    plugin = sites.for_url('https://hdkinoteatr.com/film/1')
+    film = {'url': 'https://hdkinoteatr.com/film/1', 'q_selector': 'div.missing'}
+    found = extractors.extract(html, plugin.film_fields(film))
+    assert plugin.apply(film, found)
+    assert film['name'] == 'Джон Уик 4'
+    assert film['imdb'] == '8.1|201455'
+    assert film['filmix_users_rating'] == '1165'
+    assert film['quality'] == 'HD 720P'
+
+
+def test_register_site_plugin():
+    from filmix import sites
+
+    class MirrorExtractor(sites.SiteExtractor):
+        hosts = ('*.mirror.test',)
+        quality_selector = 'span.q'
+
+    sites.register(MirrorExtractor)
+    try:
+        plugin = sites.for_url('https://films.mirror.test/1')
+        assert isinstance(plugin, MirrorExtractor)
+        film = {'url': 'https://films.mirror.test/1'}
+        found = extractors.extract('<h1 class="name">A</h1><span class="q">4K</span>',
+                                   plugin.film_fields(film))
+        assert plugin.apply(film, found)
+        assert film == {'url': 'https://films.mirror.test/1', 'name': 'A', 'quality': '4K'}
+    finally:
+        sites._registry.remove(MirrorExtractor)
+        sites.for_host.cache_clear()
+
+
+def test_selectors_compiled_once():
+    extractors.compile_selector.cache_clear()
+    for _ in range(3):
+        extractors.extract('<div class="quality">HD</div>', FILM_FIELDS)
+    assert extractors.compile_selector.cache_info().misses == 6
@@ -1,3 +1,5 @@
+import datetime
+import time
 import asyncio
 from os import read
 from typer.testing import CliRunner
@@ -7,7 +9,8 @@ from filmix import (
     cli,
 )
 
-from filmix import SUCCESS, app_name, version, filmix_lib
+from filmix import SUCCESS, DUPLICATE_ERROR, ID_ERROR, WORKERS_ERROR, app_name, version, filmix_lib, database
+from filmix.film import Film
 runner = CliRunner()
 tmp_path = '/tests'
 
@@ -61,11 +64,15 @@ test_data2 = {'url': 'https://filmix.ac/films/fjuntezia/164933-podzemelya-i-drak
 )
 def test_add(mock_json_file, url, n_selector, q_selector, expected, expected_key):
     todoer = filmix_lib.Todoer(mock_json_file)
+    # The fixture already holds this url
+    assert todoer.add(url=url, n_selector=n_selector, q_selector=q_selector).error == DUPLICATE_ERROR
+    url = url.replace('164933', '164934')
     film = todoer.add(url=url, n_selector=n_selector, q_selector=q_selector)
     assert film.todo.get(expected_key) == expected
     film_list = todoer.get_film_list()
     assert len(film_list) == 2
     assert film.todo.get('url') == url
+    assert film.todo.get('id') == 2
 
 
 def test_remove(mock_json_file):
@@ -73,10 +80,15 @@ def test_remove(mock_json_file):
     todoer.add(url='test', n_selector='test', q_selector='test')
     film_list = todoer.get_film_list()
     assert len(film_list) == 2
-    film = todoer.remove(0)
+    assert todoer.remove(0).error == ID_ERROR
+    film = todoer.remove(1)
     assert film.error == SUCCESS
     film_list = todoer.get_film_list()
     assert len(film_list) == 1
+    # The remaining film keeps its id
+    assert film_list[0].get('id') == 2
+    assert todoer.remove('test').error == SUCCESS
+    assert todoer.get_film_list() == []
 
 
 def test_remove_all(mock_json_file):
@@ -99,9 +111,1023 @@ def test_change(mock_json_file):
     assert read.todo_list[0].get('quality') == 'HD 1080P'
 
 
+def test_change_stores_zero(mock_json_file):
+    todoer = filmix_lib.Todoer(mock_json_file)
+    film = todoer.find(1).todo
+    film['filmix_users_rating'] = '0'  # As the extractor sets it for ratePos == rateNeg
+    assert todoer.change(1, **film).error == SUCCESS
+    assert todoer.find(1).todo.filmix_users_rating == 0
+    todoer.change(1, name='', quality=None)  # Options not given on the command line
+    assert todoer.find(1).todo.name == test_data1['name']
+
+
+@pytest.mark.parametrize('backend', [database.JSON_BACKEND, database.SQLITE_BACKEND,
+                                     database.JOURNAL_BACKEND])
+def test_change_of_selector_drops_validators(tmp_path, backend):
+    db_path = tmp_path / f'films.{backend}'
+    database.init_database(db_path, True, backend)
+    todoer = filmix_lib.Todoer(db_path, backend=backend)
+    todoer.add(url='https://filmix.ac/films/1')
+    todoer.change(1, etag='"abc"', last_modified='Mon, 01 Jan 2024 00:00:00 GMT',
+                  content_hash='0123')
+    todoer.change(1, name='Renamed')
+    assert filmix_lib.Todoer(db_path, backend=backend).find(1).todo.content_hash == '0123'
+    assert todoer.change(1, q_selector='span.q2').error == SUCCESS
+    film = filmix_lib.Todoer(db_path, backend=backend).find(1).todo
+    assert (film.q_selector, film.etag, film.last_modified, film.content_hash) == (
+        'span.q2', None, None, None)
+
+
 def test_set_headers_ip(mock_json_file):
     todoer = filmix_lib.Todoer(mock_json_file)
     ip_headers = todoer.set_random_headers()
     assert 'X-Forwarded-For' in ip_headers
     assert 'X-Remote-IP' in ip_headers
 
+
+
+FILM_PAGE = """<html><body>
+<h1 class="name">Test Film</h1>
+<div class="quality">HD 1080</div>
+<span class="imdb_rating">
+7.5
+53966</span>
+<span class="ratePos">600</span><span class="rateNeg">33</span>
+</body></html>"""
+
+
+async def _start_film_server(handler):
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def test_fetch_reuses_session_connection(mock_json_file):
+    from aiohttp import web
+    peers = []
+
+    async def handler(request):
+        peers.append(request.transport.get_extra_info('peername'))
+        return web.Response(text=FILM_PAGE, content_type='text/html')
+
+    async def run():
+        runner, base = await _start_film_server(handler)
+        todoer = filmix_lib.Todoer(mock_json_file)
+        try:
+            async with todoer.create_session() as session:
+                todoer._session = session
+                for idx in range(3):
+                    page = await todoer.fetch_one_status({'url': f'{base}/films/{idx}'})
+                    assert 'Test Film' in page.text
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    assert len(peers) == 3
+    assert len(set(peers)) == 1
+
+
+def test_batch_writes_once(mock_json_file, monkeypatch):
+    todoer = filmix_lib.Todoer(mock_json_file)
+    writes = []
+    original_merge = todoer._db_handler.merge
+    monkeypatch.setattr(todoer._db_handler, 'merge',
+                        lambda *changes: writes.append(1) or original_merge(*changes))
+    with todoer.batch():
+        todoer.add(url='test1', n_selector='test1', q_selector='test1')
+        todoer.change(1, name='New Name', quality='HD 1080P')
+        todoer.change(2, name='Second')
+        assert writes == []
+    assert len(writes) == 1
+    film_list = todoer.get_film_list()
+    assert film_list[0].get('quality') == 'HD 1080P'
+    assert film_list[1].get('name') == 'Second'
+
+
+@pytest.mark.parametrize('write_behind', [False, True])
+def test_batch_reports_failed_final_write(mock_json_file, monkeypatch, write_behind):
+    from filmix import DB_BUSY_ERROR, ERRORS
+    todoer = filmix_lib.Todoer(mock_json_file)
+    monkeypatch.setattr(todoer._db_handler, 'merge', lambda *changes: DB_BUSY_ERROR)
+    with todoer.batch(write_behind=write_behind) as uow:
+        todoer.change(1, name='Lost')
+    assert uow.write_error == todoer.write_error == DB_BUSY_ERROR
+    assert ERRORS[DB_BUSY_ERROR] in todoer.summary()
+
+
+def test_batch_flush_every(mock_json_file):
+    todoer = filmix_lib.Todoer(mock_json_file)
+    with todoer.batch(flush_every=2) as uow:
+        todoer.change(1, name='One')
+        todoer.change(1, name='Two')
+        assert uow.commits == 1
+        assert todoer._db_handler.read().todo_list[0].get('name') == 'Two'
+        todoer.change(1, name='Three')
+    assert uow.commits == 2
+    assert not mock_json_file.with_name(mock_json_file.name + '.tmp').exists()
+
+
+@pytest.mark.parametrize('backend', [database.JSON_BACKEND, database.JOURNAL_BACKEND])
+def test_batch_keeps_unreadable_file(mock_json_file, backend):
+    from filmix import JSON_ERROR
+    handler = database.DatabaseHandler(mock_json_file, backend)
+    with handler.unit_of_work() as uow:
+        mock_json_file.write_text('[{"url": ')  # Being edited by hand
+        uow.update(1, {'name': 'One'})
+        assert uow.commit() == JSON_ERROR
+        assert uow.pending == 1
+        assert mock_json_file.read_text() == '[{"url": '
+        mock_json_file.write_text(json.dumps([test_data1]))
+    assert handler.read().todo_list[0].name == 'One'
+
+
+def test_write_behind(mock_json_file, monkeypatch):
+    import threading
+    import time
+    todoer = filmix_lib.Todoer(mock_json_file)
+    todoer.add(url='test1', n_selector='test1', q_selector='test1')
+    release = threading.Event()
+    writes = []
+    original_merge = todoer._db_handler.merge
+
+    def merge(updates, appends, removed):
+        release.wait(5)
+        writes.append((threading.current_thread().name,
+                       {film_id: fields['name'] for film_id, fields in updates.items()}))
+        return original_merge(updates, appends, removed)
+
+    monkeypatch.setattr(todoer._db_handler, 'merge', merge)
+    with todoer.batch(flush_every=1, write_behind=True) as uow:
+        todoer.change(1, name='One')
+        while uow.writer.queued:  # Taken by the writer, which blocks
+            time.sleep(0.001)
+        todoer.change(1, name='Two')
+        todoer.change(1, name='Three')
+        todoer.change(2, name='Second')
+        assert uow.writer.queued == 2
+        release.set()
+    assert writes == [('filmix-writer', {1: 'One'}),
+                      ('filmix-writer', {1: 'Three', 2: 'Second'})]
+    assert todoer.writer.films_written == 3
+    assert todoer.writer.max_queued == 2
+    assert todoer.writer.flush_times.count == 2
+    assert todoer.writer.error == SUCCESS
+    assert [film['name'] for film in todoer.get_film_list()] == ['Three', 'Second']
+
+
+@pytest.fixture
+def mock_sqlite_file(mock_json_file, tmp_path):
+    db_file = tmp_path / "filmix.sqlite"
+    migrated = database.migrate_json(mock_json_file, db_file)
+    assert migrated.error == SUCCESS
+    return db_file
+
+
+def test_sqlite_migrate(mock_json_file, mock_sqlite_file):
+    todoer = filmix_lib.Todoer(mock_sqlite_file, backend=database.SQLITE_BACKEND)
+    legacy = json.loads(mock_json_file.read_text())
+    assert todoer.get_film_list() == [{**film, 'id': 1} for film in legacy]
+
+
+def test_sqlite_crud(mock_sqlite_file):
+    todoer = filmix_lib.Todoer(mock_sqlite_file, backend=database.SQLITE_BACKEND)
+    todoer.add(url='test1', n_selector='test1', q_selector='test1')
+    todoer.add(url='test2', n_selector='test2', q_selector='test2')
+    film = todoer.change(2, name='Second', last_checked='2023-04-01')
+    assert film.error == SUCCESS
+    assert film.todo.get('url') == 'test1'
+    assert todoer.change(4, name='Missing').error == ID_ERROR
+    film = todoer.remove(1)
+    assert film.error == SUCCESS
+    film_list = todoer.get_film_list()
+    assert [film.get('url') for film in film_list] == ['test1', 'test2']
+    assert film_list[0].get('name') == 'Second'
+    with todoer.batch():
+        todoer.change(2, quality='HD 720P')
+        todoer.add(url='test3', n_selector='test3', q_selector='test3')
+    # Ids survive the removal: 2 is still test1
+    assert todoer.get_film_list()[0].get('quality') == 'HD 720P'
+    assert len(todoer.get_film_list()) == 3
+    todoer.remove_all()
+    assert todoer.get_film_list() == []
+
+
+def test_read_cache(mock_json_file):
+    todoer = filmix_lib.Todoer(mock_json_file)
+    first = todoer.get_film_list()
+    first[0]['name'] = 'Mutated by caller'
+    second = todoer.get_film_list()
+    assert second[0].get('name') == test_data1['name']
+    assert todoer.cache_info() == (1, 1)
+    other = filmix_lib.Todoer(mock_json_file)
+    other.change(1, name='Changed elsewhere')
+    assert todoer.get_film_list()[0].get('name') == 'Changed elsewhere'
+    assert todoer.cache_info().misses == 2
+
+
+def test_journal_backend(mock_json_file):
+    todoer = filmix_lib.Todoer(mock_json_file, backend=database.JOURNAL_BACKEND)
+    snapshot = mock_json_file.read_text()
+    todoer.add(url='test1', n_selector='test1', q_selector='test1')
+    todoer.change(2, name='Second')
+    todoer.remove(1)
+    assert mock_json_file.read_text() == snapshot
+    journal = mock_json_file.with_name(mock_json_file.name + '.journal')
+    assert len(journal.read_text().splitlines()) == 4
+    # Crash in the middle of an append
+    with journal.open('a') as tail:
+        tail.write('{"op": "append", "fil')
+    reopened = filmix_lib.Todoer(mock_json_file, backend=database.JOURNAL_BACKEND)
+    film_list = reopened.get_film_list()
+    assert [film.get('name') for film in film_list] == ['Second']
+    reopened.change(2, quality='HD 720P')
+    assert filmix_lib.Todoer(mock_json_file, backend=database.JOURNAL_BACKEND) \
+        .get_film_list()[0].get('quality') == 'HD 720P'
+
+
+def test_journal_compaction(mock_json_file):
+    backend = database.JournalBackend(mock_json_file, compact_bytes=256)
+    for idx in range(10):
+        assert backend.append([{'url': f'test{idx}'}]) == SUCCESS
+    backend.wait_compaction()
+    journal = mock_json_file.with_name(mock_json_file.name + '.journal')
+    assert journal.stat().st_size < 256
+    assert len(json.loads(mock_json_file.read_text())) >= 5
+    assert len(database.JournalBackend(mock_json_file).read().todo_list) == 11
+
+
+def test_journal_ignores_folded_journal(mock_json_file):
+    backend = database.JournalBackend(mock_json_file)
+    backend.append([{'url': 'test1'}])
+    journal = mock_json_file.with_name(mock_json_file.name + '.journal')
+    old_journal = journal.read_text()
+    backend.compact()
+    # Crash after the snapshot was replaced but before the journal was reset
+    journal.write_text(old_journal)
+    assert len(database.JournalBackend(mock_json_file).read().todo_list) == 2
+
+
+def test_conditional_fetch(mock_json_file, monkeypatch):
+    from aiohttp import web
+    requests = []
+
+    async def handler(request):
+        requests.append(dict(request.headers))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text=FILM_PAGE, content_type='text/html',
+                            headers={'ETag': '"v1"',
+                                     'Last-Modified': 'Sat, 01 Apr 2023 10:00:00 GMT'})
+
+    async def run():
+        runner, base = await _start_film_server(handler)
+        todoer = filmix_lib.Todoer(mock_json_file)
+        todoer.change(1, url=f'{base}/films/1')
+        try:
+            film = todoer.get_film_list()[0]
+            await todoer.get_status(film, 1)
+            stored = todoer.get_film_list()[0]
+            assert stored.get('etag') == '"v1"'
+            assert stored.get('quality') == 'HD 1080'
+            changes = []
+            monkeypatch.setattr(todoer, 'change', lambda *args, **kwargs: changes.append(args))
+            await todoer.get_status(stored, 1)
+            assert changes == []
+            interval = todoer.get_film_list()[0]['check_interval']
+            assert interval == 2 * filmix_lib.scheduler.DEFAULT_INTERVAL
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    assert 'If-None-Match' not in requests[0]
+    assert requests[1]['If-None-Match'] == '"v1"'
+    assert requests[1]['If-Modified-Since'] == 'Sat, 01 Apr 2023 10:00:00 GMT'
+
+
+def test_unchanged_content_skipped(mock_json_file, monkeypatch):
+    from aiohttp import web
+
+    async def handler(request):
+        return web.Response(text=FILM_PAGE, content_type='text/html')
+
+    async def run():
+        runner, base = await _start_film_server(handler)
+        todoer = filmix_lib.Todoer(mock_json_file)
+        todoer.change(1, url=f'{base}/films/1')
+        try:
+            await todoer.get_status(todoer.get_film_list()[0], 1)
+            stored = todoer.get_film_list()[0]
+            assert stored.get('content_hash')
+            monkeypatch.setattr(filmix_lib.extractors, 'extract', None)
+            await todoer.get_status(stored, 1)
+        finally:
+            await runner.cleanup()
+        return todoer
+
+    todoer = asyncio.run(run())
+    assert todoer.stats['updated'] == 1
+    assert todoer.stats['unchanged'] == 1
+    assert '1 unchanged' in todoer.summary()
+
+
+def test_streaming_stops_early(mock_json_file):
+    from aiohttp import web
+    padding = '<div class="comment">' + 'x' * 1024 + '</div>\n'
+    big_page = FILM_PAGE.replace('</body>', padding * 4096 + '</body>')
+
+    async def handler(request):
+        return web.Response(text=big_page, content_type='text/html')
+
+    async def run():
+        runner, base = await _start_film_server(handler)
+        todoer = filmix_lib.Todoer(mock_json_file, stream=True)
+        todoer.change(1, url=f'{base}/films/1')
+        try:
+            film = dict(todoer.get_film_list()[0], name='')
+            page = await todoer.fetch_one_status(film)
+        finally:
+            await runner.cleanup()
+        return todoer, page
+
+    todoer, page = asyncio.run(run())
+    assert todoer.stats['stopped_early'] == 1
+    assert page.found['name'].text == 'Test Film'
+    assert page.found['quality'].text == 'HD 1080'
+    assert page.found['rate_pos'].text == '600'
+
+
+def test_benchmark_smoke(tmp_path):
+    from tests.bench_filmix import run_benchmark
+    from tests.stub_server import StubFilmServer
+    with StubFilmServer() as server:
+        result = run_benchmark(20, server.base_url, work_dir=str(tmp_path))
+    assert server.served == 20
+    assert result['stats']['updated'] == 20
+    assert result['db_writes'] == {'merge': 1}
+    assert result['p99_ms'] >= result['p50_ms'] > 0
+
+
+def test_profiler_stages(tmp_path):
+    from filmix import profiling
+    from tests.bench_filmix import run_benchmark
+    from tests.stub_server import StubFilmServer
+    profiler = profiling.Profiler()
+    with StubFilmServer() as server:
+        run_benchmark(5, server.base_url, work_dir=str(tmp_path), profiler=profiler)
+    timings = profiler.as_dict()
+    for name in ('connect', 'ttfb', 'download', 'parse', 'change', 'db_write'):
+        assert timings[name]['count'] > 0
+    assert timings['ttfb']['count'] == 5
+    assert 'ttfb' in profiler.report()
+    profiler.write_json(tmp_path / 'profile.json')
+    assert json.loads((tmp_path / 'profile.json').read_text())['parse']['count'] == 5
+
+
+def test_parse_pool(tmp_path):
+    from tests.bench_filmix import run_benchmark
+    from tests.stub_server import StubFilmServer
+    with StubFilmServer() as server:
+        result = run_benchmark(8, server.base_url, work_dir=str(tmp_path),
+                               parse_pool=True, parse_workers=2)
+    assert result['stats']['updated'] == 8
+    assert result['db_writes'] == {'merge': 1}
+
+
+# Modules only the fetch path needs; importing the CLI must not pull them in
+FETCH_ONLY_MODULES = ('aiohttp', 'asyncio', 'bs4', 'soupsieve', 'fake_useragent')
+CLI_IMPORT_BUDGET_MS = 250
+
+
+def test_cli_startup_is_lazy():
+    import subprocess
+    import sys
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import filmix.cli'],
+                            capture_output=True, text=True, check=True)
+    imported = {line.split('|')[-1].strip(): int(line.split('|')[1])
+                for line in result.stderr.splitlines() if line.startswith('import time:')
+                and not line.split('|')[1].strip().startswith('cumulative')}
+    assert not [name for name in FETCH_ONLY_MODULES if name in imported]
+    assert imported['filmix.cli'] / 1000 < CLI_IMPORT_BUDGET_MS
+
+
+def test_scheduler_adapts_interval():
+    from filmix import scheduler
+    film = {'quality': 'TS', 'imdb': '|7.5|100'}
+    scheduler.reschedule(film, False, now=0)
+    assert film['check_interval'] == scheduler.DEFAULT_INTERVAL
+    scheduler.reschedule(film, False, now=0)
+    assert film['check_interval'] == 2 * scheduler.DEFAULT_INTERVAL
+    assert film['next_due'] == 2 * scheduler.DEFAULT_INTERVAL
+    for _ in range(10):
+        scheduler.reschedule(film, True, now=0)
+    assert film['check_interval'] == scheduler.MIN_INTERVAL
+    scheduler.reschedule(film, None, now=0)
+    assert film['check_interval'] == scheduler.MIN_INTERVAL
+    assert film['next_due'] == scheduler.RETRY_INTERVAL
+    seen = scheduler.tracked(film)
+    film['imdb'] = '|7.5|101'
+    assert scheduler.tracked(film) == seen
+    film['quality'] = 'HD 1080'
+    assert scheduler.tracked(film) != seen
+
+
+def test_scheduler_due_order():
+    from filmix import scheduler
+    films = [{'next_due': 300}, {'next_due': 50}, {'last_checked': '2023-04-01'},
+             {}, {'next_due': 10 ** 12}]
+    due = scheduler.due_films(films, now=1000)
+    assert [film_id for film_id, _ in due] == [4, 2, 1]
+    due = scheduler.due_films(films, now=10 ** 11)
+    assert [film_id for film_id, _ in due] == [4, 2, 1, 3]
+
+
+def test_fetch_budget(tmp_path):
+    from tests.bench_filmix import run_benchmark
+    from tests.stub_server import StubFilmServer
+    with StubFilmServer() as server:
+        result = run_benchmark(10, server.base_url, work_dir=str(tmp_path), budget=4)
+    assert server.served == 4
+    assert result['stats']['fetched'] == 4
+
+
+def test_fetch_pipeline_is_bounded(tmp_path):
+    from aiohttp import web
+    from tests.bench_filmix import make_catalog
+    in_flight = []
+    peak = []
+
+    async def handler(request):
+        in_flight.append(request)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(request)
+        return web.Response(text=FILM_PAGE, content_type='text/html')
+
+    async def run():
+        runner, base = await _start_film_server(handler)
+        db_path = tmp_path / 'films.json'
+        make_catalog(db_path, base, 30, database.JSON_BACKEND)
+        todoer = filmix_lib.Todoer(db_path, concurrency=3)
+        try:
+            await todoer.fetch_all_statuses()
+        finally:
+            await runner.cleanup()
+        return todoer
+
+    todoer = asyncio.run(run())
+    assert todoer.stats['updated'] == 30
+    assert len(peak) == 30
+    assert max(peak) == 3
+
+
+def test_retry_after_parsing():
+    from filmix.ratelimit import parse_retry_after
+    assert parse_retry_after(None, 30) == 30
+    assert parse_retry_after('', 30) == 30
+    assert parse_retry_after('5', 30) == 5
+    assert parse_retry_after('soon', 30) == 30
+    assert parse_retry_after('Sat, 01 Apr 2023 10:00:00 GMT', 30) == 0
+
+
+def test_host_limiter_paces_and_pauses():
+    import time
+    from filmix.ratelimit import HostLimiter
+
+    async def run():
+        limiter = HostLimiter(rate=50, burst=1)
+        start = time.monotonic()
+        for _ in range(5):
+            await limiter.acquire('http://filmix.ac/films/1')
+        paced = time.monotonic() - start
+        await limiter.acquire('http://other.host/films/1')
+        assert time.monotonic() - start - paced < 0.01
+        limiter.pause('http://filmix.ac/films/2', 0.1)
+        start = time.monotonic()
+        await limiter.acquire('http://filmix.ac/films/3')
+        return paced, time.monotonic() - start
+
+    paced, paused = asyncio.run(run())
+    assert paced >= 0.07
+    assert paused >= 0.09
+
+
+def test_fetch_retries_throttled_and_failing_hosts(tmp_path):
+    from aiohttp import web
+    from filmix.ratelimit import RateLimits
+    from tests.bench_filmix import make_catalog
+    hits = []
+
+    async def handler(request):
+        hits.append(request.path)
+        if request.path.endswith('/9.html'):
+            return web.Response(status=503)
+        if hits.count(request.path) == 1:
+            return web.Response(status=429)  # No Retry-After header
+        return web.Response(text=FILM_PAGE, content_type='text/html')
+
+    async def run():
+        runner, base = await _start_film_server(handler)
+        db_path = tmp_path / 'films.json'
+        make_catalog(db_path, base, 9, database.JSON_BACKEND)
+        limits = RateLimits(retries=2, backoff_base=0.001, default_retry_after=0.01)
+        todoer = filmix_lib.Todoer(db_path, concurrency=3, limits=limits)
+        try:
+            await todoer.fetch_all_statuses()
+        finally:
+            await runner.cleanup()
+        return todoer, base
+
+    todoer, base = asyncio.run(run())
+    assert todoer.stats['updated'] == 8
+    assert todoer.stats['throttled'] == 8
+    assert todoer.skipped == [f'{base}/films/9.html']
+    assert hits.count('/films/9.html') == 3
+    summary = todoer.summary()
+    assert 'Throttled 8 times by 127.0.0.1' in summary
+    assert f'{base}/films/9.html' in summary
+
+
+def test_serve_api(mock_json_file):
+    import aiohttp
+    from aiohttp import web
+    from filmix import profiling, server
+    from tests.stub_server import StubFilmServer
+
+    async def run(film_url):
+        todoer = filmix_lib.Todoer(mock_json_file, profiler=profiling.Profiler())
+        todoer.remove_all()
+        runner = web.AppRunner(server.create_app(todoer, max_idle=0.1))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        base = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        try:
+            async with aiohttp.ClientSession() as client:
+                async with client.post(f'{base}/films', json={'url': film_url}) as resp:
+                    assert resp.status == 201
+                async with client.post(f'{base}/films', json={'url': film_url + '/'}) as resp:
+                    assert resp.status == 409
+                    # Id 1 went to the film cleared above and is not given out again
+                    assert (await resp.json())['film']['id'] == 2
+                for _ in range(50):
+                    async with client.get(f'{base}/films') as resp:
+                        films = (await resp.json())['films']
+                    if films[0].get('quality'):
+                        break
+                    await asyncio.sleep(0.1)
+                async with client.get(f'{base}/metrics') as resp:
+                    metrics = await resp.json()
+                async with client.post(f'{base}/refresh') as resp:
+                    assert resp.status == 202
+                async with client.post(f'{base}/films', data='nope') as resp:
+                    assert resp.status == 400
+                async with client.delete(f'{base}/films/1') as resp:
+                    assert resp.status == 404
+                async with client.delete(f'{base}/films/2') as resp:
+                    assert resp.status == 200
+                async with client.get(f'{base}/films') as resp:
+                    assert (await resp.json())['films'] == []
+        finally:
+            await runner.cleanup()
+        return films, metrics
+
+    with StubFilmServer() as stub:
+        films, metrics = asyncio.run(run(stub.film_url(1)))
+    assert films[0]['id'] == 2
+    assert films[0]['name'] == 'Film 1'
+    assert films[0]['next_due'] > 0
+    assert metrics['films'] == 1
+    assert metrics['runs'] >= 1
+    assert metrics['last_run']['stats']['updated'] == 1
+    assert metrics['stages']['ttfb']['count'] >= 1
+    assert metrics['writer']['films_written'] >= 1
+    assert metrics['writer']['flush']['count'] >= 1
+
+
+def test_serve_removes_during_refresh(mock_json_file):
+    import aiohttp
+    from aiohttp import web
+    from filmix import server
+    from tests.stub_server import StubFilmServer
+
+    async def run(film_urls):
+        todoer = filmix_lib.Todoer(mock_json_file, concurrency=1)
+        todoer.remove_all()
+        ids = [todoer.add(url=url).todo.id for url in film_urls]
+        service = web.AppRunner(server.create_app(todoer, max_idle=60))
+        await service.setup()
+        await web.TCPSite(service, '127.0.0.1', 0).start()
+        base = f'http://127.0.0.1:{service.addresses[0][1]}'
+        try:
+            async with aiohttp.ClientSession() as client:
+                while not todoer.stats['fetched']:  # Half way through the run
+                    await asyncio.sleep(0.01)
+                started = time.monotonic()
+                async with client.delete(f'{base}/films/{ids[3]}') as resp:
+                    assert resp.status == 200
+                removed_in = time.monotonic() - started
+                runs = 0
+                while not runs:
+                    await asyncio.sleep(0.05)
+                    async with client.get(f'{base}/metrics') as resp:
+                        runs = (await resp.json())['runs']
+        finally:
+            await service.cleanup()
+        return ids, removed_in
+
+    with StubFilmServer(latency=0.2) as stub:
+        ids, removed_in = asyncio.run(run([stub.film_url(n) for n in range(1, 6)]))
+    assert removed_in < 0.2  # Not held up until the run ends
+    films = filmix_lib.Todoer(mock_json_file).get_film_list()
+    assert [film.id for film in films] == ids[:3] + ids[4:]
+    assert all(film.name for film in films)
+
+
+def test_history_records_changes_only(mock_json_file):
+    from filmix.history import History
+    film = dict(test_data1)
+    history = History(mock_json_file)
+    run = history.start_run(now=1000)
+    assert history.record(film, run, now=1000)
+    history.flush()
+    run = history.start_run(now=2000)
+    assert not history.record(dict(film, imdb='|7.5|54000'), run, now=2000)
+    assert history.record(dict(film, quality='HD 1080P'), run, now=2000)
+    history.flush()
+    assert (mock_json_file.parent / 'filmix.json.history' / 'film.col').stat().st_size == 16
+
+    history = History(mock_json_file)
+    assert history.runs() == [1000, 2000]
+    rows = history.for_url(film['url'])
+    assert [row.quality for row in rows] == ['TS 1080', 'HD 1080P']
+    assert rows[0].imdb == 7.5 and rows[0].votes == 53966 and rows[0].rating == 567
+    before, after = history.changed_in_run([film['url'], 'https://filmix.ac/films/2'])[film['url']]
+    assert (before.quality, after.quality) == ('TS 1080', 'HD 1080P')
+    assert not history.record(dict(film, quality='HD 1080P'), history.start_run())
+
+
+def test_history_skips_values_out_of_range(mock_json_file):
+    from filmix.film import Film
+    from filmix.history import History
+    url = 'https://filmix.ac/films/1'
+    history = History(mock_json_file)
+    run = history.start_run(now=1000)
+    # No score, only a vote count: the votes are not taken for the score
+    assert history.record(Film.from_dict({'url': url, 'imdb': '|N/A|12345'}), run, now=1000)
+    assert history.record({'url': url, 'quality': 'TS', 'imdb': 10 ** 6,
+                           'imdb_votes': 2 ** 40, 'filmix_users_rating': 10 ** 12}, run)
+    history.flush()
+    rows = History(mock_json_file).for_url(url)
+    assert [(row.quality, row.imdb, row.votes, row.rating) for row in rows] == [
+        (None, None, 12345, None), ('TS', None, 0, None)]
+
+
+def test_history_shared_by_processes(mock_json_file):
+    from filmix.history import History
+    first, second = History(mock_json_file), History(mock_json_file)
+    first.runs(), second.runs()  # Both loaded before either wrote
+    runs = [first.start_run(now=1000), second.start_run(now=2000)]
+    assert runs == [0, 1]
+    first.record({'url': 'https://filmix.ac/films/1', 'quality': 'TS'}, runs[0])
+    second.record({'url': 'https://filmix.ac/films/2', 'quality': 'HD'}, runs[1])
+    second.record({'url': 'https://filmix.ac/films/3', 'quality': 'TS'}, runs[1])
+    first.flush()
+    second.flush()
+    assert not second.record({'url': 'https://filmix.ac/films/3', 'quality': 'TS'}, runs[1])
+    history = History(mock_json_file)
+    assert history.runs() == [1000, 2000]
+    assert [(row.run, row.quality) for n in (1, 2, 3)
+            for row in history.for_url(f'https://filmix.ac/films/{n}')] == [
+        (0, 'TS'), (1, 'HD'), (1, 'TS')]
+    assert [row.quality for row in second.for_url('https://filmix.ac/films/3')] == ['TS']
+
+
+def test_fetch_records_history(mock_json_file):
+    from filmix.history import History
+    from tests.stub_server import StubFilmServer
+    with StubFilmServer() as server:
+        todoer = filmix_lib.Todoer(mock_json_file)
+        todoer.change(1, url=server.film_url(1))
+        asyncio.run(todoer.fetch_all_statuses())
+        rows = History(mock_json_file).for_url(server.film_url(1))
+    assert len(rows) == 1
+    assert rows[0].run == 0
+    assert rows[0].quality == 'TS 1080'
+
+
+def test_import_deduplicates_in_one_write(mock_json_file):
+    from filmix import bulk
+    todoer = filmix_lib.Todoer(mock_json_file)
+    writes = []
+    original_append = todoer._db_handler.append
+    todoer._db_handler.append = lambda films: writes.append(len(films)) or original_append(films)
+    lines = [
+        '# watchlist\n',
+        'https://filmix.ac/films/1\th2.title\tspan.q\n',
+        'HTTPS://FILMIX.AC/films/1/\n',
+        test_data1['url'] + '#comments\n',
+        '\n',
+        'not a url\n',
+        'https://filmix.ac/films/2\n',
+    ]
+    result = todoer.import_films(bulk.read_films(lines))
+    assert result == filmix_lib.ImportResult(added=2, duplicates=2, invalid=1)
+    assert writes == [2]
+    films = todoer.get_film_list()
+    assert films[1] == {'id': 2, 'url': 'https://filmix.ac/films/1',
+                        'n_selector': 'h2.title', 'q_selector': 'span.q'}
+    assert films[2]['q_selector'] == 'div.quality'
+
+
+def test_import_formats():
+    from filmix import bulk
+    jsonl = ['{"url": "https://filmix.ac/films/1", "name": "One"}\n']
+    assert list(bulk.read_films(jsonl, bulk.JSONL_FORMAT))[0]['name'] == 'One'
+    with pytest.raises(ValueError, match='line 2'):
+        list(bulk.read_films(jsonl + ['{oops\n'], bulk.JSONL_FORMAT))
+    csv_lines = ['url,q_selector\n', 'https://filmix.ac/films/1,\n']
+    film, = bulk.read_films(csv_lines, bulk.CSV_FORMAT)
+    assert film == {'url': 'https://filmix.ac/films/1',
+                    'n_selector': 'h1.name', 'q_selector': 'div.quality'}
+
+
+@pytest.mark.parametrize('backend', [database.JSON_BACKEND, database.SQLITE_BACKEND,
+                                     database.JOURNAL_BACKEND])
+def test_export_streams_films(tmp_path, backend, monkeypatch):
+    import io
+    from filmix import bulk
+    db_path = tmp_path / f'films.{backend}'
+    database.init_database(db_path, True, backend)
+    films = [{'url': f'https://filmix.ac/films/{i}', 'name': f'Фильм {i}'} for i in range(300)]
+    database.DatabaseHandler(db_path, backend).write(films)
+    monkeypatch.setattr(database, 'ITER_CHUNK_SIZE', 100)
+    todoer = filmix_lib.Todoer(db_path, backend=backend)
+    stream = io.StringIO()
+    assert todoer.export_films(stream) == filmix_lib.ExportResult(300)
+    assert [json.loads(line) for line in stream.getvalue().splitlines()] == \
+        [{'id': number, **film} for number, film in enumerate(films, 1)]
+    stream = io.StringIO()
+    todoer.export_films(stream, bulk.CSV_FORMAT)
+    assert stream.getvalue().splitlines()[1] == '1,https://filmix.ac/films/0,Фильм 0,,,,,,,'
+
+
+def test_film_parses_legacy_strings(mock_json_file):
+    from filmix.film import Film
+    legacy = json.loads(mock_json_file.read_text())[0]
+    film = Film.from_dict({**legacy, 'last_checked': '2023-04-01'})
+    assert film.imdb == 7.5 and film.imdb_votes == 53966
+    assert film.filmix_users_rating == 567
+    assert film.last_checked == datetime.date(2023, 4, 1)
+    # Typed on disk, and loads back equal
+    data = film.to_dict()
+    assert data['imdb'] == 7.5 and data['last_checked'] == '2023-04-01'
+    assert Film.from_dict(json.loads(json.dumps(data))) == film
+    assert film == {**legacy, 'last_checked': '2023-04-01'}
+    # Still a mapping
+    assert film['quality'] == 'TS 1080' and 'etag' not in film
+    film['imdb'] = '|7.6|54000'
+    assert (film['imdb'], film['imdb_votes']) == (7.6, 54000)
+    film['custom'] = 'kept'
+    assert dict(film)['custom'] == 'kept'
+
+
+def test_database_stores_films(mock_json_file):
+    from filmix.film import Film
+    todoer = filmix_lib.Todoer(mock_json_file)
+    film = todoer.get_film_list()[0]
+    assert isinstance(film, Film) and film.imdb == 7.5
+    todoer.change(1, imdb='|7.5|53966', quality='TS 1080')
+    assert json.loads(mock_json_file.read_text())[0]['imdb'] == '|7.5|53966'
+    todoer.change(1, imdb='|7.7|60000')
+    stored = json.loads(mock_json_file.read_text())[0]
+    assert (stored['imdb'], stored['imdb_votes'], stored['filmix_users_rating']) == (7.7, 60000, 567)
+
+
+@pytest.mark.parametrize('backend', [database.JSON_BACKEND, database.SQLITE_BACKEND,
+                                     database.JOURNAL_BACKEND])
+def test_stable_ids(tmp_path, backend):
+    db_path = tmp_path / f'films.{backend}'
+    database.init_database(db_path, True, backend)
+    todoer = filmix_lib.Todoer(db_path, backend=backend)
+    for number in range(1, 4):
+        assert todoer.add(url=f'https://filmix.ac/films/{number}').todo.get('id') == number
+    assert todoer.remove(2).error == SUCCESS
+    assert todoer.change('HTTPS://filmix.ac/films/3/', name='Third').error == SUCCESS
+    reopened = filmix_lib.Todoer(db_path, backend=backend)
+    assert [(film.get('id'), film.get('name')) for film in reopened.get_film_list()] == \
+        [(1, None), (3, 'Third')]
+    assert reopened.find('3').todo.get('name') == 'Third'
+    assert reopened.change(2, name='Gone').error == ID_ERROR
+    assert reopened.add(url='https://filmix.ac/films/3#top').error == DUPLICATE_ERROR
+    with reopened.batch():
+        assert reopened.add(url='https://filmix.ac/films/4').todo.get('id') == 4
+        assert reopened.remove('https://filmix.ac/films/1').error == SUCCESS
+        assert reopened.change(4, name='Fourth').error == SUCCESS
+    film_list = filmix_lib.Todoer(db_path, backend=backend).get_film_list()
+    assert [(film.get('id'), film.get('name')) for film in film_list] == \
+        [(3, 'Third'), (4, 'Fourth')]
+
+
+@pytest.mark.parametrize('backend', [database.JSON_BACKEND, database.SQLITE_BACKEND,
+                                     database.JOURNAL_BACKEND])
+def test_ids_are_never_reused(tmp_path, backend):
+    db_path = tmp_path / f'films.{backend}'
+    database.init_database(db_path, True, backend)
+    todoer = filmix_lib.Todoer(db_path, backend=backend)
+    for number in range(1, 3):
+        todoer.add(url=f'https://filmix.ac/films/{number}')
+    todoer.remove(2)  # The film with the highest id
+    assert todoer.add(url='https://filmix.ac/films/3').todo.id == 3
+    with todoer.batch():
+        todoer.remove(3)
+        assert todoer.add(url='https://filmix.ac/films/4').todo.id == 4
+    reopened = filmix_lib.Todoer(db_path, backend=backend)
+    reopened.remove(4)
+    reopened.remove_all()
+    assert filmix_lib.Todoer(db_path, backend=backend).add(
+        url='https://filmix.ac/films/5').todo.id == 5
+    database.init_database(db_path, True, backend)  # A new database starts over
+    assert filmix_lib.Todoer(db_path, backend=backend).add(
+        url='https://filmix.ac/films/6').todo.id == 1
+
+
+def test_sqlite_upgrade_numbers_legacy_films(tmp_path):
+    import sqlite3
+    db_path = tmp_path / 'old.sqlite'
+    conn = sqlite3.connect(str(db_path))
+    conn.execute('CREATE TABLE films (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT,'
+                 ' last_checked TEXT, data TEXT NOT NULL)')
+    conn.executemany('INSERT INTO films (id, url, data) VALUES (?, ?, ?)',
+                     [(row_id, url, json.dumps({'url': url})) for row_id, url in
+                      [(5, 'https://filmix.ac/films/a'), (9, 'https://filmix.ac/films/b')]])
+    conn.commit()
+    conn.close()
+    todoer = filmix_lib.Todoer(db_path, backend=database.SQLITE_BACKEND)
+    # Numbered as 'filmix list' showed them before ids were stored
+    assert [film.get('id') for film in todoer.get_film_list()] == [1, 2]
+    assert todoer.find('https://FILMIX.ac/films/b/').todo.get('id') == 2
+
+
+def test_file_lock(tmp_path):
+    import threading
+    from filmix.locking import FileLock
+    path = tmp_path / 'films.json.lock'
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with FileLock(path):
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait(5)
+    try:
+        # A lock of its own, like another process would have
+        with pytest.raises(TimeoutError):
+            with FileLock(path, timeout=0.05):
+                pass
+    finally:
+        release.set()
+        thread.join()
+    lock = FileLock(path, timeout=0.05)
+    with lock, lock:  # The holder may take it again
+        pass
+
+
+def _add_films(db_path, backend, worker, count):
+    handler = database.DatabaseHandler(db_path, backend)
+    for number in range(count):
+        error = handler.append([{'url': f'https://filmix.ac/films/{worker}-{number}'}])
+        assert error == SUCCESS, error
+
+
+@pytest.mark.parametrize('backend', [database.JSON_BACKEND, database.SQLITE_BACKEND,
+                                     database.JOURNAL_BACKEND])
+def test_concurrent_processes_keep_every_film(tmp_path, backend):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    db_path = tmp_path / f'films.{backend}'
+    database.init_database(db_path, True, backend)
+    with ProcessPoolExecutor(4, mp_context=get_context('spawn')) as pool:
+        for future in [pool.submit(_add_films, db_path, backend, worker, 10)
+                       for worker in range(4)]:
+            future.result()
+    films = database.DatabaseHandler(db_path, backend).read().todo_list
+    assert len({film.url for film in films}) == 40
+    assert sorted(film.id for film in films) == list(range(1, 41))
+
+
+@pytest.mark.parametrize('backend', [database.JSON_BACKEND, database.SQLITE_BACKEND,
+                                     database.JOURNAL_BACKEND])
+def test_batch_merges_concurrent_changes(tmp_path, backend):
+    db_path = tmp_path / f'films.{backend}'
+    database.init_database(db_path, True, backend)
+    todoer = filmix_lib.Todoer(db_path, backend=backend)
+    for number in range(1, 4):
+        todoer.add(url=f'https://filmix.ac/films/{number}')
+    # Another process, with a database handler of its own
+    other = filmix_lib.Todoer(db_path, backend=backend)
+    with todoer.batch() as uow:
+        assert todoer.change(1, name='Mine').error == SUCCESS
+        assert todoer.remove(2).error == SUCCESS
+        assert todoer.add(url='https://filmix.ac/films/mine').todo.get('id') == 4
+        assert other.change(3, name='Theirs').error == SUCCESS
+        assert other.change(2, name='Removed here').error == SUCCESS
+        assert other.add(url='https://filmix.ac/films/theirs').todo.get('id') == 4
+        assert other.remove(1).error == SUCCESS
+    # Our film got the next free id, and later changes find it under it
+    assert uow.find('https://filmix.ac/films/mine').id == 5
+    assert todoer.change(5, name='Mine too').error == SUCCESS
+    film_list = filmix_lib.Todoer(db_path, backend=backend).get_film_list()
+    assert [(film.id, film.name) for film in film_list] == \
+        [(3, 'Theirs'), (4, None), (5, 'Mine too')]
+
+
+def test_write_behind_follows_renumbered_films(mock_json_file):
+    todoer = filmix_lib.Todoer(mock_json_file)
+    other = filmix_lib.Todoer(mock_json_file)
+    with todoer.batch(write_behind=True) as uow:
+        film = todoer.add(url='https://filmix.ac/films/mine').todo
+        assert film.id == 2
+        other.add(url='https://filmix.ac/films/theirs')
+        uow.commit()
+        uow.writer.flush()
+        todoer.change(film.id, name='Mine')
+    assert [(film.id, film.url.rsplit('/', 1)[1], film.name)
+            for film in other.get_film_list()[1:]] == [(2, 'theirs', None), (3, 'mine', 'Mine')]
+
+
+def test_job_queue_leases(tmp_path):
+    from filmix.jobqueue import JobQueue
+    films = [(film_id, {'id': film_id, 'url': f'https://filmix.ac/films/{film_id}'})
+             for film_id in (1, 2, 3)]
+    with JobQueue(tmp_path / 'filmix.json.jobs', max_attempts=2) as queue:
+        assert queue.enqueue(films) == 3
+        assert queue.enqueue(films) == 0
+        assert [job.film_id for job in queue.lease('a', 2, 10, now=0)] == [1, 2]
+        assert [job.film.url for job in queue.lease('b', 5, 10, now=0)] == [films[2][1]['url']]
+        assert queue.stats(now=5) == (0, 3, 0, 0)
+        queue.release('b', [3])
+        # a stops answering, its leases run out and b takes the jobs over
+        assert [(job.film_id, job.attempts) for job in queue.lease('b', 5, 10, now=11)] == [
+            (1, 2), (2, 2), (3, 1)]
+        assert queue.complete('a', {1: {'name': 'Late'}}) == 0
+        assert queue.complete('b', {1: {'name': 'One'}, 3: {}}) == 2
+        assert queue.results() == {1: (films[0][1]['url'], {'name': 'One'}),
+                                   3: (films[2][1]['url'], {})}
+        queue.ack([1, 3])
+        assert queue.stats(now=30) == (0, 0, 0, 1)
+        assert queue.lease('c', 5, 10, now=30) == []
+        assert queue.discard_given_up(now=30) == ['https://filmix.ac/films/2']
+        assert queue.stats(now=30) == (0, 0, 0, 0)
+
+
+def test_dispatch_skips_results_of_changed_films(mock_json_file, tmp_path):
+    from filmix.jobqueue import JobQueue
+    todoer = filmix_lib.Todoer(mock_json_file)
+    film = todoer.get_film_list()[0]
+    with JobQueue(tmp_path / 'filmix.json.jobs') as queue:
+        queue.enqueue([(1, film)])
+        # Left over from an earlier dispatch, the job gets the film as it is now
+        film = Film.from_dict({**film, 'q_selector': 'span.q2'})
+        assert queue.enqueue([(1, film)]) == 0
+        job, = queue.lease('a', 1)
+        assert job.film.q_selector == 'span.q2'
+        todoer.change(1, url='https://filmix.ac/films/other')
+        queue.complete('a', {1: {'quality': 'HD 1080P'}})
+        assert todoer.dispatch(queue, poll=0) == (0, 0, [], SUCCESS)
+        assert queue.stats() == (0, 0, 0, 0)
+    assert todoer.get_film_list()[0].quality != 'HD 1080P'
+
+
+def test_workers_refresh_through_the_queue(mock_json_file):
+    from tests.stub_server import StubFilmServer
+    with StubFilmServer() as server:
+        todoer = filmix_lib.Todoer(mock_json_file)
+        todoer.change(1, url=server.film_url(1))
+        for n in (2, 3):
+            todoer.add(url=server.film_url(n))
+        with todoer.job_queue() as queue:
+            assert todoer.queue_due(queue) == (3, 0, [], SUCCESS)
+            # A worker that leased a job and died before finishing it
+            assert len(queue.lease('dead', 1, seconds=-1)) == 1
+            worker = filmix_lib.Todoer(mock_json_file, history=False)
+            assert asyncio.run(worker.work(queue, 'alive', batch=2, once=True)) == 3
+            assert server.served == 3
+            result = todoer.dispatch(queue, poll=0)
+            assert queue.stats() == (0, 0, 0, 0)
+            # Nobody left to fetch what is queued
+            queue.enqueue([(1, todoer.get_film_list()[0])])
+            assert todoer.dispatch(queue, poll=0, workers_alive=lambda: False).error \
+                == WORKERS_ERROR
+    assert result == (0, 3, [], SUCCESS)
+    films = filmix_lib.Todoer(mock_json_file).get_film_list()
+    assert [(film.name, film.quality) for film in films[1:]] == [
+        ('Film 2', 'WEB-DL 720'), ('Film 3', 'HD 1080P')]
+    assert all(film.next_due for film in films)